@@ -2,17 +2,130 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import base64
+import codecs
+import cProfile
+import hashlib
+import io
+import json
+import math
+import mmap
+import os
+import posixpath
 import re
+import shlex
 import shutil
-from dataclasses import dataclass
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import zipfile
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass, field
+from http import HTTPStatus
 from pathlib import Path
-from typing import List, Optional, Set, Tuple
+from typing import IO, Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for --optimize_figures
+    Image = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak memory is then not reported
+    resource = None
 
 
 # Constants
 IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".pdf", ".eps", ".svg"}
 BIB_EXTS = {".bib"}
 
+# Order in which extension-less \includegraphics targets are resolved
+# (pdfLaTeX's default graphics extensions first)
+IMAGE_EXT_ORDER = (".pdf", ".png", ".jpg", ".jpeg", ".eps", ".svg")
+
+# "referenced": migrate only \includegraphics targets; "all": every image file
+IMAGE_MODES = ("referenced", "all")
+IMAGE_COPY_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Multi-file manuscripts: "single" flattens every \input/\include/\subfile
+# into main.tex, "per_file" keeps the includes and writes each file rewritten
+INCLUDE_MODES = ("single", "per_file")
+INCLUDE_COMMANDS = ("input", "include", "subfile")
+INCLUDE_READ_WORKERS = min(16, (os.cpu_count() or 1) + 4)
+
+# Figure optimization (--optimize_figures, needs Pillow)
+RASTER_EXTS = {".png", ".jpg", ".jpeg"}
+FIGURE_DPI = 300
+# Bump when the optimizer's output changes, to invalidate cached results
+FIGURE_OPT_VERSION = 1
+# MDPI article layout (Definitions/mdpi.cls): A4 with 5.87 cm / 1.27 cm side
+# margins; \fulllength is the width of full-width figures
+MDPI_TEXTWIDTH_CM = 13.86
+MDPI_FULLLENGTH_CM = 18.46
+MDPI_TEXTHEIGHT_CM = 24.0
+
+# LaTeX compilation (--compile); the main .tex file name is appended to each command
+LATEX_CMD = "pdflatex -interaction=nonstopmode"
+BIBTEX_CMD = "bibtex"
+LATEX_MAX_PASSES = 5
+# Dumps the static part of the preamble into a format with mylatexformat;
+# -jobname and the .tex file are added by PreambleFormat
+FORMAT_CMD = "pdftex -ini -interaction=nonstopmode &pdflatex mylatexformat.ltx"
+# Compiled PDF cache (--cache_pdf): size limit and age after which entries not
+# used since are evicted; bump the version when cached artifacts change
+PDF_CACHE_MAX_MB = 1024
+PDF_CACHE_MAX_DAYS = 30
+PDF_CACHE_VERSION = 1
+
+# Budget for main-file detection: stop reading a .tex file after this much.
+# \documentclass has to show up early; \begin{document} may follow a long preamble.
+MAIN_TEX_CLASS_SCAN_BYTES = 64 * 1024
+MAIN_TEX_SCAN_BYTES = 512 * 1024
+MAIN_TEX_SCAN_LINES = 20000
+MAIN_TEX_READ_CHUNK = 16 * 1024
+
+# Threads running independent conversion stages (template copy, body
+# processing, image copy, bib merge) side by side; 1 runs them in sequence
+STAGE_WORKERS = 4
+
+# How template files are materialized into out_dir; "changed" (copy only when
+# size/mtime/hash differ) is the default and the fallback of every link mode
+MATERIALIZE_STRATEGIES = ("changed", "copy", "hardlink", "reflink", "symlink")
+
+# Linux FICLONE ioctl (copy-on-write clone on btrfs/XFS/...)
+_FICLONE = 0x40049409
+
+# Archive conversion (VirtualFS): chunk size for streamed copies, and output
+# files that are already compressed and are stored in the zip as they are
+STREAM_CHUNK = 1024 * 1024
+# Text files at least this large are decoded straight from a memory map,
+# without a bytes copy of the whole file; written text is encoded and
+# compared in pieces of TEXT_CHUNK characters
+MMAP_MIN_BYTES = 1024 * 1024
+TEXT_CHUNK = 256 * 1024
+ZIP_STORED_EXTS = {".png", ".jpg", ".jpeg", ".pdf", ".zip", ".gz"}
+# Largest total uncompressed size of an input archive convert_archive accepts,
+# so a small zip bomb cannot exhaust memory or a service worker
+ARCHIVE_MAX_UNPACKED_MB = 4096
+
+# Conversion service (--serve): default port, largest accepted upload, and how
+# many conversions may wait for a worker before new ones are refused with 503
+SERVICE_PORT = 8765
+SERVICE_MAX_UPLOAD_MB = 512
+SERVICE_MAX_QUEUE = 16
+# Deflate level of service responses: they only travel over localhost, so
+# compression speed matters more than size
+SERVICE_ZIP_LEVEL = 1
+
 
 @dataclass
 class ConversionReport:
@@ -24,6 +137,25 @@ class ConversionReport:
     merged_bib: Optional[str]
     warnings: List[str]
     errors: List[str]
+    incremental: List[str] = field(default_factory=list)
+    included_files: List[str] = field(default_factory=list)
+    cited_keys: List[str] = field(default_factory=list)
+    bib_entries_total: int = 0
+    bib_entries_written: int = 0
+    missing_cite_keys: List[str] = field(default_factory=list)
+    image_sources: Dict[str, str] = field(default_factory=dict)
+    missing_images: List[str] = field(default_factory=list)
+    renamed_images: List[str] = field(default_factory=list)
+    duplicate_images: List[str] = field(default_factory=list)
+    figure_specs: Dict[str, List[List[Any]]] = field(default_factory=dict)
+    figure_results: List[Dict[str, Any]] = field(default_factory=list)
+    compile_steps: List[Dict[str, Any]] = field(default_factory=list)
+    pdf: Optional[str] = None
+    preamble_format: Optional[str] = None
+    pdf_cache: Optional[str] = None
+    stages: List[Dict[str, Any]] = field(default_factory=list)
+    journal: Optional[str] = None
+    shared_assets_from: Optional[str] = None
 
     def to_md(self) -> str:
         """Generate markdown report"""
@@ -33,22 +165,60 @@ class ConversionReport:
         out.append("## 1) 主文件识别")
         out.append(f"- AMA 主 tex：{self.source_main_tex or '（未找到）'}")
         out.append(f"- MDPI 模板主 tex：{self.mdpi_template_main_tex or '（未找到）'}")
+        if self.journal:
+            out.append(f"- 期刊选项：{self.journal}")
+        if self.shared_assets_from:
+            out.append(f"- 正文由一次解析共享；图片与参考文献链接自：{self.shared_assets_from}")
 
         out.append("\n## 2) 正文抽取")
         out.append(f"- 抽取正文行数（粗略）：{self.extracted_body_lines}")
+        if self.included_files:
+            out.append(f"- \\input/\\include/\\subfile 子文件：{len(self.included_files)}")
+            for p in self.included_files[:40]:
+                out.append(f"  - {p}")
 
         out.append("\n## 3) 图片迁移")
-        if self.copied_images:
-            out.append(f"- 迁移图片数量：{len(self.copied_images)}")
-            for p in self.copied_images[:40]:
+        images = self.copied_images + [r["path"] for r in self.figure_results if not r.get("error")]
+        if images:
+            out.append(f"- 迁移图片数量：{len(images)}")
+            for p in images[:40]:
                 out.append(f"  - {p}")
-            if len(self.copied_images) > 40:
+            if len(images) > 40:
                 out.append("  - ...（剩余略）")
         else:
             out.append("- 未发现图片或未迁移")
+        if self.figure_results:
+            saved = sum(r["bytes_in"] - r["bytes_out"] for r in self.figure_results)
+            total = sum(r["bytes_in"] for r in self.figure_results) or 1
+            hits = sum(1 for r in self.figure_results if r["cached"])
+            seconds = sum(r["seconds"] for r in self.figure_results)
+            out.append(
+                f"- 图片优化：{len(self.figure_results)} 张，节省 {saved / 1024:.0f} KB"
+                f"（{saved * 100 / total:.0f}%），缓存命中 {hits}，耗时 {seconds:.2f}s"
+            )
+            for r in self.figure_results:
+                cached = "（缓存）" if r["cached"] else ""
+                out.append(
+                    f"  - {r['path']}：{r['bytes_in'] / 1024:.0f} KB → {r['bytes_out'] / 1024:.0f} KB，"
+                    f"{r['action']}，{r['seconds']:.2f}s{cached}"
+                )
+        for label, items in (
+            ("同名冲突已重命名", self.renamed_images),
+            ("内容相同已合并", self.duplicate_images),
+            ("未找到的图片引用", self.missing_images),
+        ):
+            if items:
+                out.append(f"- {label}：{len(items)}")
+                for item in items[:40]:
+                    out.append(f"  - {item}")
 
         out.append("\n## 4) 参考文献迁移")
         out.append(f"- refs.bib：{self.merged_bib or '（未生成）'}")
+        if self.merged_bib:
+            out.append(f"- 正文引用 key 数：{len(self.cited_keys)}")
+            out.append(f"- 写入条目数 / 源条目总数：{self.bib_entries_written} / {self.bib_entries_total}")
+            if self.missing_cite_keys:
+                out.append(f"- 未找到的引用 key：{', '.join(self.missing_cite_keys)}")
 
         out.append("\n## 5) 警告（可能需要人工确认）")
         if self.warnings:
@@ -64,500 +234,4929 @@ class ConversionReport:
         else:
             out.append("- （无）")
 
+        if self.incremental:
+            out.append("\n## 7) 增量构建")
+            for line in self.incremental:
+                out.append(f"- {line}")
+
+        if self.compile_steps or self.pdf_cache:
+            out.append("\n## 8) 编译")
+            counts: Dict[str, int] = {}
+            for step in self.compile_steps:
+                counts[step["tool"]] = counts.get(step["tool"], 0) + 1
+            total = sum(step["seconds"] for step in self.compile_steps)
+            runs = "，".join(f"{tool} {n} 次" for tool, n in counts.items())
+            runs = f"{runs}，共 {total:.2f}s" if runs else "取自 PDF 缓存"
+            out.append(f"- PDF：{self.pdf or '（未生成）'}（{runs}）")
+            if self.pdf_cache:
+                out.append(f"- PDF 缓存：{self.pdf_cache}")
+            if self.preamble_format:
+                out.append(f"- 预编译导言区：{self.preamble_format}")
+            for i, step in enumerate(self.compile_steps, 1):
+                out.append(f"  - {i}. {step['tool']}：{step['seconds']:.2f}s（{step['reason']}）")
+
+        if self.stages:
+            out.append("\n## 9) 各阶段耗时")
+            top = [s for s in self.stages if "/" not in s["stage"]]
+            busy = sum(s["seconds"] for s in top)
+            # Stages of the stage graph may overlap: the total is the wall-clock span
+            total = max(s["start"] + s["seconds"] for s in top) - min(s["start"] for s in top)
+            if busy > total + 0.0005:
+                out.append(f"- 总耗时：{total:.3f}s（各阶段累计 {busy:.3f}s，部分阶段并行执行）")
+            else:
+                out.append(f"- 总耗时：{total:.3f}s")
+            for s in self.stages:
+                indent = "    " if "/" in s["stage"] else ""
+                parts = [f"{s['seconds']:.3f}s"]
+                if s["bytes_read"] is not None:
+                    parts.append(f"读 {_format_bytes(s['bytes_read'])} / 写 {_format_bytes(s['bytes_written'])}")
+                elif s.get("io_shared"):
+                    # Ran alongside another stage: the process-wide counters cannot tell them apart
+                    parts.append("读 — / 写 —")
+                parts.append(f"文件 {s['files_read']} → {s['files_written']}")
+                if s["peak_rss"] is not None:
+                    parts.append(f"进程峰值内存（截至此阶段）{_format_bytes(s['peak_rss'])}")
+                skipped = "（跳过）" if s["status"] == "skipped" else ""
+                out.append(f"{indent}- {s['stage']}{skipped}：{'，'.join(parts)}")
+
         out.append("")
         return "\n".join(out)
 
 
-class TeXParser:
-    """Handle TeX file detection and parsing"""
+def _format_bytes(n: int) -> str:
+    """Human-readable byte count for the report"""
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
 
-    @staticmethod
-    def read_text(p: Path) -> str:
-        """Read text file with UTF-8 encoding"""
-        return p.read_text(encoding="utf-8", errors="ignore")
 
-    @staticmethod
-    def find_main_tex(tex_files: List[Path]) -> Optional[Path]:
-        """Find the main TeX file from a list of TeX files"""
-        candidates: List[Path] = []
-        for f in tex_files:
-            t = TeXParser.read_text(f)
-            if "\\documentclass" in t and "\\begin{document}" in t:
-                candidates.append(f)
+class StageReport:
+    """
+    One stage's view of the ConversionReport while stages run concurrently.
+    Fields are read from and set on the shared report (every stage owns its
+    own fields); warnings, errors and incremental notes, which all stages
+    append to, are buffered and merged back by merge() in stage order.
+    """
 
-        if not candidates:
-            return None
+    BUFFERED = ("warnings", "errors", "incremental")
 
-        # Priority names
-        priority_names = ["main.tex", "manuscript.tex", "paper.tex", "submission.tex", "template.tex"]
-        for name in priority_names:
-            for c in candidates:
-                if c.name.lower() == name:
-                    return c
+    def __init__(self, report: ConversionReport):
+        object.__setattr__(self, "_report", report)
+        for name in self.BUFFERED:
+            object.__setattr__(self, name, [])
 
-        # Fallback: shortest path depth then largest file size
-        candidates.sort(key=lambda x: (len(x.parts), -x.stat().st_size))
-        return candidates[0]
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._report, name)
 
-    @staticmethod
-    def extract_document_body(tex_text: str) -> str:
-        """Extract content between \\begin{document} and \\end{document}"""
-        begin = tex_text.find("\\begin{document}")
-        end = tex_text.rfind("\\end{document}")
-        if begin == -1 or end == -1 or end <= begin:
-            return ""
-        body = tex_text[begin + len("\\begin{document}") : end]
-        return body.strip()
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in self.BUFFERED:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._report, name, value)
 
-    @staticmethod
-    def collect_tex_files(folder: Path) -> List[Path]:
-        """Collect all .tex files from a folder"""
-        return [p for p in folder.rglob("*.tex") if p.is_file()]
+    def merge(self) -> None:
+        """Append the buffered lists to the shared report"""
+        for name in self.BUFFERED:
+            getattr(self._report, name).extend(getattr(self, name))
 
-    @staticmethod
-    def extract_title(tex_text: str) -> Optional[str]:
-        """Extract title from \\title{...} command"""
-        match = re.search(r'\\title\{([^}]+)\}', tex_text)
-        if match:
-            return match.group(1).strip()
-        return None
 
-    @staticmethod
-    def extract_abstract(body: str) -> Tuple[Optional[str], str]:
-        """
-        Extract abstract section content and return (abstract_text, body_without_abstract)
-        Looks for \\section*{Abstract} or \\section{Abstract}
-        """
-        # Try to find abstract section
-        pattern = r'\\section\*?\{Abstract\}\\label\{[^}]*\}\s*(.*?)(?=\\section|\Z)'
-        match = re.search(pattern, body, re.DOTALL | re.IGNORECASE)
-
-        if match:
-            abstract_text = match.group(1).strip()
-            # Remove the abstract section from body
-            body_without_abstract = re.sub(
-                r'\\section\*?\{Abstract\}\\label\{[^}]*\}.*?(?=\\section)',
-                '',
-                body,
-                count=1,
-                flags=re.DOTALL | re.IGNORECASE
-            )
-            return abstract_text, body_without_abstract.strip()
+class IndexedFile:
+    """A file recorded by TreeIndex; stat data is fetched once, on first use"""
 
-        return None, body
+    __slots__ = ("path", "rel", "suffix", "_entry", "_stat", "_index")
 
+    def __init__(self, entry: os.DirEntry, rel: str, index: "TreeIndex"):
+        self.path = Path(entry.path)
+        self.rel = rel
+        self.suffix = os.path.splitext(entry.name)[1].lower()
+        self._entry = entry
+        self._stat: Optional[os.stat_result] = None
+        self._index = index
 
-class ContentProcessor:
-    """Process and transform TeX content"""
+    @classmethod
+    def virtual(cls, path: Path, rel: str, size: int, mtime: float, index: "TreeIndex") -> "IndexedFile":
+        """Entry of a file that is not on disk (VirtualFS), with known size and mtime"""
+        f = cls.__new__(cls)
+        f.path = path
+        f.rel = rel
+        f.suffix = posixpath.splitext(rel)[1].lower()
+        f._entry = None
+        f._stat = os.stat_result((0o100644, 0, 0, 1, 0, 0, size, mtime, mtime, mtime))
+        f._index = index
+        return f
 
-    @staticmethod
-    def normalize_citations(body: str) -> Tuple[str, List[str]]:
-        """Convert natbib-like cite commands to MDPI friendly \\cite{}"""
-        warnings: List[str] = []
+    def stat(self) -> os.stat_result:
+        """Cached stat result (DirEntry.stat, at most one syscall per file)"""
+        if self._stat is None:
+            self._stat = self._entry.stat()
+            self._index.stat_calls += 1
+        return self._stat
 
-        # \citep{A} \citet{A} -> \cite{A}
-        body2 = re.sub(r"\\citep\s*\{", r"\\cite{", body)
-        body2 = re.sub(r"\\citet\s*\{", r"\\cite{", body2)
+    @property
+    def size(self) -> int:
+        return self.stat().st_size
 
-        # Check for unsupported commands
-        if "\\citeauthor" in body2:
-            warnings.append("检测到 \\citeauthor，MDPI 模板可能不支持或需要 natbib 支持。")
-        if "\\citeyear" in body2:
-            warnings.append("检测到 \\citeyear，MDPI 模板可能不支持或需要 natbib 支持。")
+    @property
+    def mtime(self) -> float:
+        return self.stat().st_mtime
 
-        return body2, warnings
 
-    @staticmethod
-    def fix_includegraphics_paths(tex: str, figures_dir: str = "figures") -> str:
-        """Rewrite includegraphics{...} to includegraphics{figures/<basename>}"""
-        pattern = re.compile(r"(\\includegraphics(?:\[[^\]]*\])?\{)([^}]+)(\})")
+class TreeIndex:
+    """
+    Single os.scandir pass over a directory tree, bucketed by extension.
+    An index built from a VirtualFS (fs is set) is also the way its files are
+    read: open() and read_text() go to the file system instead of the disk.
+    """
 
-        def repl(m: re.Match) -> str:
-            prefix = m.group(1)
-            path = m.group(2).strip()
-            suffix = m.group(3)
+    def __init__(self, root: Path, fs: Optional["VirtualFS"] = None):
+        self.root = root
+        self.fs = fs
+        self.files: List[IndexedFile] = []
+        self.dirs: List[str] = []
+        self.stat_calls = 0
+        self._by_ext: Dict[str, List[IndexedFile]] = {}
+        self._by_path: Dict[Path, IndexedFile] = {}
 
-            # Already points to figures/
-            if path.startswith(figures_dir + "/") or path.startswith("./" + figures_dir + "/"):
-                return m.group(0)
+    @classmethod
+    def build(cls, root: Path) -> "TreeIndex":
+        """Walk root once and bucket every regular file by extension"""
+        index = cls(root)
+        stack: List[Tuple[str, str]] = [(str(root), "")]
+        while stack:
+            folder, rel_folder = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
 
-            basename = Path(path).name
-            return f"{prefix}{figures_dir}/{basename}{suffix}"
+            subdirs: List[Tuple[str, str]] = []
+            for entry in entries:
+                rel = f"{rel_folder}/{entry.name}" if rel_folder else entry.name
+                try:
+                    # d_type based checks: no stat syscall on most filesystems
+                    if entry.is_dir(follow_symlinks=False):
+                        index.dirs.append(rel)
+                        subdirs.append((entry.path, rel))
+                    elif entry.is_file():
+                        index._add(IndexedFile(entry, rel, index))
+                except OSError:
+                    continue
 
-        return pattern.sub(repl, tex)
+            # Depth-first, in name order
+            stack.extend(reversed(subdirs))
+        return index
 
-    @staticmethod
-    def strip_ama_artifacts(body: str) -> str:
-        """Remove common AMA-specific commands"""
-        body = re.sub(r"\\maketitle\s*", "", body)
-        return body
+    @classmethod
+    def from_fs(cls, fs: "VirtualFS") -> "TreeIndex":
+        """Index of a virtual file system, in the same order TreeIndex.build uses"""
+        index = cls(fs.root, fs)
+        dirs: Set[str] = set()
+        def order(item: Tuple[str, int, float]) -> List[Tuple[int, str]]:
+            # Files of a directory before its sub-directories, each in name order
+            parts = item[0].split("/")
+            return [(1, part) for part in parts[:-1]] + [(0, parts[-1])]
 
-    @staticmethod
-    def remove_biblatex_commands(body: str) -> Tuple[str, List[str]]:
-        """Remove biblatex-specific commands that conflict with MDPI natbib"""
-        warnings: List[str] = []
+        for rel, size, mtime in sorted(fs.walk(), key=order):
+            parent = posixpath.dirname(rel)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = posixpath.dirname(parent)
+            index._add(IndexedFile.virtual(fs.root.joinpath(*rel.split("/")), rel, size, mtime, index))
+        index.dirs = sorted(dirs)
+        return index
 
-        # Remove \printbibliography command
-        if "\\printbibliography" in body:
-            body = re.sub(r"\\printbibliography\s*(?:\[[^\]]*\])?\s*", "", body)
-            warnings.append("已移除 \\printbibliography 命令（MDPI 使用 natbib 而非 biblatex）。")
+    def _add(self, f: IndexedFile) -> None:
+        self.files.append(f)
+        self._by_ext.setdefault(f.suffix, []).append(f)
+        self._by_path[f.path] = f
 
-        # Remove \addbibresource commands
-        if "\\addbibresource" in body:
-            body = re.sub(r"\\addbibresource\s*\{[^}]+\}\s*", "", body)
-            warnings.append("已移除 \\addbibresource 命令（MDPI 使用 natbib 而非 biblatex）。")
+    def entries_by_ext(self, exts: Set[str]) -> List[IndexedFile]:
+        """Indexed files whose lower-cased suffix is in exts, in walk order"""
+        if len(exts) == 1:
+            return list(self._by_ext.get(next(iter(exts)), []))
+        return [f for f in self.files if f.suffix in exts]
 
-        return body, warnings
+    def by_ext(self, exts: Set[str]) -> List[Path]:
+        """Paths of indexed files whose lower-cased suffix is in exts"""
+        return [f.path for f in self.entries_by_ext(exts)]
 
+    def get(self, path: Path) -> Optional[IndexedFile]:
+        """Cached entry for path, if it was indexed"""
+        return self._by_path.get(path)
 
-class FileHandler:
-    """Handle file operations: copying images, merging bib files"""
+    def open(self, path: Path, seekable: bool = False) -> BinaryIO:
+        """Binary stream of a file under root (seekable: cheap random access)"""
+        if self.fs is None:
+            return path.open("rb")
+        entry = self._by_path.get(path)
+        return self.fs.open(entry.rel if entry is not None else path.relative_to(self.root).as_posix(), seekable)
 
-    @staticmethod
-    def collect_files_by_ext(folder: Path, exts: Set[str]) -> List[Path]:
-        """Collect files with specific extensions"""
-        return [p for p in folder.rglob("*") if p.is_file() and p.suffix.lower() in exts]
+    def read_text(self, path: Path) -> str:
+        """Like TeXParser.read_text, through the file system of this index"""
+        if self.fs is None:
+            return TeXParser.read_text(path)
+        with self.open(path) as fh:
+            return fh.read().decode("utf-8", errors="ignore")
 
-    @staticmethod
-    def safe_copy(src: Path, dst: Path) -> None:
-        """Safely copy file, creating parent directories if needed"""
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(src, dst)
+    def digest(self, f: IndexedFile) -> str:
+        """SHA-256 of an indexed file's content"""
+        if self.fs is None:
+            return FileHandler.file_digest(f.path)
+        h = hashlib.sha256()
+        with self.open(f.path) as fh:
+            for chunk in iter(lambda: fh.read(STREAM_CHUNK), b""):
+                h.update(chunk)
+        return h.hexdigest()
 
-    @staticmethod
-    def copy_images(source_dir: Path, out_dir: Path, figures_dir: str) -> Tuple[List[str], List[str]]:
-        """Copy all images from source to output figures directory"""
-        images = FileHandler.collect_files_by_ext(source_dir, IMAGE_EXTS)
-        fig_dir = out_dir / figures_dir
-        fig_dir.mkdir(parents=True, exist_ok=True)
 
-        copied: List[str] = []
-        warnings: List[str] = []
+class VirtualFS(ABC):
+    """
+    File tree a conversion reads its sources from or writes its results to,
+    addressed by "/"-separated relative paths. DirFS is a plain directory and
+    keeps every local optimization (link strategies, the build manifest,
+    figure optimization, compilation); MemoryFS and ZipFS let a conversion
+    run on in-memory data and archives without touching the disk.
+    """
 
-        for img in images:
-            dst = fig_dir / img.name
-            try:
-                FileHandler.safe_copy(img, dst)
-                copied.append(str(dst.relative_to(out_dir)))
-            except Exception as e:
-                warnings.append(f"复制图片失败：{img} -> {dst}，原因：{e}")
+    local = False
+    # Whether several stages may create files at the same time
+    parallel_writes = False
 
-        return copied, warnings
+    def __init__(self, root: Path):
+        # Anchor for the Path objects the pipeline passes around
+        self.root = root
 
-    @staticmethod
-    def merge_bib_files(bibs: List[Path], out_bib: Path) -> Tuple[bool, List[str]]:
-        """Merge multiple .bib files into one, detecting duplicates"""
-        warnings: List[str] = []
-        seen_keys: Set[str] = set()
-        merged_entries: List[str] = []
+    @abstractmethod
+    def walk(self) -> Iterable[Tuple[str, int, float]]:
+        """(relative path, size, mtime) of every file"""
 
-        key_pattern = re.compile(r"@\w+\s*\{\s*([^,\s]+)\s*,", re.IGNORECASE)
+    @abstractmethod
+    def open(self, rel: str, seekable: bool = False) -> BinaryIO:
+        """Binary read stream of a file"""
 
-        for bib in bibs:
-            txt = TeXParser.read_text(bib)
-            parts = re.split(r"\n(?=@\w+\s*\{)", txt, flags=re.IGNORECASE)
-            for part in parts:
-                s = part.strip()
-                if not s.startswith("@"):
-                    continue
-                m = key_pattern.search(s)
-                if not m:
-                    warnings.append(f"bib 条目 key 解析失败（跳过）：{bib.name}")
-                    continue
-                k = m.group(1).strip()
-                if k in seen_keys:
-                    warnings.append(f"bib key 重复跳过：{k}（来源 {bib.name}）")
-                    continue
-                seen_keys.add(k)
-                merged_entries.append(s + "\n")
+    @abstractmethod
+    def create(self, rel: str, size_hint: int = 0) -> BinaryIO:
+        """Binary write stream of a new file; the file is complete once closed"""
 
-        if not merged_entries:
-            return False, warnings
+    def index(self) -> TreeIndex:
+        return TreeIndex.from_fs(self)
 
-        out_bib.parent.mkdir(parents=True, exist_ok=True)
-        out_bib.write_text("\n\n".join(merged_entries), encoding="utf-8")
-        return True, warnings
+    def write_text_if_changed(self, rel: str, text: str) -> bool:
+        """Write text (UTF-8); returns True if the file was written"""
+        return self.write_segments_if_changed(rel, [text])
 
-    @staticmethod
-    def copy_template_structure(mdpi_dir: Path, out_dir: Path) -> None:
-        """Copy entire MDPI template structure to output directory"""
-        for p in mdpi_dir.rglob("*"):
-            if p.is_dir():
-                continue
-            rel = p.relative_to(mdpi_dir)
-            dst = out_dir / rel
-            dst.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(p, dst)
+    def write_segments_if_changed(self, rel: str, segments: List[str]) -> bool:
+        """Write the concatenation of segments (UTF-8) without building it; returns True if written"""
+        with self.create(rel, sum(map(len, segments))) as fh:
+            for chunk in FileHandler.encoded_chunks(segments):
+                fh.write(chunk)
+        return True
 
+    def copy_from(self, src: TreeIndex, path: Path, rel: str) -> bool:
+        """Stream a file of src into rel in STREAM_CHUNK pieces; returns True if written"""
+        entry = src.get(path)
+        with src.open(path) as fin, self.create(rel, entry.size if entry is not None else 0) as fout:
+            shutil.copyfileobj(fin, fout, STREAM_CHUNK)
+        return True
 
-class AMAToMDPIConverter:
-    """Main converter class orchestrating the conversion process"""
+    def close(self) -> None:
+        pass
 
-    def __init__(
-        self,
-        source_dir: Path,
-        mdpi_template_dir: Path,
-        out_dir: Path,
-        out_main_tex: str = "main.tex",
-        figures_dir: str = "figures",
-        bib_name: str = "refs.bib"
-    ):
-        self.source_dir = source_dir.resolve()
-        self.mdpi_dir = mdpi_template_dir.resolve()
-        self.out_dir = out_dir.resolve()
-        self.out_main_tex = out_main_tex
-        self.figures_dir = figures_dir
-        self.bib_name = bib_name
+    def __enter__(self) -> "VirtualFS":
+        return self
 
-        self.report = ConversionReport(
-            source_main_tex=None,
-            mdpi_template_main_tex=None,
-            extracted_body_lines=0,
-            copied_images=[],
-            merged_bib=None,
-            warnings=[],
-            errors=[],
-        )
+    def __exit__(self, *exc) -> None:
+        self.close()
 
-        # Extracted metadata from source
-        self.title: Optional[str] = None
-        self.abstract: Optional[str] = None
 
-    def validate_inputs(self) -> bool:
-        """Validate input directories exist"""
-        if not self.source_dir.exists():
-            self.report.errors.append(f"source_dir 不存在：{self.source_dir}")
-        if not self.mdpi_dir.exists():
-            self.report.errors.append(f"mdpi_template_dir 不存在：{self.mdpi_dir}")
+class DirFS(VirtualFS):
+    """A directory on disk: the backend of the regular directory-based conversion"""
 
-        return len(self.report.errors) == 0
+    local = True
+    parallel_writes = True
 
-    def find_main_files(self) -> Tuple[Optional[Path], Optional[Path]]:
-        """Find main TeX files in both source and template"""
-        tex_source_files = TeXParser.collect_tex_files(self.source_dir)
-        tex_mdpi_files = TeXParser.collect_tex_files(self.mdpi_dir)
+    def walk(self) -> Iterable[Tuple[str, int, float]]:
+        return ((f.rel, f.size, f.mtime) for f in self.index().files)
 
-        src_main = TeXParser.find_main_tex(tex_source_files)
-        mdpi_main = TeXParser.find_main_tex(tex_mdpi_files)
+    def open(self, rel: str, seekable: bool = False) -> BinaryIO:
+        return (self.root / rel).open("rb")
 
-        if not src_main:
-            self.report.errors.append("未找到 AMA 主 tex（缺少 \\documentclass 或 \\begin{document}）。")
-        else:
-            self.report.source_main_tex = str(src_main.relative_to(self.source_dir))
+    def create(self, rel: str, size_hint: int = 0) -> BinaryIO:
+        path = self.root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.open("wb")
 
-        if not mdpi_main:
-            self.report.errors.append("未找到 MDPI 模板主 tex（缺少 \\documentclass 或 \\begin{document}）。")
-        else:
-            self.report.mdpi_template_main_tex = str(mdpi_main.relative_to(self.mdpi_dir))
+    def index(self) -> TreeIndex:
+        return TreeIndex.build(self.root)
 
-        return src_main, mdpi_main
+    def write_text_if_changed(self, rel: str, text: str) -> bool:
+        return FileHandler.write_text_if_changed(self.root / rel, text)
 
-    def extract_and_process_body(self, src_main: Path) -> str:
-        """Extract and process AMA document body"""
-        src_text = TeXParser.read_text(src_main)
-        body = TeXParser.extract_document_body(src_text)
+    def write_segments_if_changed(self, rel: str, segments: List[str]) -> bool:
+        return FileHandler.write_segments_if_changed(self.root / rel, segments)
 
-        if not body:
-            self.report.errors.append("AMA 主文件无法抽取正文块（找不到 begin/end document）。")
-            return ""
+    def copy_from(self, src: TreeIndex, path: Path, rel: str) -> bool:
+        if src.fs is None:
+            return FileHandler.copy_if_changed(path, self.root / rel)
+        return super().copy_from(src, path, rel)
 
-        # Extract title from preamble
-        self.title = TeXParser.extract_title(src_text)
-        if not self.title:
-            self.report.warnings.append("未找到 \\title{} 命令，MDPI 标题将使用默认值。")
 
-        # Extract abstract from body
-        self.abstract, body = TeXParser.extract_abstract(body)
-        if self.abstract:
-            self.report.warnings.append("已从正文中提取 abstract 并注入到 MDPI 模板的 \\abstract{} 命令。")
-        else:
-            self.report.warnings.append("未找到 abstract section，MDPI abstract 将使用默认值。")
+class _MemoryFile(io.BytesIO):
+    """Write stream of MemoryFS: stores its content when closed"""
 
-        # Process citations
-        body, cite_warns = ContentProcessor.normalize_citations(body)
-        self.report.warnings.extend(cite_warns)
+    def __init__(self, files: Dict[str, bytes], rel: str):
+        super().__init__()
+        self._files = files
+        self._rel = rel
 
-        # Remove biblatex commands
-        body, biblatex_warns = ContentProcessor.remove_biblatex_commands(body)
-        self.report.warnings.extend(biblatex_warns)
+    def close(self) -> None:
+        if not self.closed:
+            self._files[self._rel] = self.getvalue()
+        super().close()
 
-        # Strip AMA artifacts
-        body = ContentProcessor.strip_ama_artifacts(body)
 
-        # Fix graphics paths
-        body = ContentProcessor.fix_includegraphics_paths(body, figures_dir=self.figures_dir)
+class MemoryFS(VirtualFS):
+    """Files held in a dict of relative path -> bytes"""
 
-        self.report.extracted_body_lines = len(body.splitlines())
+    parallel_writes = True
 
-        return body
+    def __init__(self, files: Optional[Mapping[str, bytes]] = None, root: Path = Path("/<memory>")):
+        super().__init__(root)
+        self.files: Dict[str, bytes] = {}
+        for rel, data in (files or {}).items():
+            rel = _safe_rel(rel)
+            if rel:
+                self.files[rel] = bytes(data)
 
-    def inject_body_into_template(self, mdpi_main: Path, body: str) -> str:
-        """Inject processed body into MDPI template"""
-        mdpi_template_path = self.out_dir / mdpi_main.relative_to(self.mdpi_dir)
-        mdpi_template_text = TeXParser.read_text(mdpi_template_path)
+    def walk(self) -> Iterable[Tuple[str, int, float]]:
+        return ((rel, len(data), 0.0) for rel, data in self.files.items())
 
-        # Find \begin{document} and \end{document} at start of line (not in comments)
-        begin_match = re.search(r'^\\begin\{document\}', mdpi_template_text, re.MULTILINE)
-        end_match = re.search(r'^\\end\{document\}', mdpi_template_text, re.MULTILINE)
+    def open(self, rel: str, seekable: bool = False) -> BinaryIO:
+        if rel not in self.files:
+            raise FileNotFoundError(rel)
+        return io.BytesIO(self.files[rel])
 
-        if not begin_match or not end_match:
-            self.report.errors.append("MDPI 模板主文件结构异常，无法定位 begin/end document。")
-            return ""
+    def create(self, rel: str, size_hint: int = 0) -> BinaryIO:
+        return _MemoryFile(self.files, rel)
 
-        mdpi_begin = begin_match.end()
-        mdpi_end = end_match.start()
 
-        if mdpi_end <= mdpi_begin:
-            self.report.errors.append("MDPI 模板主文件结构异常，end document 在 begin document 之前。")
-            return ""
+class WarmTemplate(MemoryFS):
+    """
+    A template directory read into memory once, for processes that convert
+    many manuscripts against the same template (the --serve workers). The
+    tree index is built once as well, so the template main file and
+    Definitions/ are never read from disk again.
+    """
 
-        pre = mdpi_template_text[:mdpi_begin]
-        post = mdpi_template_text[mdpi_end:]
+    def __init__(self, template_dir: Path):
+        template_dir = template_dir.resolve()
+        files = {f.rel: f.path.read_bytes() for f in TreeIndex.build(template_dir).files}
+        super().__init__(files, root=template_dir)
+        self._index: Optional[TreeIndex] = None
 
-        # Replace title in preamble if extracted
-        if self.title:
-            pre = re.sub(r'\\Title\{[^}]*\}', f'\\\\Title{{{self.title}}}', pre)
+    def index(self) -> TreeIndex:
+        if self._index is None:
+            self._index = super().index()
+        return self._index
 
-        # Replace abstract in preamble if extracted
-        if self.abstract:
-            # Escape special regex characters in abstract
-            abstract_escaped = self.abstract.replace('\\', '\\\\')
-            pre = re.sub(
-                r'\\abstract\{[^}]*?\}',
-                f'\\\\abstract{{{self.abstract}}}',
-                pre,
-                flags=re.DOTALL
-            )
 
-        # Combine body with template
-        final_main = pre + "\n\n" + body + "\n\n" + post
+class ArchiveTooLarge(ValueError):
+    """An input archive unpacks to more than the allowed total size"""
 
-        # Ensure bibliography command exists (check if not already in body or template)
-        # Check the entire document body section
-        if "\\bibliography{" not in body and "\\begin{thebibliography}" not in body:
-            # Insert bibliography before \end{document}
-            end_doc_pos = final_main.rfind("\\end{document}")
-            if end_doc_pos != -1:
-                final_main = final_main[:end_doc_pos] + "\\bibliography{refs}\n\n" + final_main[end_doc_pos:]
-                self.report.warnings.append("未检测到 bibliography 指令，已在 \\end{document} 前添加 \\bibliography{refs}。")
 
-        return final_main
+class ZipFS(VirtualFS):
+    """
+    A zip archive, read (mode "r") or written (mode "w") as a stream; file
+    is a path or a binary file object. Written entries are deflated except
+    for already-compressed formats, which are stored. In read mode,
+    max_unpacked caps the total uncompressed size: zipfile never inflates a
+    member past its declared size, so the declared sizes bound what can be
+    read and an archive over the cap is refused before anything is inflated.
+    """
 
-    def process_images(self) -> None:
-        """Copy images from source to output"""
-        copied, warnings = FileHandler.copy_images(
-            self.source_dir,
-            self.out_dir,
-            self.figures_dir
+    # Entries macOS adds to archives made in Finder
+    IGNORED_PREFIXES = ("__MACOSX/",)
+
+    def __init__(
+        self,
+        file: Union[str, Path, IO[bytes]],
+        mode: str = "r",
+        root: Path = Path("/<zip>"),
+        compresslevel: Optional[int] = None,
+        max_unpacked: Optional[int] = None
+    ):
+        super().__init__(root)
+        self.mode = mode
+        self.zip = zipfile.ZipFile(
+            file, mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=compresslevel
         )
-        self.report.copied_images = copied
-        self.report.warnings.extend(warnings)
+        self._members: Dict[str, zipfile.ZipInfo] = {}
+        # Entries created so far (mode "w")
+        self._written: Set[str] = set()
+        if mode == "r":
+            for info in self.zip.infolist():
+                rel = _safe_rel(info.filename)
+                if rel and not info.is_dir() and not info.filename.startswith(self.IGNORED_PREFIXES):
+                    self._members.setdefault(rel, info)
+            unpacked = sum(info.file_size for info in self._members.values())
+            if max_unpacked is not None and unpacked > max_unpacked:
+                self.zip.close()
+                raise ArchiveTooLarge(f"archive unpacks to {unpacked} bytes, more than {max_unpacked}")
 
-    def process_bibliography(self) -> None:
-        """Merge bibliography files"""
-        bibs = FileHandler.collect_files_by_ext(self.source_dir, BIB_EXTS)
-        out_bib = self.out_dir / self.bib_name
+    def walk(self) -> Iterable[Tuple[str, int, float]]:
+        for rel, info in self._members.items():
+            yield rel, info.file_size, time.mktime(info.date_time + (0, 0, -1))
 
-        if bibs:
-            ok, bib_warns = FileHandler.merge_bib_files(bibs, out_bib)
-            self.report.warnings.extend(bib_warns)
-            if ok:
-                self.report.merged_bib = str(out_bib.relative_to(self.out_dir))
-            else:
-                self.report.warnings.append("bib 合并失败：未生成 refs.bib（可能源 bib 为空）。")
-        else:
-            self.report.warnings.append("未找到任何 .bib 文件，引用可能无法编译。")
+    def open(self, rel: str, seekable: bool = False) -> BinaryIO:
+        info = self._members.get(rel)
+        if info is None:
+            raise FileNotFoundError(rel)
+        fh = self.zip.open(info)
+        if seekable and info.compress_type != zipfile.ZIP_STORED:
+            # Seeking backwards in a compressed member restarts decompression
+            with fh:
+                return io.BytesIO(fh.read())
+        return fh
 
-    def convert(self) -> bool:
-        """Execute the complete conversion process"""
-        # Create output directory
-        self.out_dir.mkdir(parents=True, exist_ok=True)
+    def create(self, rel: str, size_hint: int = 0) -> BinaryIO:
+        if rel in self._written:
+            raise ValueError(f"duplicate archive entry: {rel}")
+        stored = posixpath.splitext(rel)[1].lower() in ZIP_STORED_EXTS
+        # Opened by name, an entry takes the archive's compression and level
+        # (and the ZipInfo default timestamp). Entries are written one at a
+        # time, so switching the compression per entry is safe.
+        self.zip.compression = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        self._written.add(rel)
+        return self.zip.open(rel, "w", force_zip64=size_hint > 0x7FFFFFFF)
 
-        # Validate inputs
-        if not self.validate_inputs():
-            self.save_report()
-            return False
+    def close(self) -> None:
+        self.zip.close()
 
-        # Find main files
-        src_main, mdpi_main = self.find_main_files()
-        if self.report.errors:
-            self.save_report()
-            return False
 
-        # Copy MDPI template structure
-        FileHandler.copy_template_structure(self.mdpi_dir, self.out_dir)
+def _safe_rel(name: str) -> str:
+    """Normalized relative path of an archive/mapping member; "" if it escapes the root"""
+    rel = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if rel in ("", ".") or rel == ".." or rel.startswith("../"):
+        return ""
+    return rel
 
-        # Extract and process body
-        body = self.extract_and_process_body(src_main)
-        if self.report.errors:
-            self.save_report()
-            return False
 
-        # Inject body into template
-        final_main = self.inject_body_into_template(mdpi_main, body)
-        if self.report.errors:
-            self.save_report()
-            return False
+class TeXLexer:
+    """
+    Linear-time scanner over TeX source. Only the spots the converter cares
+    about are tokenized (control words of interest, escapes, comments and
+    verbatim regions); plain text between them is skipped by the regex engine.
+    Arguments are read with brace depth tracking, so nested groups such as
+    \\title{A \\emph{B}} come out whole.
+    """
 
-        # Process images
-        self.process_images()
+    VERBATIM_ENVS = ("verbatim", "verbatim*", "Verbatim", "lstlisting", "minted", "comment")
 
-        # Process bibliography
-        self.process_bibliography()
+    _cache: Dict[Tuple[str, ...], "TeXLexer"] = {}
+    _group_scan = re.compile(r"\\.|[{}%]", re.DOTALL)
+    _option_scan = re.compile(r"\\.|[{}\]%]", re.DOTALL)
+    _spaces = re.compile(r"\s*")
 
-        # Write output main TeX file
-        (self.out_dir / self.out_main_tex).write_text(final_main, encoding="utf-8")
+    # Fast path for the common argument shape: *, up to two simple [...] options
+    # and a {...} group without nested braces, escapes or comments
+    _SIMPLE_ARGS = (
+        r"(?:\s*\*)?(?:\s*\[[^\[\]{}%\\]*(?:\\[A-Za-z@]+[^\[\]{}%\\]*)*\]){0,2}"
+        r"\s*\{(?P<arg>[^{}%\\]*)\}"
+    )
 
-        # Save report
-        self.save_report()
+    def __init__(self, commands: Iterable[str]):
+        names = "|".join(sorted((re.escape(c) for c in commands), key=len, reverse=True))
+        envs = "|".join(re.escape(e) for e in self.VERBATIM_ENVS)
+        # A single literal \\ prefix lets the regex engine skip plain text with
+        # its fast literal search; comments and \\\\ are checked per match in commands()
+        self.pattern = re.compile(
+            r"\\(?:verb\*?(?P<delim>[^A-Za-z*\s])"
+            r"|begin\s*\{(?P<env>" + envs + r")\}"
+            + (r"|(?P<cs>" + names + r")(?![A-Za-z@])(?:" + self._SIMPLE_ARGS + ")?" if names else "")
+            + ")"
+        )
 
-        return True
+    @classmethod
+    def for_commands(cls, commands: Iterable[str]) -> "TeXLexer":
+        """Shared lexer for a set of control word names"""
+        key = tuple(sorted(set(commands)))
+        lexer = cls._cache.get(key)
+        if lexer is None:
+            lexer = cls._cache[key] = cls(key)
+        return lexer
 
-    def save_report(self) -> None:
-        """Save conversion report to output directory"""
-        (self.out_dir / "conversion_report.md").write_text(
-            self.report.to_md(),
-            encoding="utf-8"
-        )
+    def commands(
+        self,
+        text: str,
+        pos: int = 0,
+        end: Optional[int] = None
+    ) -> Iterator[Tuple[str, int, int, Optional[Tuple[int, int]]]]:
+        """
+        Yield (name, start, end, group) for every control word of interest
+        outside comments and verbatim regions. group is (content_start, end)
+        of a simple {...} argument recognised on the fast path, else None and
+        callers read arguments with read_optional/read_group.
+        """
+        end = len(text) if end is None else end
+        finditer = self.pattern.finditer
+        # text[clean_from:start] is the part of the current line not yet checked for a comment
+        clean_from = -1
+        while True:
+            for m in finditer(text, pos, end):
+                start = m.start()
+                if start and text[start - 1] == "\\" and TeXLexer._escaped(text, start):
+                    # "\\\\cmd" is a line break followed by letters
+                    continue
 
-    def print_summary(self) -> None:
-        """Print conversion summary"""
-        if self.report.errors:
-            print(f"[ERROR] Conversion failed. Check report: {self.out_dir / 'conversion_report.md'}")
-            for err in self.report.errors:
-                print(f"  - {err}")
-        else:
-            print(f"[OK] Converted project generated at: {self.out_dir}")
-            print(f"[OK] Main TeX: {self.out_dir / self.out_main_tex}")
-            print(f"[OK] Report: {self.out_dir / 'conversion_report.md'}")
+                # Inside a comment? Each character is looked at a bounded number of times
+                if clean_from == -1 or text.rfind("\n", clean_from, start) != -1:
+                    clean_from = text.rfind("\n", 0, start) + 1
+                pct = text.find("%", clean_from, start)
+                while pct != -1 and TeXLexer._escaped(text, pct):
+                    pct = text.find("%", pct + 1, start)
+                if pct != -1:
+                    nl = text.find("\n", start, end)
+                    pos = end if nl == -1 else nl
+                    clean_from = -1
+                    break
+                clean_from = start
 
+                kind = m.lastgroup
+                if kind == "delim":
+                    close = text.find(m.group("delim"), m.end(), end)
+                    pos = end if close == -1 else close + 1
+                    clean_from = -1
+                    break
+                if kind == "env":
+                    close = text.find("\\end{" + m.group("env") + "}", m.end(), end)
+                    pos = end if close == -1 else close
+                    clean_from = -1
+                    break
+                arg = m.start("arg")
+                yield m.group("cs"), start, m.end("cs"), (arg, m.end("arg") + 1) if arg != -1 else None
+            else:
+                return
 
-def main() -> None:
-    ap = argparse.ArgumentParser(
-        description="Convert AMA format LaTeX paper to MDPI template format"
-    )
-    ap.add_argument("--source_dir", required=True, help="AMA source directory")
-    ap.add_argument("--mdpi_template_dir", required=True, help="MDPI template directory")
-    ap.add_argument("--out_dir", required=True, help="Output directory")
-    ap.add_argument("--out_main_tex", default="main.tex", help="Output main TeX filename")
-    ap.add_argument("--figures_dir", default="figures", help="Figures directory name")
-    ap.add_argument("--bib_name", default="refs.bib", help="Output bibliography filename")
-    args = ap.parse_args()
+    @staticmethod
+    def _escaped(text: str, pos: int) -> bool:
+        """True if the character at pos is preceded by an odd run of backslashes"""
+        i = pos - 1
+        while i >= 0 and text[i] == "\\":
+            i -= 1
+        return (pos - 1 - i) % 2 == 1
 
-    converter = AMAToMDPIConverter(
-        source_dir=Path(args.source_dir),
-        mdpi_template_dir=Path(args.mdpi_template_dir),
-        out_dir=Path(args.out_dir),
-        out_main_tex=args.out_main_tex,
-        figures_dir=args.figures_dir,
-        bib_name=args.bib_name
-    )
+    @staticmethod
+    def skip_spaces(text: str, pos: int) -> int:
+        """Index of the first non-whitespace character at or after pos"""
+        return TeXLexer._spaces.match(text, pos).end()
+
+    @staticmethod
+    def _balanced(text: str, pos: int, scanner: "re.Pattern", closer: str) -> int:
+        """Index just past the closer that ends the group opened before pos, or -1"""
+        depth = 0
+        while True:
+            for m in scanner.finditer(text, pos):
+                c = m.group()
+                if c == "%":
+                    nl = text.find("\n", m.end())
+                    if nl == -1:
+                        return -1
+                    pos = nl
+                    break
+                if c == "{":
+                    depth += 1
+                elif c == "}":
+                    if depth == 0:
+                        return m.end() if closer == "}" else -1
+                    depth -= 1
+                elif c == closer and depth == 0:
+                    return m.end()
+            else:
+                return -1
+
+    @staticmethod
+    def read_group(text: str, pos: int) -> Optional[Tuple[int, int]]:
+        """
+        For a { at pos, return (content_start, end) where end is just past the
+        matching }; None if there is no balanced group at pos
+        """
+        if pos >= len(text) or text[pos] != "{":
+            return None
+        end = TeXLexer._balanced(text, pos + 1, TeXLexer._group_scan, "}")
+        return None if end == -1 else (pos + 1, end)
+
+    @staticmethod
+    def read_optional(text: str, pos: int) -> Optional[Tuple[int, int]]:
+        """Like read_group for a [...] optional argument (braces inside are skipped)"""
+        if pos >= len(text) or text[pos] != "[":
+            return None
+        end = TeXLexer._balanced(text, pos + 1, TeXLexer._option_scan, "]")
+        return None if end == -1 else (pos + 1, end)
+
+    def find_first(self, text: str, name: str) -> Optional[Tuple[int, int]]:
+        """(start, end) of the first uncommented occurrence of control word name"""
+        for cs, start, end, _ in self.commands(text):
+            if cs == name:
+                return start, end
+        return None
+
+
+class TeXParser:
+    """Handle TeX file detection and parsing"""
+
+    _abstract_head = re.compile(r"\\section\*?\{Abstract\}\\label\{[^}]*\}", re.IGNORECASE)
+    _section = re.compile(r"\\section", re.IGNORECASE)
+
+    # Line boundaries of str.splitlines
+    _line_break = re.compile(r"\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
+    _RARE_LINE_BREAKS = "\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+
+    @staticmethod
+    def read_text(p: Path) -> str:
+        """Read text file with UTF-8 encoding (universal newlines, like Path.read_text)"""
+        with p.open("rb") as fh:
+            if os.fstat(fh.fileno()).st_size < MMAP_MIN_BYTES:
+                text = fh.read().decode("utf-8", errors="ignore")
+            else:
+                # Decoded from the page cache: no second copy of the file as bytes
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    text = str(mm, "utf-8", "ignore")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
+    @staticmethod
+    def count_lines(text: str) -> int:
+        """len(text.splitlines()), without building the list of lines"""
+        if not any(c in text for c in TeXParser._RARE_LINE_BREAKS):
+            # Only \n breaks lines (the usual case): counted in C
+            return text.count("\n") + (not text.endswith("\n") and text != "")
+        count = 0
+        end = 0
+        for m in TeXParser._line_break.finditer(text):
+            count += 1
+            end = m.end()
+        return count + (end < len(text))
+
+    @staticmethod
+    def strip_comment(line: str) -> str:
+        """Drop a TeX comment (first unescaped %) from a single line"""
+        pos = line.find("%")
+        while pos != -1:
+            backslashes = 0
+            i = pos - 1
+            while i >= 0 and line[i] == "\\":
+                backslashes += 1
+                i -= 1
+            if backslashes % 2 == 0:
+                return line[:pos]
+            pos = line.find("%", pos + 1)
+        return line
+
+    @staticmethod
+    def _find_uncommented(block: str, marker: str, start: int = 0) -> int:
+        """Position of the first occurrence of marker in block that is not in a comment"""
+        pos = block.find(marker, start)
+        while pos != -1:
+            line_start = block.rfind("\n", 0, pos) + 1
+            prefix = block[line_start:pos]
+            if "%" not in prefix or len(TeXParser.strip_comment(prefix)) == len(prefix):
+                return pos
+            pos = block.find(marker, pos + 1)
+        return -1
+
+    @staticmethod
+    def has_main_markers(
+        p: Path,
+        max_bytes: int = MAIN_TEX_SCAN_BYTES,
+        max_lines: int = MAIN_TEX_SCAN_LINES,
+        class_bytes: int = MAIN_TEX_CLASS_SCAN_BYTES,
+        index: Optional[TreeIndex] = None
+    ) -> Optional[bool]:
+        """
+        Stream a .tex file and report whether it has an uncommented \\documentclass
+        followed by \\begin{document}. The first class_bytes are read at once
+        and a file without \\documentclass in them is rejected on the raw bytes;
+        otherwise reading continues from the same handle until both markers are
+        found or \\begin{document} shows up first. Returns None if the
+        byte/line budget runs out before that. With an index, p is read
+        through it (see TreeIndex.open).
+        """
+        has_class = False
+        consumed = 0
+        lines = 0
+        pending = ""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        try:
+            with (index.open(p) if index is not None and index.fs is not None else p.open("rb")) as raw:
+                data = raw.read(class_bytes)
+                # Most non-main files stop here, after one read and a bytes search
+                if b"\\documentclass" not in data:
+                    return False
+                while True:
+                    eof = not data
+                    consumed += len(data)
+                    buf = pending + decoder.decode(data, final=eof)
+                    # Only scan complete lines so comment checks see the whole prefix
+                    cut = len(buf) if eof else buf.rfind("\n") + 1
+                    block, pending = buf[:cut], buf[cut:]
+                    lines += block.count("\n")
+
+                    start = 0
+                    if not has_class:
+                        cls_pos = TeXParser._find_uncommented(block, "\\documentclass")
+                        begin_pos = TeXParser._find_uncommented(block, "\\begin{document}")
+                        if begin_pos != -1 and (cls_pos == -1 or begin_pos < cls_pos):
+                            return False
+                        if cls_pos == -1:
+                            if eof or (consumed >= class_bytes and "\\documentclass" not in pending):
+                                return False
+                        else:
+                            has_class = True
+                            start = cls_pos
+                    if has_class and TeXParser._find_uncommented(block, "\\begin{document}", start) != -1:
+                        return True
+                    if eof:
+                        return False
+                    if consumed >= max_bytes or lines >= max_lines:
+                        return None
+                    data = raw.read(MAIN_TEX_READ_CHUNK)
+        except OSError:
+            return False
+
+    @staticmethod
+    def find_main_tex(tex_files: List[Path], index: Optional[TreeIndex] = None) -> Optional[Path]:
+        """Find the main TeX file from a list of TeX files"""
+        candidates: List[Path] = []
+        undecided: List[Path] = []
+        for f in tex_files:
+            found = TeXParser.has_main_markers(f, index=index)
+            if found:
+                candidates.append(f)
+            elif found is None:
+                undecided.append(f)
+        if not candidates:
+            # A \\documentclass but no \\begin{document} within the budget, e.g. a
+            # main file with a very long preamble: scan those files in full
+            unlimited = sys.maxsize
+            candidates = [f for f in undecided if TeXParser.has_main_markers(f, unlimited, unlimited, index=index)]
+
+        if not candidates:
+            return None
+
+        # Priority names
+        priority_names = ["main.tex", "manuscript.tex", "paper.tex", "submission.tex", "template.tex"]
+        for name in priority_names:
+            for c in candidates:
+                if c.name.lower() == name:
+                    return c
+
+        def size_of(p: Path) -> int:
+            entry = index.get(p) if index is not None else None
+            return entry.size if entry is not None else p.stat().st_size
+
+        # Fallback: shortest path depth then largest file size
+        candidates.sort(key=lambda x: (len(x.parts), -size_of(x)))
+        return candidates[0]
+
+    @staticmethod
+    def _rfind_uncommented(text: str, marker: str) -> int:
+        """Position of the last occurrence of marker in text that is not in a comment"""
+        pos = text.rfind(marker)
+        while pos != -1:
+            line_start = text.rfind("\n", 0, pos) + 1
+            prefix = text[line_start:pos]
+            if "%" not in prefix or len(TeXParser.strip_comment(prefix)) == len(prefix):
+                return pos
+            pos = text.rfind(marker, 0, pos)
+        return -1
+
+    @staticmethod
+    def document_bounds(tex_text: str) -> Tuple[int, int]:
+        """Span of the stripped content between \\begin{document} and \\end{document} (empty if absent)"""
+        begin = TeXParser._find_uncommented(tex_text, "\\begin{document}")
+        end = TeXParser._rfind_uncommented(tex_text, "\\end{document}")
+        if begin == -1 or end == -1 or end <= begin:
+            return 0, 0
+        start = begin + len("\\begin{document}")
+        while start < end and tex_text[start].isspace():
+            start += 1
+        while end > start and tex_text[end - 1].isspace():
+            end -= 1
+        return start, end
+
+    @staticmethod
+    def extract_document_body(tex_text: str) -> str:
+        """Extract content between \\begin{document} and \\end{document}"""
+        start, end = TeXParser.document_bounds(tex_text)
+        return tex_text[start:end]
+
+    @staticmethod
+    def collect_tex_files(folder: Path, index: Optional[TreeIndex] = None) -> List[Path]:
+        """Collect all .tex files from a folder (from index when given)"""
+        if index is not None:
+            return index.by_ext({".tex"})
+        return [p for p in folder.rglob("*.tex") if p.is_file()]
+
+    @staticmethod
+    def extract_title(tex_text: str) -> Optional[str]:
+        """Extract title from \\title[short]{...} command (nested braces allowed)"""
+        found = TeXLexer.for_commands(["title"]).find_first(tex_text, "title")
+        if not found:
+            return None
+        pos = TeXLexer.skip_spaces(tex_text, found[1])
+        opt = TeXLexer.read_optional(tex_text, pos)
+        if opt:
+            pos = TeXLexer.skip_spaces(tex_text, opt[1])
+        group = TeXLexer.read_group(tex_text, pos)
+        if not group:
+            return None
+        title = tex_text[group[0]:group[1] - 1].strip()
+        return title or None
+
+    @staticmethod
+    def extract_graphicspath(tex_text: str) -> List[str]:
+        """Directories listed in \\graphicspath{{dir1/}{dir2/}}, in order"""
+        found = TeXLexer.for_commands(["graphicspath"]).find_first(tex_text, "graphicspath")
+        if not found:
+            return []
+        outer = TeXLexer.read_group(tex_text, TeXLexer.skip_spaces(tex_text, found[1]))
+        if not outer:
+            return []
+        dirs: List[str] = []
+        pos = TeXLexer.skip_spaces(tex_text, outer[0])
+        while pos < outer[1] - 1:
+            group = TeXLexer.read_group(tex_text, pos)
+            if not group:
+                break
+            d = tex_text[group[0]:group[1] - 1].strip()
+            if d:
+                dirs.append(d)
+            pos = TeXLexer.skip_spaces(tex_text, group[1])
+        return dirs
+
+    @staticmethod
+    def extract_abstract(body: str, start: int = 0, end: Optional[int] = None) -> Tuple[Optional[str], str]:
+        """
+        Extract abstract section content and return (abstract_text, body_without_abstract)
+        Looks for \\section*{Abstract} or \\section{Abstract}; the abstract runs
+        to the next \\section, found by one forward search from the heading.
+        start/end limit the body to a span of a larger text (see document_bounds),
+        which is then sliced once instead of copied as a whole first.
+        """
+        end = len(body) if end is None else end
+        head = TeXParser._abstract_head.search(body, start, end)
+        if not head:
+            return None, body[start:end]
+
+        following = TeXParser._section.search(body, head.end(), end)
+        if not following:
+            # Last section: the abstract is still extracted, the body keeps it
+            return body[head.end():end].strip(), body[start:end].strip()
+        abstract_text = body[head.end():following.start()].strip()
+        before = body[start:head.start()]
+        if not before.strip():
+            # The abstract opens the body (the usual case): one slice, no concatenation
+            return abstract_text, body[following.start():end].strip()
+        return abstract_text, (before + body[following.start():end]).strip()
+
+
+@dataclass
+class IncludeRef:
+    """One \\input/\\include/\\subfile command in a file"""
+    command: str
+    start: int
+    end: int
+    name: str
+    target: Optional[Path]
+
+
+class IncludeResolver:
+    """
+    Follows \\input, \\include and \\subfile from the main file. Every file is
+    read once into a shared cache, however often it is included; the files
+    of one include level are read in parallel. Names resolve like LaTeX does,
+    relative to the main file's directory (then to the including file's own
+    directory, for \\subfile-style projects), with .tex appended if missing.
+    """
+
+    _BARE_NAME = re.compile(r"[ \t]+([^\s{}\\%]+)")
+
+    def __init__(self, main: Path, index: Optional[TreeIndex] = None, workers: int = INCLUDE_READ_WORKERS):
+        self.main = main
+        self.base = main.parent
+        self.index = index
+        self.workers = workers
+        self.texts: Dict[Path, str] = {}
+        self.refs: Dict[Path, List[IncludeRef]] = {}
+        self.warnings: List[str] = []
+        self._flat: Dict[Path, str] = {}
+        # (file, position) of include commands that close a cycle
+        self._cycles: Set[Tuple[Path, int]] = set()
+
+    def _exists(self, p: Path) -> bool:
+        """File test answered from the tree index when possible"""
+        if self.index is not None and self.index.get(p) is not None:
+            return True
+        return (self.index is None or self.index.fs is None) and p.is_file()
+
+    def _read(self, p: Path) -> str:
+        return self.index.read_text(p) if self.index is not None else TeXParser.read_text(p)
+
+    def resolve(self, name: str, current: Path) -> Optional[Path]:
+        """File an include name refers to, or None if there is none"""
+        names = [name] if name.lower().endswith(".tex") else [name + ".tex", name]
+        dirs = [self.base] if current.parent == self.base else [self.base, current.parent]
+        for d in dirs:
+            for n in names:
+                p = Path(os.path.normpath(d / n))
+                if self._exists(p):
+                    return p
+        return None
+
+    def scan(self, path: Path) -> List[IncludeRef]:
+        """Include commands of a cached file, skipping comments and verbatim"""
+        text = self.texts[path]
+        refs: List[IncludeRef] = []
+        for cs, start, end, group in TeXLexer.for_commands(INCLUDE_COMMANDS).commands(text):
+            if group is None:
+                group = TeXLexer.read_group(text, TeXLexer.skip_spaces(text, end))
+            if group is not None:
+                name, stop = text[group[0]:group[1] - 1].strip(), group[1]
+            elif cs == "input":
+                # Plain TeX form: \input file
+                m = self._BARE_NAME.match(text, end)
+                if not m:
+                    continue
+                name, stop = m.group(1), m.end()
+            else:
+                continue
+            if name:
+                refs.append(IncludeRef(cs, start, stop, name, self.resolve(name, path)))
+        return refs
+
+    def load(self) -> "IncludeResolver":
+        """Read the main file and everything it includes, one include level at a time"""
+        frontier = [self.main]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while frontier:
+                for path, text in zip(frontier, pool.map(self._read, frontier)):
+                    self.texts[path] = text
+                queued: Set[Path] = set()
+                next_frontier: List[Path] = []
+                for path in frontier:
+                    self.refs[path] = self.scan(path)
+                    for ref in self.refs[path]:
+                        if ref.target is not None and ref.target not in self.texts and ref.target not in queued:
+                            queued.add(ref.target)
+                            next_frontier.append(ref.target)
+                frontier = next_frontier
+        return self
+
+    @property
+    def included(self) -> List[Path]:
+        """Every file reached from the main file, in reading order"""
+        return [p for p in self.texts if p != self.main]
+
+    def _warn(self, message: str) -> None:
+        if message not in self.warnings:
+            self.warnings.append(message)
+
+    def rel_name(self, p: Path) -> str:
+        """Path of p relative to the main file's directory, with / separators"""
+        return os.path.relpath(p, self.base).replace(os.sep, "/")
+
+    def expand(self, path: Optional[Path] = None, keep: Optional[Callable[[IncludeRef], bool]] = None) -> str:
+        """
+        Text of path (default: the main file) with includes replaced by the
+        included text, recursively. Refs for which keep() is true stay as
+        \\input/\\include commands naming the file relative to the main
+        directory (a \\subfile becomes \\input). Include cycles are cut with a
+        warning; unresolved names are left as they are.
+        """
+        return self._expand(path or self.main, keep, ())
+
+    def _expand(self, path: Path, keep: Optional[Callable[[IncludeRef], bool]], stack: Tuple[Path, ...]) -> str:
+        if keep is None and path in self._flat:
+            return self._flat[path]
+        text = self.texts[path]
+        pieces: List[str] = []
+        last = 0
+        for ref in self.refs[path]:
+            pieces.append(text[last:ref.start])
+            last = ref.end
+            if ref.target is None:
+                self._warn(f"\\{ref.command}{{{ref.name}}} 找不到对应文件，已原样保留。")
+                pieces.append(text[ref.start:ref.end])
+                continue
+            if ref.target in stack or ref.target == path or (path, ref.start) in self._cycles:
+                self._cycles.add((path, ref.start))
+                chain = " → ".join(self.rel_name(p) for p in stack + (path, ref.target))
+                self._warn(f"检测到循环包含（{chain}），已忽略重复的 \\{ref.command}。")
+                continue
+            if keep is not None and keep(ref):
+                rel = self.rel_name(ref.target)
+                if ref.command != "subfile" and self.resolve(ref.name, self.main) == ref.target:
+                    pieces.append(text[ref.start:ref.end])
+                elif ref.command == "include":
+                    pieces.append(f"\\include{{{rel[:-4] if rel.endswith('.tex') else rel}}}")
+                else:
+                    pieces.append(f"\\input{{{rel}}}")
+                continue
+            content = self._expand(ref.target, None, stack + (path,))
+            if ref.command == "subfile":
+                content = TeXParser.extract_document_body(content) or content
+            elif ref.command == "include":
+                content = "\\clearpage\n" + content.rstrip("\n") + "\n\\clearpage\n"
+            pieces.append(content)
+        pieces.append(text[last:])
+        result = "".join(pieces)
+        if keep is None:
+            self._flat[path] = result
+        return result
+
+    def per_file_texts(self) -> Dict[Path, str]:
+        """
+        For per-file output: each file included from the document body that
+        lives under the main directory, with its own includes kept (a
+        \\subfile reduced to its document body). Files outside the main
+        directory cannot be referenced from the output project and are inlined
+        into their includer instead. Call after expand(), which finds cycles.
+        """
+        begin = TeXParser._find_uncommented(self.texts[self.main], "\\begin{document}")
+        pending = [r for r in self.refs[self.main] if r.start > begin]
+        reached: Set[Path] = set()
+        while pending:
+            ref = pending.pop()
+            if ref.target is None or ref.target in reached or ref.target == self.main:
+                continue
+            reached.add(ref.target)
+            pending.extend(r for r in self.refs[ref.target] if (ref.target, r.start) not in self._cycles)
+
+        subfiles = {r.target for refs in self.refs.values() for r in refs if r.command == "subfile"}
+        texts: Dict[Path, str] = {}
+        for p in self.included:
+            if p not in reached or not self.keep_separate(p):
+                continue
+            text = self.expand(p, self.keep_ref)
+            if p in subfiles:
+                text = (TeXParser.extract_document_body(text) or text) + "\n"
+            texts[p] = text
+        return texts
+
+    def keep_separate(self, p: Path) -> bool:
+        """Whether p can be written as its own file next to the output main file"""
+        return not self.rel_name(p).startswith("../")
+
+    def keep_ref(self, ref: IncludeRef) -> bool:
+        """expand() predicate of per-file output: keep includes of separate files"""
+        return ref.target is not None and self.keep_separate(ref.target)
+
+
+@dataclass
+class RewriteResult:
+    """Outcome of ContentProcessor.rewrite_body"""
+    body: str
+    warnings: List[str]
+    graphics: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ImagePlan:
+    """Where each image goes in figures_dir and what \\includegraphics should say"""
+    paths: Dict[str, str]      # \includegraphics argument -> rewritten argument
+    sources: Dict[str, str]    # target file name in figures_dir -> source path (relative)
+    missing: List[str] = field(default_factory=list)
+    renamed: List[str] = field(default_factory=list)
+    duplicates: List[str] = field(default_factory=list)
+    targets: Dict[str, str] = field(default_factory=dict)  # \includegraphics argument -> file name
+
+
+class ContentProcessor:
+    """Process and transform TeX content"""
+
+    REWRITE_COMMANDS = (
+        "citep", "citet", "citeauthor", "citeyear", "citeyearpar",
+        "maketitle", "printbibliography", "addbibresource", "includegraphics",
+    )
+    # Output pieces joined into one chunk at a time: thousands of small
+    # slices cost several times their text in object overhead
+    REWRITE_FLUSH_PIECES = 4096
+
+    @staticmethod
+    def _read_arguments(text: str, pos: int, max_optional: int = 2) -> Optional[Tuple[int, int]]:
+        """
+        Skip an optional star and up to max_optional [...] arguments after a
+        command; return (content_start, end) of the following {...} argument
+        (end just past the closing brace) or None
+        """
+        end = pos
+        if text.startswith("*", end):
+            end += 1
+        for _ in range(max_optional):
+            opt = TeXLexer.read_optional(text, TeXLexer.skip_spaces(text, end))
+            if not opt:
+                break
+            end = opt[1]
+        return TeXLexer.read_group(text, TeXLexer.skip_spaces(text, end))
+
+    @staticmethod
+    def rewrite_body(
+        body: str,
+        figures_dir: str = "figures",
+        citations: bool = True,
+        biblatex: bool = True,
+        artifacts: bool = True,
+        graphics: bool = True,
+        graphics_map: Optional[Dict[str, str]] = None
+    ) -> RewriteResult:
+        """
+        Apply every body rewrite in one traversal, skipping comments and
+        verbatim regions, and writing into a single output buffer:
+        \\citep/\\citet -> \\cite, drop \\maketitle, drop \\printbibliography and
+        \\addbibresource, and point \\includegraphics at figures_dir/<basename>
+        (or at graphics_map[target] when given). Graphics targets are
+        collected along the way.
+        """
+        chunks: List[str] = []
+        out: List[str] = []
+        last = 0
+        warnings: List[str] = []
+        targets: List[str] = []
+        seen = {"citeauthor": False, "citeyear": False, "printbibliography": False, "addbibresource": False}
+
+        lexer = TeXLexer.for_commands(ContentProcessor.REWRITE_COMMANDS)
+        for name, start, end, group in lexer.commands(body):
+            if len(out) >= ContentProcessor.REWRITE_FLUSH_PIECES:
+                chunks.append("".join(out))
+                out.clear()
+            if name == "citep" or name == "citet":
+                if citations:
+                    out.append(body[last:start])
+                    out.append("\\cite")
+                    # "\\citep {" -> "\\cite{"
+                    brace = TeXLexer.skip_spaces(body, end)
+                    last = brace if body.startswith("{", brace) else end
+
+            elif name == "citeauthor":
+                seen["citeauthor"] = True
+
+            elif name.startswith("citeyear"):
+                seen["citeyear"] = True
+
+            elif name == "includegraphics":
+                if group is None:
+                    group = ContentProcessor._read_arguments(body, end)
+                    if not group:
+                        continue
+                path = body[group[0]:group[1] - 1].strip()
+                targets.append(path)
+                if not graphics:
+                    continue
+                mapped = graphics_map.get(path) if graphics_map else None
+                if mapped is None:
+                    # Already points to figures/
+                    if path.startswith(figures_dir + "/") or path.startswith("./" + figures_dir + "/"):
+                        continue
+                    mapped = f"{figures_dir}/{path[path.rfind('/') + 1:]}"
+                out.append(body[last:group[0]])
+                out.append(mapped)
+                last = group[1] - 1
+
+            elif name == "maketitle":
+                if artifacts:
+                    out.append(body[last:start])
+                    last = TeXLexer.skip_spaces(body, end)
+
+            elif name == "printbibliography":
+                if biblatex:
+                    stop = TeXLexer.skip_spaces(body, end)
+                    opt = TeXLexer.read_optional(body, stop)
+                    if opt:
+                        stop = TeXLexer.skip_spaces(body, opt[1])
+                    out.append(body[last:start])
+                    last = stop
+                    seen["printbibliography"] = True
+
+            elif name == "addbibresource":
+                if biblatex:
+                    if group is None:
+                        group = ContentProcessor._read_arguments(body, end, max_optional=1)
+                    if group:
+                        out.append(body[last:start])
+                        last = TeXLexer.skip_spaces(body, group[1])
+                        seen["addbibresource"] = True
+
+        out.append(body[last:])
+
+        # Check for unsupported commands
+        if citations and seen["citeauthor"]:
+            warnings.append("检测到 \\citeauthor，MDPI 模板可能不支持或需要 natbib 支持。")
+        if citations and seen["citeyear"]:
+            warnings.append("检测到 \\citeyear，MDPI 模板可能不支持或需要 natbib 支持。")
+        if seen["printbibliography"]:
+            warnings.append("已移除 \\printbibliography 命令（MDPI 使用 natbib 而非 biblatex）。")
+        if seen["addbibresource"]:
+            warnings.append("已移除 \\addbibresource 命令（MDPI 使用 natbib 而非 biblatex）。")
+
+        return RewriteResult(
+            body="".join(chunks + out) if last else body,
+            warnings=warnings,
+            graphics=targets,
+        )
+
+    # Commands whose last mandatory argument is a comma separated list of bib keys
+    CITE_COMMANDS = (
+        "cite", "citep", "citet", "citealp", "citealt", "citeauthor", "citeyear",
+        "citeyearpar", "citenum", "nocite", "parencite", "textcite", "autocite",
+        "footcite", "supercite", "Cite", "Citep", "Citet", "Parencite", "Textcite", "Autocite",
+    )
+
+    @staticmethod
+    def collect_cite_keys(body: str) -> List[str]:
+        """Bib keys cited in body (outside comments/verbatim), in first-use order; "*" for \\nocite{*}"""
+        keys: Dict[str, None] = {}
+        lexer = TeXLexer.for_commands(ContentProcessor.CITE_COMMANDS)
+        for _, _, end, group in lexer.commands(body):
+            if group is None:
+                group = ContentProcessor._read_arguments(body, end)
+                if not group:
+                    continue
+            for key in body[group[0]:group[1] - 1].split(","):
+                key = key.strip()
+                if key:
+                    keys[key] = None
+        return list(keys)
+
+    @staticmethod
+    def collect_graphics(body: str) -> List[str]:
+        """\\includegraphics targets in body (outside comments/verbatim), in order"""
+        return [target for target, _ in ContentProcessor.collect_graphics_options(body)]
+
+    @staticmethod
+    def collect_graphics_options(body: str) -> List[Tuple[str, str]]:
+        """(target, text between the command and its target, e.g. "[width=5cm]") per \\includegraphics"""
+        found: List[Tuple[str, str]] = []
+        for _, _, end, group in TeXLexer.for_commands(["includegraphics"]).commands(body):
+            if group is None:
+                group = ContentProcessor._read_arguments(body, end)
+                if not group:
+                    continue
+            found.append((body[group[0]:group[1] - 1].strip(), body[end:group[0] - 1]))
+        return found
+
+    @staticmethod
+    def normalize_citations(body: str) -> Tuple[str, List[str]]:
+        """Convert natbib-like cite commands to MDPI friendly \\cite{}"""
+        r = ContentProcessor.rewrite_body(body, biblatex=False, artifacts=False, graphics=False)
+        return r.body, r.warnings
+
+    @staticmethod
+    def fix_includegraphics_paths(tex: str, figures_dir: str = "figures") -> str:
+        """Rewrite includegraphics{...} to includegraphics{figures/<basename>}"""
+        return ContentProcessor.rewrite_body(
+            tex, figures_dir, citations=False, biblatex=False, artifacts=False
+        ).body
+
+    @staticmethod
+    def strip_ama_artifacts(body: str) -> str:
+        """Remove common AMA-specific commands"""
+        return ContentProcessor.rewrite_body(body, citations=False, biblatex=False, graphics=False).body
+
+    @staticmethod
+    def remove_biblatex_commands(body: str) -> Tuple[str, List[str]]:
+        """Remove biblatex-specific commands that conflict with MDPI natbib"""
+        r = ContentProcessor.rewrite_body(body, citations=False, artifacts=False, graphics=False)
+        return r.body, r.warnings
+
+
+class FileHandler:
+    """Handle file operations: copying images, merging bib files"""
+
+    @staticmethod
+    def collect_files_by_ext(folder: Path, exts: Set[str], index: Optional[TreeIndex] = None) -> List[Path]:
+        """Collect files with specific extensions (from index when given)"""
+        if index is not None:
+            return index.by_ext(exts)
+        return [p for p in folder.rglob("*") if p.is_file() and p.suffix.lower() in exts]
+
+    @staticmethod
+    def file_digest(p: Path) -> str:
+        """SHA-256 of a file's content"""
+        h = hashlib.sha256()
+        with p.open("rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def safe_copy(src: Path, dst: Path) -> None:
+        """Safely copy file, creating parent directories if needed"""
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(src, dst)
+
+    @staticmethod
+    def same_content(src: Path, dst: Path) -> bool:
+        """True if dst holds the same bytes as src (size/mtime first, hash only on doubt)"""
+        try:
+            s_st, d_st = src.stat(), dst.stat()
+        except OSError:
+            return False
+        if s_st.st_size != d_st.st_size:
+            return False
+        if s_st.st_mtime == d_st.st_mtime:
+            return True
+        return FileHandler.file_digest(dst) == FileHandler.file_digest(src)
+
+    @staticmethod
+    def _is_link_to(src: Path, dst: Path) -> bool:
+        """True if dst is a symlink or hardlink to src"""
+        try:
+            return dst.is_symlink() or os.path.samefile(src, dst)
+        except OSError:
+            return False
+
+    @staticmethod
+    def _unlink(p: Path) -> None:
+        if p.is_symlink() or p.exists():
+            p.unlink()
+
+    @staticmethod
+    def copy_if_changed(src: Path, dst: Path) -> bool:
+        """Copy src to dst unless dst already holds identical bytes; returns True if copied"""
+        if FileHandler._is_link_to(src, dst):
+            FileHandler._unlink(dst)
+        elif FileHandler.same_content(src, dst):
+            return False
+        try:
+            # Never write through a hard link shared with another output (link_shared_images)
+            if dst.stat().st_nlink > 1:
+                dst.unlink()
+        except OSError:
+            pass
+        FileHandler.safe_copy(src, dst)
+        return True
+
+    @staticmethod
+    def reflink(src: Path, dst: Path) -> bool:
+        """Copy-on-write clone of src to dst; False if the filesystem cannot do it"""
+        if not sys.platform.startswith("linux"):
+            return False
+        import fcntl
+
+        try:
+            with src.open("rb") as s, dst.open("wb") as d:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        except OSError:
+            try:
+                dst.unlink()
+            except OSError:
+                pass
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    @staticmethod
+    def materialize(src: Path, dst: Path, strategy: str = "changed") -> str:
+        """
+        Make dst provide the content of src using the given strategy.
+        Returns what was actually done: "skipped", "copy", "hardlink", "reflink"
+        or "symlink"; link modes fall back to copying when unsupported.
+        """
+        dst.parent.mkdir(parents=True, exist_ok=True)
+
+        if strategy == "hardlink":
+            try:
+                if os.path.samefile(src, dst):
+                    return "skipped"
+            except OSError:
+                pass
+            try:
+                FileHandler._unlink(dst)
+                os.link(src, dst)
+                return "hardlink"
+            except OSError:
+                pass
+        elif strategy == "symlink":
+            target = src.resolve()
+            if dst.is_symlink() and Path(os.readlink(dst)) == target:
+                return "skipped"
+            try:
+                FileHandler._unlink(dst)
+                os.symlink(target, dst)
+                return "symlink"
+            except OSError:
+                pass
+        elif strategy == "reflink":
+            if not FileHandler._is_link_to(src, dst) and FileHandler.same_content(src, dst):
+                return "skipped"
+            FileHandler._unlink(dst)
+            if FileHandler.reflink(src, dst):
+                return "reflink"
+        elif strategy == "copy":
+            FileHandler._unlink(dst)
+            FileHandler.safe_copy(src, dst)
+            return "copy"
+
+        return "copy" if FileHandler.copy_if_changed(src, dst) else "skipped"
+
+    @staticmethod
+    def write_text_if_changed(p: Path, text: str) -> bool:
+        """Write text unless the file already has this exact content; returns True if written"""
+        return FileHandler.write_segments_if_changed(p, [text])
+
+    @staticmethod
+    def encoded_chunks(segments: List[str]) -> Iterator[bytes]:
+        """UTF-8 encoding of the concatenated segments, TEXT_CHUNK characters at a time"""
+        for segment in segments:
+            for i in range(0, len(segment), TEXT_CHUNK):
+                yield segment[i:i + TEXT_CHUNK].encode("utf-8")
+
+    @staticmethod
+    def _has_chunks(p: Path, segments: List[str]) -> bool:
+        """Whether file p holds exactly the encoded segments (compared piece by piece)"""
+        with p.open("rb") as fh:
+            for chunk in FileHandler.encoded_chunks(segments):
+                if fh.read(len(chunk)) != chunk:
+                    return False
+            return not fh.read(1)
+
+    @staticmethod
+    def write_segments_if_changed(p: Path, segments: List[str]) -> bool:
+        """
+        Write the concatenation of segments unless the file already has this
+        exact content; returns True if written. Neither the whole text nor
+        its encoding is ever held in memory.
+        """
+        try:
+            st = p.lstat()
+            if not p.is_symlink() and FileHandler._has_chunks(p, segments):
+                return False
+            # Never write through a link into the template or source tree
+            if p.is_symlink() or st.st_nlink > 1:
+                p.unlink()
+        except OSError:
+            pass
+        p.parent.mkdir(parents=True, exist_ok=True)
+        with p.open("wb") as fh:
+            for chunk in FileHandler.encoded_chunks(segments):
+                fh.write(chunk)
+        return True
+
+    @staticmethod
+    def resolve_graphic(ref: str, index: TreeIndex, search_dirs: List[str]) -> Optional[IndexedFile]:
+        """
+        Source file for an \\includegraphics target, looked up like LaTeX does:
+        in each search dir (relative to the index root) as written, then with
+        every extension of IMAGE_EXT_ORDER appended
+        """
+        if not ref:
+            return None
+        if os.path.isabs(ref):
+            try:
+                bases = [Path(ref).resolve().relative_to(index.root).as_posix()]
+            except ValueError:
+                return None
+        else:
+            bases = [posixpath.normpath(posixpath.join(d, ref)) for d in search_dirs]
+
+        for base in bases:
+            if base.startswith("../"):
+                continue
+            names = [base] if posixpath.splitext(base)[1].lower() in IMAGE_EXTS else []
+            names.extend(base + ext for ext in IMAGE_EXT_ORDER)
+            for name in names:
+                found = index.get(index.root / name)
+                if found is not None:
+                    return found
+        return None
+
+    @staticmethod
+    def plan_images(
+        refs: List[str],
+        index: TreeIndex,
+        figures_dir: str,
+        search_dirs: Optional[List[str]] = None,
+        include_unreferenced: bool = False,
+        workers: int = IMAGE_COPY_WORKERS
+    ) -> ImagePlan:
+        """
+        Assign a file name in figures_dir to every referenced image (and, with
+        include_unreferenced, every other image in the index). Byte-identical
+        files share one name; different files with the same name get -2, -3,
+        ... suffixes in order of first reference, so the result is deterministic.
+        """
+        search_dirs = search_dirs if search_dirs is not None else [""]
+        plan = ImagePlan(paths={}, sources={})
+
+        resolved: Dict[str, IndexedFile] = {}
+        ordered: Dict[str, IndexedFile] = {}
+        for ref in refs:
+            if ref in resolved or ref in plan.missing:
+                continue
+            f = FileHandler.resolve_graphic(ref, index, search_dirs)
+            if f is None:
+                plan.missing.append(ref)
+                continue
+            resolved[ref] = f
+            ordered.setdefault(f.rel, f)
+        if include_unreferenced:
+            for f in sorted(index.entries_by_ext(IMAGE_EXTS), key=lambda f: f.rel):
+                ordered.setdefault(f.rel, f)
+
+        # Only files sharing a size can be identical: hash just those, in parallel
+        by_size: Dict[int, List[IndexedFile]] = {}
+        for f in ordered.values():
+            by_size.setdefault(f.size, []).append(f)
+        to_hash = [f for group in by_size.values() if len(group) > 1 for f in group]
+        keys: Dict[str, str] = {f.rel: "file:" + f.rel for f in ordered.values()}
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                for f, digest in zip(to_hash, pool.map(index.digest, to_hash)):
+                    keys[f.rel] = "sha256:" + digest
+
+        names: Dict[str, str] = {}
+        by_key: Dict[str, str] = {}
+        taken: Set[str] = set()
+        for f in ordered.values():
+            key = keys[f.rel]
+            if key in by_key:
+                names[f.rel] = by_key[key]
+                plan.duplicates.append(f"{f.rel} = {figures_dir}/{by_key[key]}")
+                continue
+            name = posixpath.basename(f.rel)
+            stem, ext = posixpath.splitext(name)
+            n = 1
+            # Case-insensitive, so the result also works on Windows/macOS file systems
+            while name.lower() in taken:
+                n += 1
+                name = f"{stem}-{n}{ext}"
+            if n > 1:
+                plan.renamed.append(f"{f.rel} -> {figures_dir}/{name}")
+            taken.add(name.lower())
+            by_key[key] = name
+            names[f.rel] = name
+            plan.sources[name] = f.rel
+
+        # Extension-less references stay extension-less unless that would be ambiguous
+        stems: Dict[str, int] = {}
+        for name in plan.sources:
+            stem = posixpath.splitext(name)[0].lower()
+            stems[stem] = stems.get(stem, 0) + 1
+        for ref, f in resolved.items():
+            name = names[f.rel]
+            stem = posixpath.splitext(name)[0]
+            if posixpath.splitext(ref)[1].lower() not in IMAGE_EXTS and stems[stem.lower()] == 1:
+                name = stem
+            plan.paths[ref] = f"{figures_dir}/{name}"
+            plan.targets[ref] = names[f.rel]
+        return plan
+
+    @staticmethod
+    def copy_images(
+        source_dir: Path,
+        out_dir: Path,
+        figures_dir: str,
+        index: Optional[TreeIndex] = None,
+        sources: Optional[Dict[str, str]] = None,
+        workers: int = IMAGE_COPY_WORKERS
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Copy images into the output figures directory on a thread pool.
+        sources maps target file names to source paths (see plan_images);
+        by default every image under source_dir is copied.
+        """
+        if sources is None:
+            index = index if index is not None else TreeIndex.build(source_dir.resolve())
+            sources = FileHandler.plan_images([], index, figures_dir, include_unreferenced=True).sources
+        fig_dir = out_dir / figures_dir
+        fig_dir.mkdir(parents=True, exist_ok=True)
+
+        def copy_one(item: Tuple[str, str]) -> Optional[str]:
+            name, rel = item
+            img, dst = source_dir / rel, fig_dir / name
+            try:
+                FileHandler.copy_if_changed(img, dst)
+            except Exception as e:
+                return f"复制图片失败：{img} -> {dst}，原因：{e}"
+            return None
+
+        copied: List[str] = []
+        warnings: List[str] = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            # map() keeps plan order, so the report is deterministic
+            for (name, _), error in zip(sources.items(), pool.map(copy_one, sources.items())):
+                if error:
+                    warnings.append(error)
+                else:
+                    copied.append(f"{figures_dir}/{name}")
+
+        return copied, warnings
+
+    @staticmethod
+    def replace_if_changed(tmp: Path, dst: Path) -> bool:
+        """Move tmp over dst unless dst already has the same bytes; returns True if replaced"""
+        if dst.is_file() and not FileHandler._is_link_to(tmp, dst) and \
+                dst.stat().st_size == tmp.stat().st_size and \
+                FileHandler.file_digest(dst) == FileHandler.file_digest(tmp):
+            tmp.unlink()
+            return False
+        if dst.is_symlink():
+            dst.unlink()
+        os.replace(tmp, dst)
+        return True
+
+    @staticmethod
+    def merge_bib_files(
+        bibs: List[Path],
+        out_bib: Path,
+        cited: Optional[List[str]] = None
+    ) -> Tuple[bool, List[str]]:
+        """
+        Merge multiple .bib files into one, detecting duplicates. With cited,
+        only those entries (plus crossref and @string dependencies) are kept.
+        """
+        if cited is None:
+            out_bib.parent.mkdir(parents=True, exist_ok=True)
+            tmp = out_bib.with_name(out_bib.name + ".tmp")
+            with tmp.open("w", encoding="utf-8", newline="") as out:
+                index = BibIndex.stream_all(bibs, out.write)
+            if not index.total:
+                tmp.unlink()
+                return False, list(index.warnings)
+            FileHandler.replace_if_changed(tmp, out_bib)
+            return True, list(index.warnings)
+
+        index = BibIndex.build(bibs)
+        warnings = list(index.warnings)
+        refs = index.select(cited)
+        missing = index.missing(cited)
+        if missing:
+            warnings.append(f"正文引用的 bib key 未找到：{', '.join(missing)}")
+        if not refs:
+            return False, warnings
+        index.write(refs, out_bib)
+        return True, warnings
+
+    @staticmethod
+    def copy_template_structure(
+        mdpi_dir: Path,
+        out_dir: Path,
+        index: Optional[TreeIndex] = None,
+        strategy: str = "changed"
+    ) -> Dict[str, int]:
+        """Materialize entire MDPI template structure in output directory; returns counts per method"""
+        counts: Dict[str, int] = {}
+        if index is not None:
+            for d in index.dirs:
+                (out_dir / d).mkdir(parents=True, exist_ok=True)
+            files = [(f.path, f.rel) for f in index.files]
+        else:
+            files = [(p, p.relative_to(mdpi_dir)) for p in mdpi_dir.rglob("*") if not p.is_dir()]
+
+        for src, rel in files:
+            done = FileHandler.materialize(src, out_dir / rel, strategy)
+            counts[done] = counts.get(done, 0) + 1
+        return counts
+
+
+@dataclass
+class BibEntryRef:
+    """Location of one .bib entry; the entry text itself is not kept in memory"""
+    source: int
+    offset: int
+    length: int
+    kind: str
+    key: str
+
+
+class BibReader:
+    """Streaming, brace-balanced reader of .bib files"""
+
+    CHUNK = 64 * 1024
+    _header = re.compile(rb"@[ \t\r\n]*([A-Za-z]+)[ \t\r\n]*([{(])")
+    _key = re.compile(rb"[ \t\r\n]*([^ \t\r\n,{}()=\"#]+)[ \t\r\n]*,")
+    _delims = re.compile(rb"[{}()]")
+    _not_braces = bytes(b for b in range(256) if b not in b"{}")
+    # Brace-delimited entry body with up to three levels of nested groups,
+    # matched in C; deeper nesting falls back to the counting loop
+    _braced = re.compile(
+        rb"[^{}]*(?:\{[^{}]*(?:\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}[^{}]*)*\}[^{}]*)*\}"
+    )
+
+    @staticmethod
+    def iter_entries(path: Path, opener: Optional[Callable[[Path], BinaryIO]] = None) -> Iterator[Tuple[int, bytes]]:
+        """
+        Yield (byte_offset, raw_bytes) for every @entry in path (opened with
+        opener when given). Only the entry being read and one chunk are held
+        in memory at a time.
+        """
+        with (opener(path) if opener is not None else path.open("rb")) as fh:
+            buf = b""
+            base = 0  # file offset of buf[0]
+            pos = 0
+            eof = False
+
+            def refill(keep_from: int) -> bool:
+                nonlocal buf, base, pos, eof
+                chunk = fh.read(BibReader.CHUNK)
+                if not chunk:
+                    eof = True
+                    return False
+                base += keep_from
+                pos -= keep_from
+                buf = buf[keep_from:] + chunk
+                return True
+
+            refill(0)
+            while True:
+                at = buf.find(b"@", pos)
+                if at == -1:
+                    if not refill(len(buf)):
+                        return
+                    pos = 0
+                    continue
+
+                pos = at
+                m = BibReader._header.match(buf, at)
+                if m is None:
+                    # Header may be split across chunks
+                    if len(buf) - at < 256 and not eof and refill(at):
+                        continue
+                    pos = at + 1
+                    continue
+
+                end = BibReader._entry_end(buf, m.end(), m.group(2))
+                if end == -1:
+                    if refill(at):
+                        continue
+                    # Unterminated entry at end of file: hand it out as is
+                    end = len(buf)
+                yield base + at, buf[at:end]
+                pos = end
+
+    @staticmethod
+    def _entry_end(buf: bytes, pos: int, opener: bytes) -> int:
+        """Index just past the delimiter closing an entry body that starts at pos, or -1"""
+        if opener == b"{":
+            # Common layout: the entry's last "}" is followed only by blank
+            # space up to the next line starting with "@". It closes the entry
+            # if the braces before it nest properly, which is checked on the
+            # braces alone with C-level bytes operations.
+            nxt = buf.find(b"@", pos)
+            while nxt != -1 and buf[nxt - 1:nxt] != b"\n":
+                nxt = buf.find(b"@", nxt + 1)
+            if nxt != -1:
+                close = buf.rfind(b"}", pos, nxt)
+                if close != -1 and not buf[close + 1:nxt].strip():
+                    braces = buf[pos:close].translate(None, BibReader._not_braces)
+                    for _ in range(8):  # nesting depth; deeper falls through
+                        if b"{}" not in braces:
+                            break
+                        braces = braces.replace(b"{}", b"")
+                    if not braces:
+                        return close + 1
+            m = BibReader._braced.match(buf, pos)
+            if m is not None:
+                return m.end()
+        depth = 0
+        for m in BibReader._delims.finditer(buf, pos):
+            c = m.group()
+            if c == b"{":
+                depth += 1
+            elif c == b"}":
+                if depth == 0:
+                    return m.end() if opener == b"{" else -1
+                depth -= 1
+            elif c == b")" and depth == 0 and opener == b"(":
+                return m.end()
+        return -1
+
+
+class BibIndex:
+    """Key index over one or more .bib files, built with BibReader"""
+
+    _crossref = re.compile(r"\bcrossref\s*=\s*[{\"]\s*([^}\"\s]+)", re.IGNORECASE)
+    # Bare identifiers used as field values: @string macro references
+    _macro_use = re.compile(r"[=#]\s*([A-Za-z_][\w\-:.+/']*)\s*(?=[,#})]|$)")
+
+    def __init__(self, files: List[Path], index: Optional[TreeIndex] = None):
+        self.files = files
+        self.index = index
+        self.refs: List[BibEntryRef] = []
+        self.entries: Dict[str, BibEntryRef] = {}
+        self.strings: Dict[str, BibEntryRef] = {}
+        self.warnings: List[str] = []
+        self.total = 0  # entries kept, preamble and @string included
+        self._keys: Set[str] = set()
+        self._macros: Set[str] = set()
+        self._lower: Dict[str, str] = {}
+
+    @classmethod
+    def build(cls, files: List[Path], index: Optional[TreeIndex] = None) -> "BibIndex":
+        """
+        Stream every file once and index entries, @string macros and @preamble
+        blocks. Files are read through index when given (see TreeIndex.open).
+        """
+        bib = cls(files, index)
+        for source, path in enumerate(files):
+            for offset, raw in BibReader.iter_entries(path, bib._open):
+                bib._add(source, offset, raw)
+        return bib
+
+    def _open(self, path: Path) -> BinaryIO:
+        if self.index is not None:
+            return self.index.open(path, seekable=True)
+        return path.open("rb")
+
+    @classmethod
+    def stream_all(
+        cls,
+        files: List[Path],
+        write: Callable[[str], None],
+        index: Optional[TreeIndex] = None
+    ) -> "BibIndex":
+        """
+        The unpruned merge: pass every kept entry to write as it is read, in
+        the format of write_to(). Only keys are recorded (for missing()), no
+        entry locations, so nothing can be selected or read back afterwards.
+        """
+        bib = cls(files, index)
+        for source, path in enumerate(files):
+            for _, raw in BibReader.iter_entries(path, bib._open):
+                if bib._name(source, raw) is not None:
+                    write(("\n\n" if bib.total else "") + raw.decode("utf-8", errors="ignore").strip() + "\n")
+                    bib.total += 1
+        return bib
+
+    def _add(self, source: int, offset: int, raw: bytes) -> None:
+        name = self._name(source, raw)
+        if name is None:
+            return
+        kind, key = name
+        ref = BibEntryRef(source, offset, len(raw), kind, key)
+        if kind == "string":
+            self.strings[key] = ref
+        elif kind != "preamble":
+            self.entries[key] = ref
+        self.refs.append(ref)
+        self.total += 1
+
+    def _name(self, source: int, raw: bytes) -> Optional[Tuple[str, str]]:
+        """
+        (kind, key) of an entry to keep, key being the lowercased macro name
+        for @string and "" for @preamble. None for comments, duplicates and
+        entries that do not parse.
+        """
+        header = BibReader._header.match(raw)
+        kind = header.group(1).decode("ascii").lower()
+        if kind == "comment":
+            return None
+
+        if kind == "preamble":
+            return kind, ""
+
+        if kind == "string":
+            macro = raw[header.end():].split(b"=", 1)[0].strip().decode("utf-8", errors="ignore").lower()
+            if not macro:
+                self.warnings.append(f"bib @string 解析失败（跳过）：{self.files[source].name}")
+                return None
+            if macro in self._macros:
+                return None
+            self._macros.add(macro)
+            return kind, macro
+
+        m = BibReader._key.match(raw, header.end())
+        if m is None:
+            self.warnings.append(f"bib 条目 key 解析失败（跳过）：{self.files[source].name}")
+            return None
+        key = m.group(1).decode("utf-8", errors="ignore")
+        if key in self._keys:
+            self.warnings.append(f"bib key 重复跳过：{key}（来源 {self.files[source].name}）")
+            return None
+        self._keys.add(key)
+        self._lower.setdefault(key.lower(), key)
+        return kind, key
+
+    def lookup(self, key: str) -> Optional[BibEntryRef]:
+        """Entry for key; BibTeX matches keys case-insensitively"""
+        ref = self.entries.get(key)
+        if ref is None and key.lower() in self._lower:
+            ref = self.entries[self._lower[key.lower()]]
+        return ref
+
+    def all_refs(self) -> List[BibEntryRef]:
+        return list(self.refs)
+
+    def missing(self, cited: List[str]) -> List[str]:
+        """Cited keys with no entry"""
+        return [k for k in cited if k != "*" and k.lower() not in self._lower]
+
+    def select(self, cited: List[str]) -> List[BibEntryRef]:
+        """
+        Entries for the cited keys plus everything they depend on (crossref
+        targets, @string macros) and all @preamble blocks, in file order.
+        Dependencies are read from the selected entries only. \\nocite{*}
+        selects everything.
+        """
+        if "*" in cited:
+            return self.all_refs()
+
+        chosen: Dict[int, BibEntryRef] = {}
+        queue = [ref for ref in (self.lookup(k) for k in cited) if ref is not None]
+        handles: Dict[int, Any] = {}
+        try:
+            while queue:
+                ref = queue.pop()
+                if id(ref) in chosen:
+                    continue
+                chosen[id(ref)] = ref
+                text = self._read(ref, handles)
+                if ref.kind == "string":
+                    text = "=" + text.split("=", 1)[-1]
+                elif "crossref" in text.lower():
+                    m = self._crossref.search(text)
+                    target = self.lookup(m.group(1)) if m else None
+                    if target is not None:
+                        queue.append(target)
+                if self.strings:
+                    for m in self._macro_use.finditer(text):
+                        target = self.strings.get(m.group(1).lower())
+                        if target is not None:
+                            queue.append(target)
+        finally:
+            for fh in handles.values():
+                fh.close()
+
+        return [r for r in self.refs if id(r) in chosen or r.kind == "preamble"]
+
+    def _read(self, ref: BibEntryRef, handles: Dict[int, Any]) -> str:
+        fh = handles.get(ref.source)
+        if fh is None:
+            fh = handles[ref.source] = self._open(self.files[ref.source])
+        fh.seek(ref.offset)
+        return fh.read(ref.length).decode("utf-8", errors="ignore")
+
+    def write(self, refs: List[BibEntryRef], out_bib: Path) -> None:
+        """Stream the selected entries into out_bib; an unchanged file is left untouched"""
+        out_bib.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out_bib.with_name(out_bib.name + ".tmp")
+        with tmp.open("w", encoding="utf-8", newline="") as out:
+            self.write_to(refs, out)
+        FileHandler.replace_if_changed(tmp, out_bib)
+
+    def write_to(self, refs: List[BibEntryRef], out: IO[str]) -> None:
+        """Stream the selected entries into a text stream"""
+        handles: Dict[int, Any] = {}
+        try:
+            for i, ref in enumerate(refs):
+                out.write(("\n\n" if i else "") + self._read(ref, handles).strip() + "\n")
+        finally:
+            for fh in handles.values():
+                fh.close()
+
+
+@dataclass
+class FigureJob:
+    """One raster figure for _optimize_figure (picklable for worker processes)"""
+    name: str
+    source: str
+    specs: List[List[Any]]
+    dpi: int
+    max_px: int
+    cache_file: str
+    meta_file: str
+
+
+def _optimize_figure(job: FigureJob) -> Dict[str, Any]:
+    """
+    Downscale and/or losslessly recompress one figure into the cache; runs in
+    a worker process. Returns the result record also stored as cache metadata.
+    """
+    start = time.perf_counter()
+    src = Path(job.source)
+    bytes_in = src.stat().st_size
+    result: Dict[str, Any] = {"bytes_in": bytes_in, "bytes_out": bytes_in, "action": "保留原图", "optimized": False}
+    tmp = Path(job.cache_file + ".tmp")
+    try:
+        with Image.open(src) as img:
+            img.load()
+            fmt = img.format
+            w, h = img.size
+            dpi = img.info.get("dpi") or (72, 72)
+            dpi_x, dpi_y = (float(dpi[0]) or 72.0, float(dpi[1]) or 72.0)
+
+            display = max(FigureOptimizer.display_width(spec, w / dpi_x, w, h) for spec in job.specs)
+            target = w
+            if math.isfinite(display):
+                target = min(target, math.ceil(display * job.dpi))
+            if job.max_px and max(w, h) > job.max_px:
+                target = min(target, max(1, int(w * job.max_px / max(w, h))))
+
+            out = img
+            # Ignore reductions below 5%: not worth a resampling pass
+            resized = target < w * 0.95
+            if resized:
+                out = img.resize((target, max(1, round(h * target / w))), Image.LANCZOS)
+
+            options: Dict[str, Any] = {"optimize": True}
+            if resized or "dpi" in img.info:
+                # Scale the DPI header so LaTeX's natural size of the figure is unchanged
+                scale = out.width / w
+                options["dpi"] = (dpi_x * scale, dpi_y * scale)
+            if fmt == "JPEG":
+                if resized:
+                    options["quality"] = 90
+                else:
+                    options["quality"] = "keep"
+            tmp.parent.mkdir(parents=True, exist_ok=True)
+            out.save(tmp, format=fmt, **options)
+
+        bytes_out = tmp.stat().st_size
+        if bytes_out < bytes_in:
+            os.replace(tmp, job.cache_file)
+            result.update(
+                bytes_out=bytes_out,
+                optimized=True,
+                action=f"缩放 {w}px → {target}px" if resized else "无损重压缩",
+            )
+        else:
+            tmp.unlink()
+            result["action"] = "已是最优，保留原图"
+    except Exception as e:
+        if tmp.exists():
+            tmp.unlink()
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["seconds"] = time.perf_counter() - start
+    if "error" not in result:
+        Path(job.meta_file).write_text(json.dumps(result), encoding="utf-8")
+    return result
+
+
+def default_cache_dir(subdir: str) -> Path:
+    """$XDG_CACHE_HOME/ama_to_mdpi/<subdir> (~/.cache when XDG_CACHE_HOME is unset)"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(base) / "ama_to_mdpi" / subdir
+
+
+class FigureOptimizer:
+    """
+    Optional raster figure stage: downscale PNG/JPEG figures to the DPI they
+    are displayed at, or just recompress them losslessly. Results live in a
+    content-addressed on-disk cache keyed by source hash and settings, so an
+    unchanged figure is never processed twice.
+    """
+
+    _option = re.compile(r"\b(width|height|scale)\s*=\s*([^,\]]+)")
+    _length = re.compile(r"(-?[\d.]*)\s*(\\[A-Za-z]+|cm|mm|in|pt|bp)")
+    _units = {
+        "cm": 1 / 2.54, "mm": 1 / 25.4, "in": 1.0, "pt": 1 / 72.27, "bp": 1 / 72.0,
+        "\\textwidth": MDPI_TEXTWIDTH_CM / 2.54,
+        "\\linewidth": MDPI_TEXTWIDTH_CM / 2.54,
+        "\\columnwidth": MDPI_TEXTWIDTH_CM / 2.54,
+        "\\hsize": MDPI_TEXTWIDTH_CM / 2.54,
+        "\\fulllength": MDPI_FULLLENGTH_CM / 2.54,
+        "\\textheight": MDPI_TEXTHEIGHT_CM / 2.54,
+    }
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        dpi: int = FIGURE_DPI,
+        max_px: int = 0,
+        workers: Optional[int] = None
+    ):
+        self.cache_dir = cache_dir or default_cache_dir("figures")
+        self.dpi = dpi
+        self.max_px = max_px
+        self.workers = workers or os.cpu_count() or 1
+
+    @staticmethod
+    def available() -> bool:
+        return Image is not None
+
+    @staticmethod
+    def _inches(value: str) -> Optional[float]:
+        m = FigureOptimizer._length.fullmatch(value.strip())
+        if not m or m.group(2) not in FigureOptimizer._units:
+            return None
+        try:
+            factor = float(m.group(1)) if m.group(1) not in ("", "-") else 1.0
+        except ValueError:
+            return None
+        return factor * FigureOptimizer._units[m.group(2)]
+
+    @staticmethod
+    def display_spec(options: str) -> List[Any]:
+        """
+        How an \\includegraphics[...] sizes its figure, as a JSON-friendly
+        [kind, a, b]: width/height/fit (inches), scale, natural or unknown
+        """
+        values = {k: v for k, v in FigureOptimizer._option.findall(options)}
+        width = FigureOptimizer._inches(values["width"]) if "width" in values else None
+        height = FigureOptimizer._inches(values["height"]) if "height" in values else None
+        if "width" in values and width is None or "height" in values and height is None:
+            return ["unknown", 0, 0]
+        if width and height:
+            return ["fit", width, height] if "keepaspectratio" in options else ["width", width, 0]
+        if width:
+            return ["width", width, 0]
+        if height:
+            return ["height", height, 0]
+        if "scale" in values:
+            try:
+                return ["scale", float(values["scale"]), 0]
+            except ValueError:
+                return ["unknown", 0, 0]
+        return ["natural", 0, 0]
+
+    @staticmethod
+    def display_width(spec: List[Any], natural: float, w: int, h: int) -> float:
+        """Printed width in inches for a spec; inf when it cannot be known"""
+        kind, a, b = spec
+        if kind == "width":
+            return a
+        if kind == "height":
+            return a * w / h
+        if kind == "fit":
+            return min(a, b * w / h)
+        if kind == "scale":
+            return natural * a
+        if kind == "natural":
+            return natural
+        return math.inf
+
+    def key(self, digest: str, specs: List[List[Any]]) -> str:
+        settings = json.dumps([FIGURE_OPT_VERSION, Image.__version__ if Image else "", self.dpi, self.max_px, specs])
+        return hashlib.sha256(f"{digest}\0{settings}".encode("utf-8")).hexdigest()
+
+    def optimize(self, figures: List[Tuple[str, Path, List[List[Any]]]]) -> List[Dict[str, Any]]:
+        """
+        Optimize (name, source, display specs) figures, in parallel across
+        processes. Each result has path-independent fields plus "output", the
+        cached file to use instead of the source (None: use the source).
+        """
+        with ThreadPoolExecutor(max_workers=IMAGE_COPY_WORKERS) as pool:
+            digests = list(pool.map(lambda item: FileHandler.file_digest(item[1]), figures))
+
+        results: List[Dict[str, Any]] = []
+        pending: List[int] = []
+        jobs: List[FigureJob] = []
+        for (name, src, specs), digest in zip(figures, digests):
+            start = time.perf_counter()
+            key = self.key(digest, specs)
+            folder = self.cache_dir / key[:2]
+            job = FigureJob(
+                name=name, source=str(src), specs=specs, dpi=self.dpi, max_px=self.max_px,
+                cache_file=str(folder / (key + src.suffix.lower())), meta_file=str(folder / (key + ".json")),
+            )
+            jobs.append(job)
+            try:
+                meta = json.loads(Path(job.meta_file).read_text(encoding="utf-8"))
+                if meta["optimized"] and not Path(job.cache_file).is_file():
+                    raise FileNotFoundError(job.cache_file)
+                results.append(dict(meta, cached=True, seconds=time.perf_counter() - start))
+            except (OSError, ValueError, KeyError):
+                results.append({})
+                pending.append(len(results) - 1)
+
+        if pending:
+            todo = [jobs[i] for i in pending]
+            if self.workers > 1 and len(todo) > 1:
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(todo))) as pool:
+                    done = list(pool.map(_optimize_figure, todo))
+            else:
+                done = [_optimize_figure(job) for job in todo]
+            for i, result in zip(pending, done):
+                results[i] = dict(result, cached=False)
+
+        return [
+            dict(result, name=job.name, output=job.cache_file if result.get("optimized") else None)
+            for job, result in zip(jobs, results)
+        ]
+
+
+class LaTeXCompiler:
+    """
+    Compile out_dir/main.tex with as few engine runs as possible: BibTeX only
+    when the citation data in the .aux or the .bib files changed, and another
+    LaTeX pass only while .aux/.out/.toc keep changing or the log asks for a
+    rerun. Commands are plain argument lists, so any engine (or a fake one)
+    can be plugged in.
+    """
+
+    STATE_FILE = ".ama_to_mdpi_compile.json"
+    TRACKED_EXTS = (".aux", ".out", ".toc", ".lof", ".lot")
+    _rerun = re.compile(
+        rb"Rerun to get|Please \(?re\)?run LaTeX|Rerun LaTeX|Label\(s\) may have changed"
+    )
+    _bib_aux = re.compile(rb"^\\(?:citation|bibdata|bibstyle)\{.*$", re.MULTILINE)
+    _bibdata = re.compile(rb"^\\bibdata\{([^}]*)\}", re.MULTILINE)
+    _format_error = re.compile(rb"format file|\.fmt|Fatal format", re.IGNORECASE)
+
+    def __init__(
+        self,
+        out_dir: Path,
+        main_tex: str = "main.tex",
+        latex_cmd: str = LATEX_CMD,
+        bibtex_cmd: str = BIBTEX_CMD,
+        max_passes: int = LATEX_MAX_PASSES,
+        fmt: Optional[str] = None
+    ):
+        self.out_dir = out_dir
+        self.main_tex = main_tex
+        self.jobname = Path(main_tex).stem
+        self.latex_cmd = shlex.split(latex_cmd)
+        self.bibtex_cmd = shlex.split(bibtex_cmd)
+        self.max_passes = max_passes
+        self.fmt = fmt
+        self.steps: List[Dict[str, Any]] = []
+        self.warnings: List[str] = []
+        self.errors: List[str] = []
+
+    def _path(self, ext: str) -> Path:
+        return self.out_dir / (self.jobname + ext)
+
+    @staticmethod
+    def _hash(p: Path) -> Optional[str]:
+        try:
+            return hashlib.sha256(p.read_bytes()).hexdigest()
+        except OSError:
+            return None
+
+    def _snapshot(self) -> Dict[str, Optional[str]]:
+        return {ext: self._hash(self._path(ext)) for ext in self.TRACKED_EXTS}
+
+    def _bib_key(self) -> Optional[str]:
+        """Hash of the .aux citation data plus the .bib files it names; None without \\bibdata"""
+        try:
+            aux = self._path(".aux").read_bytes()
+        except OSError:
+            return None
+        data = self._bibdata.search(aux)
+        if not data:
+            return None
+        h = hashlib.sha256(b"\n".join(self._bib_aux.findall(aux)))
+        for name in data.group(1).decode("utf-8", errors="ignore").split(","):
+            name = name.strip()
+            bib = self.out_dir / (name if name.endswith(".bib") else name + ".bib")
+            h.update(f"\0{name}\0{self._hash(bib)}".encode("utf-8"))
+        return h.hexdigest()
+
+    def _run(self, tool: str, cmd: List[str], reason: str) -> Optional[int]:
+        start = time.perf_counter()
+        try:
+            proc = subprocess.run(
+                cmd, cwd=self.out_dir, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            self.errors.append(f"无法运行 {cmd[0]}：{e}")
+            return None
+        self.steps.append({
+            "tool": tool,
+            "seconds": time.perf_counter() - start,
+            "reason": reason,
+            "returncode": proc.returncode,
+        })
+        return proc.returncode
+
+    def _format_failed(self) -> bool:
+        """True if the last LaTeX run stopped because the format could not be loaded"""
+        try:
+            log = self._path(".log").read_bytes()
+        except OSError:
+            return True
+        # A run that got past the format prints the main file name; one that did not, does not
+        return self.main_tex.encode("utf-8") not in log or bool(self._format_error.search(log[:4096]))
+
+    def load_state(self) -> Dict[str, Any]:
+        try:
+            return json.loads((self.out_dir / self.STATE_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def compile(self) -> Optional[Path]:
+        """Run LaTeX (and BibTeX) until the auxiliary files converge; returns the PDF or None"""
+        state = self.load_state()
+        latex, bibtex = "LaTeX", "BibTeX"
+        reason = "编译"
+        passes = 0
+
+        while True:
+            before = self._snapshot()
+            # The engine name comes first; -fmt goes right after it
+            cmd = self.latex_cmd[:1] + ([f"-fmt={self.fmt}"] if self.fmt else []) + self.latex_cmd[1:]
+            code = self._run(latex, cmd + [self.main_tex], reason)
+            if code is None:
+                return None
+            passes += 1
+            if code != 0 and self.fmt and self._format_failed():
+                self.warnings.append(f"无法加载预编译格式 {self.fmt}.fmt，已改为常规编译。")
+                self.fmt = None
+                reason = "预编译格式不可用"
+                continue
+            if code != 0:
+                self.warnings.append(f"{self.latex_cmd[0]} 返回码 {code}，详见 {self.jobname}.log")
+
+            reasons: List[str] = []
+            bib_key = self._bib_key()
+            if bib_key is not None and (bib_key != state.get("bib_key") or not self._path(".bbl").is_file()):
+                bbl = self._hash(self._path(".bbl"))
+                code = self._run(bibtex, self.bibtex_cmd + [self.jobname], "引用或参考文献库已变化")
+                if code is None:
+                    return None
+                if code != 0:
+                    self.warnings.append(f"{self.bibtex_cmd[0]} 返回码 {code}，详见 {self.jobname}.blg")
+                state["bib_key"] = bib_key
+                if self._hash(self._path(".bbl")) != bbl:
+                    reasons.append(".bbl 已更新")
+
+            changed = [ext for ext, digest in self._snapshot().items() if digest != before[ext]]
+            if changed:
+                reasons.append("/".join(changed) + " 已变化")
+            try:
+                with self._path(".log").open("rb") as fh:
+                    if self._rerun.search(fh.read()):
+                        reasons.append("日志提示 Rerun")
+            except OSError:
+                pass
+
+            if not reasons:
+                break
+            if passes >= self.max_passes:
+                self.warnings.append(f"已编译 {passes} 次仍未收敛（{'，'.join(reasons)}），停止编译。")
+                break
+            reason = "，".join(reasons)
+
+        (self.out_dir / self.STATE_FILE).write_text(json.dumps(state), encoding="utf-8")
+        pdf = self._path(".pdf")
+        if not pdf.is_file():
+            self.errors.append(f"PDF 生成失败，详见 {self.jobname}.log")
+            return None
+        return pdf
+
+
+class PreambleFormat:
+    """
+    Precompiled format of the static part of the MDPI preamble (mylatexformat).
+    The converter marks the end of that part in main.tex with an \\endofdump
+    that is a no-op in normal runs. Formats are cached by the hash of the
+    template files, the preamble text and the dump command, so every
+    manuscript converted from the same template shares one format.
+    """
+
+    MARKER = "\\csname endofdump\\endcsname"
+    NAME = "mdpi_preamble"
+    # Preamble lines the converter rewrites per manuscript; the dump stops before the first
+    _injected = re.compile(r"^[ \t]*\\(?:Title|abstract)\{", re.MULTILINE)
+
+    def __init__(self, cache_dir: Optional[Path] = None, format_cmd: str = FORMAT_CMD):
+        self.cache_dir = cache_dir or default_cache_dir("formats")
+        self.format_cmd = format_cmd
+
+    @staticmethod
+    def cut_point(preamble: str) -> int:
+        """Where the static part of the preamble (text before \\begin{document}) ends"""
+        m = PreambleFormat._injected.search(preamble)
+        return m.start() if m else len(preamble)
+
+    @staticmethod
+    def mark(preamble: str) -> str:
+        """Insert the end-of-dump marker into the preamble"""
+        cut = PreambleFormat.cut_point(preamble)
+        return preamble[:cut] + PreambleFormat.MARKER + "\n" + preamble[cut:]
+
+    def prepare(self, out_dir: Path, main_tex: str, template_digest: str) -> Tuple[Optional[str], str]:
+        """
+        Make out_dir/<NAME>.fmt match the marked preamble of main_tex, dumping
+        it on a cache miss. Returns (format name or None, what happened).
+        """
+        try:
+            text = (out_dir / main_tex).read_text(encoding="utf-8")
+        except OSError as e:
+            return None, f"未使用（无法读取 {main_tex}：{e}）"
+        cut = text.find(self.MARKER)
+        begin = TeXParser._find_uncommented(text, "\\begin{document}")
+        if cut == -1 or (begin != -1 and begin < cut):
+            return None, "未使用（main.tex 中没有导言区分界标记）"
+        static = text[:cut]
+
+        key = hashlib.sha256(
+            f"{template_digest}\0{self.format_cmd}\0{static}".encode("utf-8")
+        ).hexdigest()
+        cached = self.cache_dir / key[:2] / f"{key}.fmt"
+        target = out_dir / f"{self.NAME}.fmt"
+        if cached.is_file():
+            FileHandler.materialize(cached, target, "hardlink")
+            return self.NAME, f"命中缓存（{key[:12]}）"
+
+        # Dump in out_dir, where Definitions/ and the rest of the template live
+        source = out_dir / f"{self.NAME}.tex"
+        source.write_text(static + self.MARKER + "\n\\begin{document}\n\\end{document}\n", encoding="utf-8")
+        cmd = shlex.split(self.format_cmd)
+        cmd = cmd[:1] + [f"-jobname={self.NAME}"] + cmd[1:] + [source.name]
+        try:
+            proc = subprocess.run(
+                cmd, cwd=out_dir, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        except OSError as e:
+            return None, f"未使用（无法运行 {cmd[0]}：{e}）"
+        finally:
+            source.unlink()
+        if proc.returncode != 0 or not target.is_file():
+            return None, f"未使用（生成格式失败，详见 {self.NAME}.log）"
+
+        # Publish atomically: concurrent batch jobs may dump the same key
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+        shutil.copy2(target, tmp)
+        os.replace(tmp, cached)
+        FileHandler.materialize(cached, target, "hardlink")
+        return self.NAME, f"新生成并缓存（{key[:12]}）"
+
+
+class PDFCache:
+    """Content-addressed cache of compile results (PDF, .bbl, .log, .aux), keyed by every compile input"""
+
+    ARTIFACTS = (".pdf", ".bbl", ".log", ".aux")
+    # Temporary entry directories older than this were left by a store() that
+    # died half-way and are removed by evict()
+    TMP_GRACE_SECONDS = 3600
+    META = "entry.json"
+    STATS = "stats"
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        max_mb: float = PDF_CACHE_MAX_MB,
+        max_days: float = PDF_CACHE_MAX_DAYS
+    ):
+        self.cache_dir = cache_dir or default_cache_dir("pdf")
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_days * 86400
+
+    @staticmethod
+    def key(inputs: Dict[str, Any]) -> str:
+        """Cache key of a compile input description (BuildManifest.fingerprint)"""
+        data = json.dumps([PDF_CACHE_VERSION, inputs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def _count(self, event: bytes) -> None:
+        """Append a hit (h) or miss (m) to the stats file; O_APPEND keeps concurrent writers intact"""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.cache_dir / self.STATS), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, event)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def lookup(self, key: str, out_dir: Path, jobname: str) -> Optional[Dict[str, Any]]:
+        """
+        Restore the artifacts of key into out_dir; returns the entry metadata
+        on a hit and None on a miss. Files are copied (reflink where the file
+        system supports it), not hard-linked: the next LaTeX run overwrites
+        them in place.
+        """
+        entry = self._entry(key)
+        try:
+            meta = json.loads((entry / self.META).read_text(encoding="utf-8"))
+            for ext in meta["artifacts"]:
+                FileHandler.materialize(entry / f"artifact{ext}", out_dir / (jobname + ext), "reflink")
+            os.utime(entry)
+        except (OSError, ValueError, KeyError, TypeError):
+            # No entry, or one evicted by another process while restoring
+            self._count(b"m")
+            return None
+        self._count(b"h")
+        return meta
+
+    def store(
+        self, key: str, out_dir: Path, jobname: str,
+        warnings: List[str], seconds: float, state: Dict[str, Any]
+    ) -> bool:
+        """Add the compile result in out_dir under key; False if it could not be stored"""
+        entry = self._entry(key)
+        if entry.is_dir():
+            return True
+        tmp = entry.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            tmp.mkdir(parents=True)
+            artifacts = []
+            for ext in self.ARTIFACTS:
+                src = out_dir / (jobname + ext)
+                if src.is_file():
+                    shutil.copy2(src, tmp / f"artifact{ext}")
+                    artifacts.append(ext)
+            meta = {
+                "artifacts": artifacts, "warnings": warnings, "seconds": seconds,
+                "state": state, "created": time.time(),
+            }
+            (tmp / self.META).write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+            # Publish atomically; a concurrent job that stored the same key first wins
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return entry.is_dir()
+        return True
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        """(last use, size in bytes, path) of every entry; removes stale temporary directories"""
+        entries = []
+        now = time.time()
+        for shard in self.cache_dir.iterdir() if self.cache_dir.is_dir() else ():
+            if not shard.is_dir():
+                continue
+            for entry in shard.iterdir():
+                if entry.name.endswith(".tmp"):
+                    try:
+                        if now - entry.stat().st_mtime > self.TMP_GRACE_SECONDS:
+                            shutil.rmtree(entry, ignore_errors=True)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    size = sum(f.stat().st_size for f in entry.iterdir())
+                    entries.append((entry.stat().st_mtime, size, entry))
+                except OSError:
+                    continue
+        return entries
+
+    def evict(self, keep: Optional[str] = None) -> Tuple[int, int]:
+        """
+        Remove entries unused for longer than max_days, then the least
+        recently used ones until the cache fits in max_mb, and temporary
+        directories of crashed stores. The entry of keep (the one just used)
+        is never removed. Returns (entries, bytes) left.
+        """
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda e: e[0], reverse=True)
+        total = 0
+        left = 0
+        for mtime, size, entry in entries:
+            expired = now - mtime > self.max_age or total + size > self.max_bytes
+            if expired and entry.name != keep:
+                shutil.rmtree(entry, ignore_errors=True)
+                try:
+                    entry.parent.rmdir()
+                except OSError:
+                    pass
+                continue
+            total += size
+            left += 1
+        return left, total
+
+    def stats(self) -> Tuple[int, int]:
+        """(hits, misses) recorded so far"""
+        try:
+            data = (self.cache_dir / self.STATS).read_bytes()
+        except OSError:
+            return 0, 0
+        return data.count(b"h"), data.count(b"m")
+
+
+class StageProfiler:
+    """Wall time, I/O bytes, file counts and process peak memory of each conversion stage"""
+
+    def __init__(self) -> None:
+        self.stages: List[Dict[str, Any]] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Stage start times are offsets from the profiler's creation
+        self._t0 = time.perf_counter()
+        # Bytes spent reading /proc/self/io itself, kept out of the counts
+        self._io_overhead = 0
+
+    @property
+    def _open(self) -> List[Dict[str, Any]]:
+        """Stages currently open in the calling thread, outermost first"""
+        if not hasattr(self._local, "open"):
+            self._local.open = []
+        return self._local.open
+
+    def record_into(self, records: Optional[List[Dict[str, Any]]]) -> None:
+        """Collect the calling thread's stages in records instead of self.stages (None: stop)"""
+        self._local.records = records
+
+    def io_counters(self) -> Optional[Tuple[int, int]]:
+        """(bytes read, bytes written) by this process so far, child processes excluded; None without /proc/self/io"""
+        with self._lock:
+            try:
+                with open("/proc/self/io", "rb") as f:
+                    raw = f.read()
+                fields = dict(line.split(b":", 1) for line in raw.splitlines() if b":" in line)
+                counters = int(fields[b"rchar"]) - self._io_overhead, int(fields[b"wchar"])
+            except (OSError, KeyError, ValueError):
+                return None
+            self._io_overhead += len(raw)
+        return counters
+
+    @staticmethod
+    def peak_rss() -> Optional[int]:
+        """Peak resident set size of the whole process so far in bytes (it never goes down)"""
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, Any]]:
+        """
+        Measure the enclosed block as one stage. A stage opened inside another
+        is recorded as "outer/inner" and listed right after its parent.
+        """
+        if self._open:
+            name = f"{self._open[-1]['stage']}/{name}"
+        record: Dict[str, Any] = {
+            "stage": name,
+            "status": "run",
+            "start": 0.0,
+            "seconds": 0.0,
+            "bytes_read": None,
+            "bytes_written": None,
+            "files_read": 0,
+            "files_written": 0,
+            "peak_rss": None,
+        }
+        records = getattr(self._local, "records", None)
+        (self.stages if records is None else records).append(record)
+        self._open.append(record)
+        io_start = self.io_counters()
+        start = time.perf_counter()
+        record["start"] = round(start - self._t0, 6)
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            io_end = self.io_counters()
+            if io_start and io_end:
+                record["bytes_read"] = io_end[0] - io_start[0]
+                record["bytes_written"] = io_end[1] - io_start[1]
+            record["peak_rss"] = self.peak_rss()
+            self._open.pop()
+
+    def drop_overlapping_io(self) -> None:
+        """
+        Clear the byte counts of top-level stages whose run overlapped another
+        top-level stage, and of their sub-stages, and flag them io_shared
+        """
+        top = [s for s in self.stages if "/" not in s["stage"]]
+        shared: Set[str] = set()
+        for i, a in enumerate(top):
+            for b in top[i + 1:]:
+                if a["start"] < b["start"] + b["seconds"] and b["start"] < a["start"] + a["seconds"]:
+                    shared.update((a["stage"], b["stage"]))
+        for s in self.stages:
+            if s["stage"].split("/", 1)[0] in shared and s["bytes_read"] is not None:
+                s["bytes_read"] = s["bytes_written"] = None
+                s["io_shared"] = True
+
+    def annotate(self, **values: Any) -> None:
+        """Set fields (file counts, status) of the innermost open stage"""
+        if self._open:
+            self._open[-1].update(values)
+
+
+_CONVERTER_DIGEST: Optional[str] = None
+
+
+def _converter_digest() -> str:
+    """Hash of this converter's source; a new converter version invalidates the manifest"""
+    global _CONVERTER_DIGEST
+    if _CONVERTER_DIGEST is None:
+        _CONVERTER_DIGEST = FileHandler.file_digest(Path(__file__))
+    return _CONVERTER_DIGEST
+
+
+class BuildManifest:
+    """
+    Input/output content hashes of each conversion stage, stored in out_dir.
+    A stage whose inputs and outputs still match the previous run is skipped
+    and its report entries are replayed from the manifest.
+    """
+
+    FILENAME = ".ama_to_mdpi_manifest.json"
+    VERSION = 1
+
+    def __init__(self, out_dir: Path, reuse: bool = True):
+        self.out_dir = out_dir
+        self.path = out_dir / self.FILENAME
+        self.reuse = reuse
+        self.previous: Dict[str, Any] = self._load()
+        self.stages: Dict[str, Any] = {}
+        # Absolute path -> [size, mtime, sha256]; lets unchanged files skip rehashing
+        self._hash_cache: Dict[str, List[Any]] = dict(self.previous.get("hash_cache", {}))
+        self._new_hash_cache: Dict[str, List[Any]] = {}
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return {}
+        return data
+
+    def digest(self, p: Path, entry: Optional[IndexedFile] = None) -> str:
+        """Content hash of p, reusing the previous hash when size and mtime are unchanged"""
+        st = entry.stat() if entry is not None else p.stat()
+        key = str(p)
+        cached = self._hash_cache.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            digest = cached[2]
+        else:
+            digest = FileHandler.file_digest(p)
+        self._new_hash_cache[key] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def fingerprint(self, files: Dict[str, Path], extra: Dict[str, Any], index: Optional[TreeIndex] = None) -> Dict[str, Any]:
+        """Input description of a stage: file hashes plus option values"""
+        hashes = {
+            rel: self.digest(p, index.get(p) if index is not None else None)
+            for rel, p in sorted(files.items())
+        }
+        return {"files": hashes, "options": extra}
+
+    def check(self, stage: str, inputs: Dict[str, Any]) -> Tuple[bool, str]:
+        """Return (up_to_date, reason) for a stage"""
+        if not self.reuse:
+            return False, "强制全量构建"
+        prev = self.previous.get("stages", {}).get(stage)
+        if prev is None:
+            return False, "无历史构建记录"
+        if prev.get("inputs", {}).get("options") != inputs["options"]:
+            return False, "转换参数或转换程序已变化"
+
+        old_files = prev.get("inputs", {}).get("files", {})
+        changed = sorted(
+            rel for rel in set(old_files) | set(inputs["files"])
+            if old_files.get(rel) != inputs["files"].get(rel)
+        )
+        if changed:
+            shown = "、".join(changed[:5]) + ("…" if len(changed) > 5 else "")
+            return False, f"输入已变化：{shown}"
+
+        for rel, digest in prev.get("outputs", {}).items():
+            out = self.out_dir / rel
+            if not out.is_file() or self.digest(out) != digest:
+                return False, f"输出缺失或被修改：{rel}"
+
+        return True, "输入与输出均未变化"
+
+    def report_of(self, stage: str) -> Dict[str, Any]:
+        """Report entries recorded for a stage in the previous run"""
+        return self.previous.get("stages", {}).get(stage, {}).get("report", {})
+
+    def carry_over(self, stage: str) -> None:
+        """Keep the previous record of a skipped stage"""
+        self.stages[stage] = self.previous["stages"][stage]
+
+    def record(self, stage: str, inputs: Dict[str, Any], outputs: List[Path], report: Dict[str, Any]) -> None:
+        """Record inputs, output hashes and report entries of an executed stage"""
+        self.stages[stage] = {
+            "inputs": inputs,
+            "outputs": {
+                out.relative_to(self.out_dir).as_posix(): self.digest(out)
+                for out in outputs if out.is_file()
+            },
+            "report": report,
+        }
+
+    def save(self) -> None:
+        data = {
+            "version": self.VERSION,
+            "stages": self.stages,
+            "hash_cache": self._new_hash_cache,
+        }
+        # Sorted: stages may finish in any order
+        self.path.write_text(json.dumps(data, ensure_ascii=False, indent=1, sort_keys=True), encoding="utf-8")
+
+
+@dataclass
+class ManuscriptIR:
+    """
+    Template-independent result of parsing a manuscript once
+    (AMAToMDPIConverter.parse): title, abstract, processed body, the figure
+    plan and the merged bib subset, with the report fields and warnings each
+    part produced. A converter given an IR renders it into its template
+    without reading the source again (only figures are still copied).
+    """
+    source_main_tex: str
+    title: Optional[str]
+    abstract: Optional[str]
+    body: str
+    include_outputs: Dict[str, str]
+    main_fields: Dict[str, Any]
+    main_warnings: List[str]
+    bib_text: Optional[str]
+    bib_fields: Dict[str, Any]
+    bib_warnings: List[str]
+    # Converter options the body and bib were processed with
+    options: Dict[str, Any]
+
+    # Options that shape the IR; a converter rendering it must use the same
+    OPTIONS = ("figures_dir", "bib_name", "image_mode", "include_mode", "prune_bib")
+
+    def digest(self) -> str:
+        """Content hash, the input fingerprint of the stages rendered from it"""
+        data = json.dumps(asdict(self), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class AMAToMDPIConverter:
+    """Main converter class orchestrating the conversion process"""
+
+    # Report fields produced by the main (body) and bib stages
+    MAIN_FIELDS = (
+        "extracted_body_lines", "included_files", "cited_keys", "image_sources",
+        "missing_images", "renamed_images", "duplicate_images", "figure_specs",
+    )
+    BIB_FIELDS = ("merged_bib", "missing_cite_keys", "bib_entries_total", "bib_entries_written")
+
+    # Template preamble commands filled in per manuscript, found in one scan:
+    # the first \documentclass option (the MDPI journal), \Title and \abstract
+    _preamble_edits = re.compile(
+        r"(?P<journal>^\\documentclass\[)[^,\]]*|\\(?P<command>Title|abstract)\{[^}]*\}", re.MULTILINE
+    )
+    _template_begin = re.compile(r"^\\begin\{document\}", re.MULTILINE)
+    _template_end = re.compile(r"^\\end\{document\}", re.MULTILINE)
+
+    def __init__(
+        self,
+        source_dir: Path,
+        mdpi_template_dir: Path,
+        out_dir: Path,
+        out_main_tex: str = "main.tex",
+        figures_dir: str = "figures",
+        bib_name: str = "refs.bib",
+        incremental: bool = True,
+        template_strategy: str = "changed",
+        prune_bib: bool = False,
+        image_mode: str = "referenced",
+        optimize_figures: bool = False,
+        figure_dpi: int = FIGURE_DPI,
+        figure_max_px: int = 0,
+        figure_cache: Optional[Path] = None,
+        figure_workers: Optional[int] = None,
+        compile_pdf: bool = False,
+        latex_cmd: str = LATEX_CMD,
+        bibtex_cmd: str = BIBTEX_CMD,
+        max_passes: int = LATEX_MAX_PASSES,
+        precompile_preamble: bool = False,
+        format_cache: Optional[Path] = None,
+        format_cmd: str = FORMAT_CMD,
+        cache_pdf: bool = False,
+        pdf_cache: Optional[Path] = None,
+        pdf_cache_max_mb: float = PDF_CACHE_MAX_MB,
+        pdf_cache_max_days: float = PDF_CACHE_MAX_DAYS,
+        include_mode: str = "single",
+        source_fs: Optional[VirtualFS] = None,
+        out_fs: Optional[VirtualFS] = None,
+        template_fs: Optional[VirtualFS] = None,
+        stage_workers: int = STAGE_WORKERS,
+        journal: Optional[str] = None,
+        ir: Optional[ManuscriptIR] = None,
+        assets_from: Optional[Path] = None
+    ):
+        # source_fs / out_fs / template_fs replace the source, output and
+        # template directories (see convert_archive and WarmTemplate);
+        # source_dir / out_dir / mdpi_dir are then their roots
+        self.source_fs = source_fs or DirFS(source_dir.resolve())
+        self.out_fs = out_fs or DirFS(out_dir.resolve())
+        self.template_fs = template_fs or DirFS(mdpi_template_dir.resolve())
+        self.source_dir = self.source_fs.root
+        self.mdpi_dir = self.template_fs.root
+        self.out_dir = self.out_fs.root
+        self.out_main_tex = out_main_tex
+        self.figures_dir = figures_dir
+        self.bib_name = bib_name
+        self.incremental = incremental
+        self.template_strategy = template_strategy
+        self.prune_bib = prune_bib
+        self.image_mode = image_mode
+        self.optimize_figures = optimize_figures
+        self.figure_dpi = figure_dpi
+        self.figure_max_px = figure_max_px
+        self.figure_cache = figure_cache
+        self.figure_workers = figure_workers
+        self.compile_pdf = compile_pdf
+        self.latex_cmd = latex_cmd
+        self.bibtex_cmd = bibtex_cmd
+        self.max_passes = max_passes
+        self.precompile_preamble = precompile_preamble
+        self.format_cache = format_cache
+        self.format_cmd = format_cmd
+        self.cache_pdf = cache_pdf
+        self.pdf_cache = pdf_cache
+        self.pdf_cache_max_mb = pdf_cache_max_mb
+        self.pdf_cache_max_days = pdf_cache_max_days
+        self.include_mode = include_mode
+        self.stage_workers = stage_workers
+        if journal is not None and not re.fullmatch(r"[A-Za-z0-9]+", journal):
+            raise ValueError(f"invalid journal name: {journal!r}")
+        self.journal = journal
+        # Parse result to render instead of processing the source, and an
+        # output directory rendered from the same IR whose figures and bib
+        # are hard-linked instead of copied again
+        self.ir = ir
+        if ir is not None:
+            mismatch = [k for k in ManuscriptIR.OPTIONS if ir.options.get(k) != getattr(self, k)]
+            if mismatch:
+                raise ValueError(f"ManuscriptIR was parsed with different options: {', '.join(mismatch)}")
+        self.assets_from = assets_from.resolve() if assets_from is not None else None
+        self._template_digest: Optional[str] = None
+        # Hashes of the files the compile reads (see compile_inputs), for the PDF cache
+        self._pdf_inputs: Optional[Dict[str, Any]] = None
+        # Stage name -> whether it was executed (False: skipped as up to date)
+        self.stage_runs: Dict[str, bool] = {}
+        self.profiler = StageProfiler()
+        # Per-thread StageReport of the stage running in that thread (see _run_stages)
+        self._stage_local = threading.local()
+
+        self.report = ConversionReport(
+            source_main_tex=None,
+            mdpi_template_main_tex=None,
+            extracted_body_lines=0,
+            copied_images=[],
+            merged_bib=None,
+            warnings=[],
+            errors=[],
+            stages=self.profiler.stages,
+            journal=journal,
+            shared_assets_from=str(self.assets_from) if self.assets_from else None,
+        )
+
+        # Extracted metadata from source
+        self.title: Optional[str] = None
+        self.abstract: Optional[str] = None
+
+        # Single-pass tree indexes, built on first use
+        self._source_index: Optional[TreeIndex] = None
+        self._mdpi_index: Optional[TreeIndex] = None
+
+        # \input/\include graph of the source main file, and the rewritten
+        # included files of per-file output (path relative to main -> text)
+        self._includes: Optional[IncludeResolver] = None
+        self.include_outputs: Dict[str, str] = {}
+
+    @property
+    def report(self) -> ConversionReport:
+        """The conversion report; inside a concurrently running stage, that stage's StageReport"""
+        view = getattr(self._stage_local, "report", None)
+        return self._report if view is None else view
+
+    @report.setter
+    def report(self, report: ConversionReport) -> None:
+        self._report = report
+
+    @property
+    def source_index(self) -> TreeIndex:
+        """Index of source_dir, shared by every stage"""
+        if self._source_index is None:
+            self._source_index = self.source_fs.index()
+        return self._source_index
+
+    @property
+    def mdpi_index(self) -> TreeIndex:
+        """Index of mdpi_template_dir, shared by every stage"""
+        if self._mdpi_index is None:
+            self._mdpi_index = self.template_fs.index()
+        return self._mdpi_index
+
+    def validate_inputs(self) -> bool:
+        """Validate input directories exist"""
+        if self.source_fs.local and not self.source_dir.exists():
+            self.report.errors.append(f"source_dir 不存在：{self.source_dir}")
+        if self.template_fs.local and not self.mdpi_dir.exists():
+            self.report.errors.append(f"mdpi_template_dir 不存在：{self.mdpi_dir}")
+
+        return len(self.report.errors) == 0
+
+    def find_source_main(self) -> Tuple[Optional[Path], int]:
+        """Find the source main TeX file; returns it with the number of .tex files scanned"""
+        if self.ir is not None:
+            src_main = self.source_dir / self.ir.source_main_tex
+            scanned = 0
+        else:
+            tex_source_files = TeXParser.collect_tex_files(self.source_dir, self.source_index)
+            src_main = TeXParser.find_main_tex(tex_source_files, self.source_index)
+            scanned = len(tex_source_files)
+
+        if not src_main:
+            self.report.errors.append("未找到 AMA 主 tex（缺少 \\documentclass 或 \\begin{document}）。")
+        else:
+            self.report.source_main_tex = str(src_main.relative_to(self.source_dir))
+        return src_main, scanned
+
+    def find_main_files(self) -> Tuple[Optional[Path], Optional[Path]]:
+        """Find main TeX files in both source and template"""
+        src_main, scanned = self.find_source_main()
+        tex_mdpi_files = TeXParser.collect_tex_files(self.mdpi_dir, self.mdpi_index)
+        mdpi_main = TeXParser.find_main_tex(tex_mdpi_files, self.mdpi_index)
+        self.profiler.annotate(files_read=scanned + len(tex_mdpi_files))
+
+        if not mdpi_main:
+            self.report.errors.append("未找到 MDPI 模板主 tex（缺少 \\documentclass 或 \\begin{document}）。")
+        else:
+            self.report.mdpi_template_main_tex = str(mdpi_main.relative_to(self.mdpi_dir))
+
+        return src_main, mdpi_main
+
+    def load_includes(self, src_main: Path) -> IncludeResolver:
+        """Read the source main file and every file it includes (once per run)"""
+        if self._includes is None or self._includes.main != src_main:
+            self._includes = IncludeResolver(src_main, self.source_index).load()
+            self.report.included_files = [
+                os.path.relpath(p, self.source_dir) for p in self._includes.included
+            ]
+        return self._includes
+
+    def extract_and_process_body(self, src_main: Path) -> str:
+        """Extract and process AMA document body (with its \\input/\\include files)"""
+        includes = self.load_includes(src_main)
+        src_text = includes.expand()
+        # Body located by offsets and sliced only once abstract-free (large manuscripts)
+        start, end = TeXParser.document_bounds(src_text)
+        self.report.warnings.extend(includes.warnings)
+
+        if start == end:
+            self.report.errors.append("AMA 主文件无法抽取正文块（找不到 begin/end document）。")
+            return ""
+
+        # Per-file output keeps the includes in main.tex; figures are still
+        # planned from the flattened body so every file's graphics are covered
+        per_file = self.include_mode == "per_file" and bool(includes.included)
+        text = src_text
+        full_body = None
+        if per_file:
+            full_body = src_text[start:end]
+            text = includes.expand(keep=includes.keep_ref)
+            start, end = TeXParser.document_bounds(text)
+
+        # Extract title from preamble
+        self.title = TeXParser.extract_title(src_text)
+        if not self.title:
+            self.report.warnings.append("未找到 \\title{} 命令，MDPI 标题将使用默认值。")
+
+        # Extract abstract from body
+        self.abstract, body = TeXParser.extract_abstract(text, start, end)
+        text = None
+        if self.abstract:
+            self.report.warnings.append("已从正文中提取 abstract 并注入到 MDPI 模板的 \\abstract{} 命令。")
+        else:
+            self.report.warnings.append("未找到 abstract section，MDPI abstract 将使用默认值。")
+
+        plan = self.plan_images(src_main, src_text, full_body if per_file else body)
+        full_body = None
+
+        # Citations, biblatex commands, AMA artifacts and graphics paths in one pass
+        rewritten = ContentProcessor.rewrite_body(body, figures_dir=self.figures_dir, graphics_map=plan.paths)
+        body = rewritten.body
+        self.report.warnings.extend(rewritten.warnings)
+        # The abstract moves to \abstract{} but its citations still need bib entries
+        cited = ContentProcessor.collect_cite_keys(self.abstract) if self.abstract else []
+        cited += [k for k in ContentProcessor.collect_cite_keys(body) if k not in cited]
+        lines = TeXParser.count_lines(body)
+
+        # Every separately written file gets the same rewrites
+        self.include_outputs = {}
+        if per_file:
+            for path, text in includes.per_file_texts().items():
+                part = ContentProcessor.rewrite_body(text, figures_dir=self.figures_dir, graphics_map=plan.paths)
+                self.include_outputs[includes.rel_name(path)] = part.body
+                self.report.warnings.extend(w for w in part.warnings if w not in self.report.warnings)
+                cited += [k for k in ContentProcessor.collect_cite_keys(part.body) if k not in cited]
+                lines += TeXParser.count_lines(part.body)
+        self.report.cited_keys = cited
+        self.report.extracted_body_lines = lines
+
+        return body
+
+    def plan_images(self, src_main: Path, src_text: str, body: str) -> ImagePlan:
+        """Resolve \\includegraphics targets against the source tree and name their copies"""
+        graphics = ContentProcessor.collect_graphics_options(body)
+        main_dir = src_main.parent.relative_to(self.source_dir).as_posix()
+        main_dir = "" if main_dir == "." else main_dir
+        search_dirs = [main_dir] + [
+            posixpath.normpath(posixpath.join(main_dir, d))
+            for d in TeXParser.extract_graphicspath(src_text)
+        ]
+        plan = FileHandler.plan_images(
+            [target for target, _ in graphics],
+            self.source_index,
+            self.figures_dir,
+            search_dirs,
+            include_unreferenced=self.image_mode == "all",
+        )
+        self.report.image_sources = plan.sources
+        self.report.missing_images = plan.missing
+        self.report.renamed_images = plan.renamed
+        self.report.duplicate_images = plan.duplicates
+
+        # How each figure is displayed, for the optional figure optimization stage
+        specs: Dict[str, List[List[Any]]] = {}
+        for target, options in graphics:
+            name = plan.targets.get(target)
+            if name is not None:
+                spec = FigureOptimizer.display_spec(options)
+                if spec not in specs.setdefault(name, []):
+                    specs[name].append(spec)
+        for name in plan.sources:
+            # Copied without a reference (--image_mode all): keep the natural size
+            specs.setdefault(name, [["natural", 0, 0]])
+        self.report.figure_specs = specs
+        if plan.missing:
+            self.report.warnings.append(
+                f"{len(plan.missing)} 个 \\includegraphics 引用在源目录中找不到对应图片，路径按原文件名改写。"
+            )
+        if plan.renamed:
+            self.report.warnings.append(
+                f"{len(plan.renamed)} 张图片与其他图片同名，已重命名并同步修改正文引用。"
+            )
+        return plan
+
+    def image_tree_signature(self, manifest: BuildManifest) -> str:
+        """
+        Digest of what the image plan depends on besides the body: the image
+        names, plus the content of images that share a size with another
+        (the only candidates for deduplication). Editing a figure in place
+        therefore leaves the body alone and only re-runs the image stages.
+        """
+        images = self.source_index.entries_by_ext(IMAGE_EXTS)
+        by_size: Dict[int, int] = {}
+        for f in images:
+            by_size[f.size] = by_size.get(f.size, 0) + 1
+        h = hashlib.sha256()
+        for f in images:
+            digest = manifest.digest(f.path, f) if by_size[f.size] > 1 else ""
+            h.update(f"{f.rel}\0{digest}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def inject_body_into_template(self, mdpi_main: Path, body: str) -> str:
+        """Inject processed body into MDPI template"""
+        return "".join(self.main_segments(mdpi_main, body))
+
+    def main_segments(self, mdpi_main: Path, body: str) -> List[str]:
+        """
+        The output main TeX as consecutive pieces: the template preamble with
+        title, abstract and journal filled in, the body, the template tail.
+        Offsets found in the template are reused, never searched again, and
+        the body is not copied. Empty on errors (see report.errors).
+        """
+        # Read from the template itself rather than its copy in out_dir, so the
+        # main stage does not have to wait for the template stage
+        mdpi_template_text = self.mdpi_index.read_text(mdpi_main)
+
+        # Find \begin{document} and \end{document} at start of line (not in comments)
+        begin_match = self._template_begin.search(mdpi_template_text)
+        end_match = self._template_end.search(mdpi_template_text)
+
+        if not begin_match or not end_match:
+            self.report.errors.append("MDPI 模板主文件结构异常，无法定位 begin/end document。")
+            return []
+
+        mdpi_begin = begin_match.end()
+        mdpi_end = end_match.start()
+
+        if mdpi_end <= mdpi_begin:
+            self.report.errors.append("MDPI 模板主文件结构异常，end document 在 begin document 之前。")
+            return []
+
+        # Preamble edits as (start, end, replacement pieces); the title and
+        # abstract are inserted literally, without copying them
+        pre = mdpi_template_text[:mdpi_begin]
+        edits: List[Tuple[int, int, Tuple[str, ...]]] = []
+        if self.precompile_preamble:
+            cut = PreambleFormat.cut_point(pre)
+            edits.append((cut, cut, (PreambleFormat.MARKER + "\n",)))
+        journal_set = False
+        for m in self._preamble_edits.finditer(pre):
+            if m.group("journal"):
+                if not self.journal or journal_set:
+                    continue
+                journal_set = True
+                replacement = (m.group("journal"), self.journal)
+            elif m.group("command") == "Title":
+                if not self.title:
+                    continue
+                replacement = ("\\Title{", self.title, "}")
+            else:
+                if not self.abstract:
+                    continue
+                replacement = ("\\abstract{", self.abstract, "}")
+            edits.append((m.start(), m.end(), replacement))
+        if self.journal and not journal_set:
+            self.report.warnings.append(
+                f"模板主文件中未找到 \\documentclass[...] 选项，未能设置期刊 {self.journal}。"
+            )
+
+        segments: List[str] = []
+        pos = 0
+        for start, end, replacement in sorted(edits, key=lambda e: e[:2]):
+            segments.append(pre[pos:start])
+            segments += replacement
+            pos = end
+        segments += [pre[pos:], "\n\n", body, "\n\n"]
+
+        # Ensure bibliography command exists (check if not already in body or template)
+        # Check the entire document body section
+        if "\\bibliography{" not in body and "\\begin{thebibliography}" not in body:
+            # Insert bibliography before the last \end{document}, which is in the tail
+            end_doc_pos = mdpi_template_text.rfind("\\end{document}", mdpi_end)
+            segments += [
+                mdpi_template_text[mdpi_end:end_doc_pos],
+                "\\bibliography{refs}\n\n",
+                mdpi_template_text[end_doc_pos:],
+            ]
+            self.report.warnings.append("未检测到 bibliography 指令，已在 \\end{document} 前添加 \\bibliography{refs}。")
+        else:
+            segments.append(mdpi_template_text[mdpi_end:])
+
+        return segments
+
+    def figure_sources(self) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """Planned images split into (plain copies, raster figures for the optimization stage)"""
+        if not self.optimize_figures or self.assets_from is not None:
+            # Figures shared from another output are linked as they are there
+            return dict(self.report.image_sources), {}
+        plain: Dict[str, str] = {}
+        raster: Dict[str, str] = {}
+        for name, rel in self.report.image_sources.items():
+            (raster if posixpath.splitext(name)[1].lower() in RASTER_EXTS else plain)[name] = rel
+        return plain, raster
+
+    def process_images(self) -> None:
+        """Copy the planned images (except those handled by process_figures) from source to output"""
+        if self.assets_from is not None:
+            self.link_shared_images()
+            return
+        if not (self.source_fs.local and self.out_fs.local):
+            self.stream_images()
+            return
+        copied, warnings = FileHandler.copy_images(
+            self.source_dir,
+            self.out_dir,
+            self.figures_dir,
+            self.source_index,
+            self.figure_sources()[0]
+        )
+        self.report.copied_images = copied
+        self.report.warnings.extend(warnings)
+
+    def stream_images(self) -> None:
+        """Copy the planned images between file systems, one chunked stream at a time"""
+        for name, rel in self.figure_sources()[0].items():
+            target = f"{self.figures_dir}/{name}"
+            try:
+                self.out_fs.copy_from(self.source_index, self.source_dir.joinpath(*rel.split("/")), target)
+            except Exception as e:
+                self.report.warnings.append(f"复制图片失败：{rel} -> {target}，原因：{e}")
+                continue
+            self.report.copied_images.append(target)
+
+    def process_figures(self) -> None:
+        """Optimize raster figures through the cache and place the results in figures_dir"""
+        raster = self.figure_sources()[1]
+        optimizer = FigureOptimizer(self.figure_cache, self.figure_dpi, self.figure_max_px, self.figure_workers)
+        results = optimizer.optimize([
+            (name, self.source_dir / rel, self.report.figure_specs.get(name, [["natural", 0, 0]]))
+            for name, rel in raster.items()
+        ])
+
+        fig_dir = self.out_dir / self.figures_dir
+        records: List[Dict[str, Any]] = []
+        for (name, rel), result in zip(raster.items(), results):
+            src = Path(result["output"]) if result["output"] else self.source_dir / rel
+            dst = fig_dir / name
+            try:
+                FileHandler.copy_if_changed(src, dst)
+            except Exception as e:
+                self.report.warnings.append(f"复制图片失败：{src} -> {dst}，原因：{e}")
+                continue
+            if result.get("error"):
+                self.report.warnings.append(f"图片优化失败（已使用原图）：{name}，原因：{result['error']}")
+            records.append({
+                "path": f"{self.figures_dir}/{name}",
+                "bytes_in": result["bytes_in"],
+                "bytes_out": result["bytes_out"],
+                "seconds": result["seconds"],
+                "action": result["action"],
+                "cached": result["cached"],
+            })
+        self.report.figure_results = records
+
+    def link_shared_images(self) -> None:
+        """Hard-link the planned images from assets_from (copying where links are impossible)"""
+        shared = self.assets_from / self.figures_dir
+        copied: List[str] = []
+        for name, rel in self.report.image_sources.items():
+            src = shared / name
+            if not src.is_file():
+                # Not produced there (e.g. a failed copy): take it from the source
+                src = self.source_dir / rel
+            try:
+                FileHandler.materialize(src, self.out_dir / self.figures_dir / name, "hardlink")
+            except OSError as e:
+                self.report.warnings.append(f"复制图片失败：{src} -> {self.out_dir / self.figures_dir / name}，原因：{e}")
+                continue
+            copied.append(f"{self.figures_dir}/{name}")
+        self.report.copied_images = copied
+
+    def merge_bibliography(self, open_out: Callable[[], IO[str]]) -> Optional[IO[str]]:
+        """
+        Merge the source .bib files into the text stream open_out() returns
+        (only cited entries when prune_bib is set). The stream is opened once
+        there is an entry to write and returned for the caller to close; None
+        if nothing was written. Without pruning, entries go straight through
+        as they are read.
+        """
+        bibs = FileHandler.collect_files_by_ext(self.source_dir, BIB_EXTS, self.source_index)
+        if not bibs:
+            self.report.warnings.append("未找到任何 .bib 文件，引用可能无法编译。")
+            return None
+
+        handles: List[IO[str]] = []
+
+        def write(text: str) -> None:
+            if not handles:
+                handles.append(open_out())
+            handles[0].write(text)
+
+        try:
+            if self.prune_bib:
+                index = BibIndex.build(bibs, self.source_index)
+                refs = index.select(self.report.cited_keys)
+                if refs:
+                    handles.append(open_out())
+                    index.write_to(refs, handles[0])
+                written = len(refs)
+            else:
+                index = BibIndex.stream_all(bibs, write, self.source_index)
+                written = index.total
+        except BaseException:
+            for fh in handles:
+                fh.close()
+            raise
+
+        self.report.warnings.extend(index.warnings)
+        self.report.missing_cite_keys = index.missing(self.report.cited_keys)
+        if self.report.missing_cite_keys:
+            self.report.warnings.append(
+                f"正文引用的 bib key 未找到：{', '.join(self.report.missing_cite_keys)}"
+            )
+        self.report.bib_entries_total = index.total
+        self.report.bib_entries_written = written
+        if not handles:
+            self.report.warnings.append("bib 合并失败：未生成 refs.bib（可能源 bib 为空）。")
+            return None
+        return handles[0]
+
+    def process_bibliography(self) -> None:
+        """Merge bibliography files (only cited entries when prune_bib is set)"""
+        out_bib = self.out_dir / self.bib_name
+        if self.ir is not None:
+            self.replay(self.ir.bib_fields, self.ir.bib_warnings)
+            if self.ir.bib_text is None:
+                return
+            shared = self.assets_from / self.bib_name if self.assets_from is not None else None
+            if shared is not None and shared.is_file():
+                FileHandler.materialize(shared, out_bib, "hardlink")
+            else:
+                self.out_fs.write_text_if_changed(self.bib_name, self.ir.bib_text)
+            return
+
+        if not self.out_fs.local:
+            out = self.merge_bibliography(
+                lambda: io.TextIOWrapper(self.out_fs.create(self.bib_name), encoding="utf-8", newline="")
+            )
+            if out is not None:
+                out.close()
+                self.report.merged_bib = str(out_bib.relative_to(self.out_dir))
+            return
+
+        # Written next to out_bib first; an unchanged refs.bib is left untouched
+        tmp = out_bib.with_name(out_bib.name + ".tmp")
+
+        def open_tmp() -> IO[str]:
+            out_bib.parent.mkdir(parents=True, exist_ok=True)
+            return tmp.open("w", encoding="utf-8", newline="")
+
+        out = self.merge_bibliography(open_tmp)
+        if out is not None:
+            out.close()
+            FileHandler.replace_if_changed(tmp, out_bib)
+            self.report.merged_bib = str(out_bib.relative_to(self.out_dir))
+
+    def replay(self, fields: Dict[str, Any], warnings: List[str]) -> None:
+        """Apply report fields and warnings produced elsewhere (by the parse step)"""
+        for key, value in fields.items():
+            setattr(self.report, key, value)
+        self.report.warnings.extend(warnings)
+
+    def _run_stage(
+        self,
+        manifest: Optional[BuildManifest],
+        stage: str,
+        files: Dict[str, Path],
+        options: Dict[str, Any],
+        index: Optional[TreeIndex],
+        execute: Callable[[], Tuple[List[Path], Dict[str, Any]]]
+    ) -> None:
+        """
+        Run one stage through the build manifest. execute() returns the output
+        files it produced and the report fields (besides warnings) it set.
+        Without a manifest (virtual file systems) the stage always runs.
+        """
+        with self.profiler.stage(stage):
+            self.profiler.annotate(files_read=len(files))
+            if manifest is None:
+                outputs, _ = execute()
+                self.profiler.annotate(files_written=len(outputs))
+                self.stage_runs[stage] = True
+                return
+            inputs = manifest.fingerprint(files, dict(options, converter=_converter_digest()), index)
+            up_to_date, reason = manifest.check(stage, inputs)
+            if up_to_date:
+                previous = manifest.report_of(stage)
+                self.replay(previous.get("fields", {}), previous.get("warnings", []))
+                manifest.carry_over(stage)
+                self.report.incremental.append(f"{stage}：跳过（{reason}）")
+                self.stage_runs[stage] = False
+                self.profiler.annotate(status="skipped")
+                return
+
+            warn_start = len(self.report.warnings)
+            outputs, fields = execute()
+            self.profiler.annotate(files_written=len(outputs))
+            if self.report.errors:
+                return
+            manifest.record(stage, inputs, outputs, {
+                "fields": fields,
+                "warnings": self.report.warnings[warn_start:],
+            })
+            self.report.incremental.append(f"{stage}：已执行（{reason}）")
+            self.stage_runs[stage] = True
+
+    def _run_stages(self, stages: List[Tuple[str, Callable[[], None], Tuple[str, ...]]]) -> None:
+        """
+        Run (name, function, dependencies) stages as a dependency graph on a
+        thread pool of stage_workers threads (one if the output cannot take
+        concurrent writes). A stage starts once its dependencies finished
+        without errors and is skipped if one of them failed. Each stage
+        reports into its own StageReport and profiler record list; both are
+        merged back in the order of stages, so the report does not depend on
+        thread scheduling. An exception of a stage is re-raised at the end.
+        """
+        order = [name for name, _, _ in stages]
+        views = {name: StageReport(self._report) for name in order}
+        records: Dict[str, List[Dict[str, Any]]] = {name: [] for name in order}
+        exceptions: Dict[str, BaseException] = {}
+        done: Set[str] = set()
+        failed: Set[str] = set()
+
+        def run(name: str, fn: Callable[[], None]) -> None:
+            self._stage_local.report = views[name]
+            self.profiler.record_into(records[name])
+            try:
+                fn()
+            finally:
+                self._stage_local.report = None
+                self.profiler.record_into(None)
+
+        workers = self.stage_workers if self.out_fs.parallel_writes else 1
+        pending = list(stages)
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while pending or running:
+                ready = [stage for stage in pending if all(dep in done for dep in stage[2])]
+                for stage in ready:
+                    pending.remove(stage)
+                    name, fn, after = stage
+                    if any(dep in failed for dep in after):
+                        done.add(name)
+                        failed.add(name)
+                    else:
+                        running[pool.submit(run, name, fn)] = name
+                if not running:
+                    if ready:
+                        continue
+                    raise RuntimeError(f"stage dependencies cannot be met: {[stage[0] for stage in pending]}")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    done.add(name)
+                    if future.exception() is not None:
+                        exceptions[name] = future.exception()
+                    if name in exceptions or views[name].errors:
+                        failed.add(name)
+
+        for name in order:
+            views[name].merge()
+            self.profiler.stages.extend(records[name])
+        self.profiler.drop_overlapping_io()
+        self.stage_runs = {name: self.stage_runs[name] for name in order if name in self.stage_runs}
+        for name in order:
+            if name in exceptions:
+                raise exceptions[name]
+
+    def parse(self) -> Optional[ManuscriptIR]:
+        """
+        Parse the source once into a ManuscriptIR for rendering into any
+        number of templates (see MultiTargetConverter). Returns None when the
+        source cannot be converted; report.errors says why.
+        """
+        with self.profiler.stage("validate"):
+            valid = self.validate_inputs()
+        if not valid:
+            return None
+        with self.profiler.stage("find_main_files"):
+            src_main, _ = self.find_source_main()
+        if src_main is None:
+            return None
+        with self.profiler.stage("includes"):
+            includes = self.load_includes(src_main)
+            self.profiler.annotate(files_read=len(includes.texts))
+
+        start = len(self.report.warnings)
+        with self.profiler.stage("body"):
+            self.profiler.annotate(files_read=1)
+            body = self.extract_and_process_body(src_main)
+        if self.report.errors:
+            return None
+        main_warnings = self.report.warnings[start:]
+
+        start = len(self.report.warnings)
+        bib_text = None
+        with self.profiler.stage("bib"):
+            text = io.StringIO(newline="")
+            if self.merge_bibliography(lambda: text) is not None:
+                bib_text = text.getvalue()
+                self.report.merged_bib = self.bib_name
+        bib_warnings = self.report.warnings[start:]
+
+        return ManuscriptIR(
+            source_main_tex=self.report.source_main_tex,
+            title=self.title,
+            abstract=self.abstract,
+            body=body,
+            include_outputs=dict(self.include_outputs),
+            main_fields={key: getattr(self.report, key) for key in self.MAIN_FIELDS},
+            main_warnings=main_warnings,
+            bib_text=bib_text,
+            bib_fields={key: getattr(self.report, key) for key in self.BIB_FIELDS},
+            bib_warnings=bib_warnings,
+            options={key: getattr(self, key) for key in ManuscriptIR.OPTIONS},
+        )
+
+    def render_ir_body(self) -> str:
+        """The body step of the main stage when rendering a ManuscriptIR"""
+        self.title = self.ir.title
+        self.abstract = self.ir.abstract
+        self.include_outputs = dict(self.ir.include_outputs)
+        self.replay(self.ir.main_fields, self.ir.main_warnings)
+        return self.ir.body
+
+    def included_outputs(self, includes: Optional[IncludeResolver]) -> List[str]:
+        """Output paths of the separately written included files (per_file mode)"""
+        if includes is None:
+            return list(self.ir.include_outputs)
+        return [includes.rel_name(path) for path in includes.included]
+
+    def convert(self) -> bool:
+        """Execute the complete conversion process"""
+        # Create output directory
+        if self.out_fs.local:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+
+        # Validate inputs
+        with self.profiler.stage("validate"):
+            valid = self.validate_inputs()
+        if not valid:
+            self.save_report()
+            return False
+
+        # Find main files
+        with self.profiler.stage("find_main_files"):
+            src_main, mdpi_main = self.find_main_files()
+        if self.report.errors:
+            self.save_report()
+            return False
+
+        # Incremental builds and the disk-only stages need real directories on every end
+        local = self.source_fs.local and self.out_fs.local and self.template_fs.local
+        manifest = BuildManifest(self.out_dir, reuse=self.incremental) if local else None
+        for enabled, label in ((self.optimize_figures, "--optimize_figures"), (self.compile_pdf, "--compile")):
+            if enabled and not local:
+                self.report.warnings.append(f"{label} 仅支持目录输入/输出，压缩包或内存转换中已跳过。")
+        if not local:
+            self.optimize_figures = self.compile_pdf = False
+
+        # Resolve \input/\include/\subfile up front: included files are inputs of the main stage
+        # (a ManuscriptIR has already done it)
+        includes: Optional[IncludeResolver] = None
+        if self.ir is None:
+            with self.profiler.stage("includes"):
+                includes = self.load_includes(src_main)
+                self.profiler.annotate(files_read=len(includes.texts))
+
+        if self.optimize_figures and not FigureOptimizer.available():
+            self.report.warnings.append("未安装 Pillow，已跳过图片优化（pip install Pillow）。")
+            self.optimize_figures = False
+
+        # Copy MDPI template structure
+        def run_template() -> Tuple[List[Path], Dict[str, Any]]:
+            if not (self.out_fs.local and self.template_fs.local):
+                for f in self.mdpi_index.files:
+                    self.out_fs.copy_from(self.mdpi_index, f.path, f.rel)
+                return [self.out_dir / f.rel for f in self.mdpi_index.files], {}
+            counts = FileHandler.copy_template_structure(
+                self.mdpi_dir, self.out_dir, self.mdpi_index, self.template_strategy
+            )
+            if self.template_strategy in ("hardlink", "reflink", "symlink") and counts.get("copy"):
+                self.report.warnings.append(
+                    f"{counts['copy']} 个模板文件无法使用 {self.template_strategy}，已回退为复制。"
+                )
+            return [self.out_dir / f.rel for f in self.mdpi_index.files], {}
+
+        def template_stage() -> None:
+            self._run_stage(
+                manifest, "template",
+                {f.rel: f.path for f in self.mdpi_index.files}, {"strategy": self.template_strategy},
+                self.mdpi_index, run_template
+            )
+
+        # Extract and process body, inject it into the template and write main TeX
+        def run_main() -> Tuple[List[Path], Dict[str, Any]]:
+            if self.ir is not None:
+                body = self.render_ir_body()
+            else:
+                with self.profiler.stage("body"):
+                    self.profiler.annotate(files_read=1)
+                    body = self.extract_and_process_body(src_main)
+            if self.report.errors:
+                return [], {}
+            with self.profiler.stage("inject"):
+                self.profiler.annotate(files_read=1)
+                segments = self.main_segments(mdpi_main, body)
+            if self.report.errors:
+                return [], {}
+            out_main = self.out_dir / self.out_main_tex
+            outputs = [out_main]
+            with self.profiler.stage("write"):
+                # Streamed: template preamble, body, template tail
+                written = int(self.out_fs.write_segments_if_changed(self.out_main_tex, segments))
+                for rel, text in self.include_outputs.items():
+                    written += self.out_fs.write_text_if_changed(rel, text)
+                    outputs.append(self.out_dir / rel)
+                self.profiler.annotate(files_written=written)
+            return outputs, {key: getattr(self.report, key) for key in self.MAIN_FIELDS}
+
+        def main_stage() -> None:
+            main_files = {"template/" + self.report.mdpi_template_main_tex: mdpi_main}
+            options = {
+                "include_mode": self.include_mode,
+                "figures_dir": self.figures_dir,
+                "out_main_tex": self.out_main_tex,
+                "precompile_preamble": self.precompile_preamble,
+                "image_mode": self.image_mode,
+                "journal": self.journal,
+            }
+            if self.ir is not None:
+                # The IR stands for the source files it was parsed from
+                options["ir"] = self.ir.digest()
+            else:
+                main_files["source/" + self.report.source_main_tex] = src_main
+                for rel, path in zip(self.report.included_files, includes.included):
+                    main_files["source/" + rel] = path
+                options["images"] = self.image_tree_signature(manifest) if manifest is not None else ""
+            self._run_stage(manifest, "main", main_files, options, None, run_main)
+
+        # Process images
+        def run_images() -> Tuple[List[Path], Dict[str, Any]]:
+            self.process_images()
+            return (
+                [self.out_dir / p for p in self.report.copied_images],
+                {"copied_images": self.report.copied_images}
+            )
+
+        def images_stage() -> None:
+            plain, _ = self.figure_sources()
+            files = {rel: self.source_dir / rel for rel in plain.values()}
+            if self.assets_from is not None:
+                shared = self.assets_from / self.figures_dir
+                files = {
+                    rel: shared / name if (shared / name).is_file() else files[rel]
+                    for name, rel in plain.items()
+                }
+            self._run_stage(
+                manifest, "images",
+                files,
+                {"figures_dir": self.figures_dir, "plan": plain, "assets_from": self.report.shared_assets_from},
+                self.source_index if self.assets_from is None else None, run_images
+            )
+
+        # Optional raster figure optimization
+        def run_figures() -> Tuple[List[Path], Dict[str, Any]]:
+            self.process_figures()
+            return (
+                [self.out_dir / r["path"] for r in self.report.figure_results],
+                {"figure_results": self.report.figure_results}
+            )
+
+        def figures_stage() -> None:
+            _, raster = self.figure_sources()
+            if raster:
+                self._run_stage(
+                    manifest, "figures",
+                    {rel: self.source_dir / rel for rel in raster.values()},
+                    {
+                        "figures_dir": self.figures_dir,
+                        "plan": raster,
+                        "specs": {name: self.report.figure_specs.get(name) for name in raster},
+                        "dpi": self.figure_dpi,
+                        "max_px": self.figure_max_px,
+                    },
+                    self.source_index, run_figures
+                )
+
+        # Process bibliography
+        def run_bib() -> Tuple[List[Path], Dict[str, Any]]:
+            self.process_bibliography()
+            outputs = [self.out_dir / self.report.merged_bib] if self.report.merged_bib else []
+            return outputs, {key: getattr(self.report, key) for key in self.BIB_FIELDS}
+
+        def bib_stage() -> None:
+            options = {"bib_name": self.bib_name, "prune": self.prune_bib, "cited_keys": self.report.cited_keys}
+            if self.ir is not None:
+                options["ir"] = self.ir.digest()
+                files: Dict[str, Path] = {}
+            else:
+                files = {f.rel: f.path for f in self.source_index.entries_by_ext(BIB_EXTS)}
+            self._run_stage(manifest, "bib", files, options, self.source_index, run_bib)
+
+        # The template copy overlaps with body processing, and the image copy
+        # with the bib merge. Images and bib need the body (\includegraphics
+        # targets, cited keys); figure optimization forks worker processes,
+        # so it starts once the image copy threads are done. A stage that
+        # writes where the template has files waits for the template copy.
+        template_files = {f.rel for f in self.mdpi_index.files}
+
+        def after_template(*rels: str) -> Tuple[str, ...]:
+            clash = any(
+                rel in template_files or any(t.startswith(rel + "/") for t in template_files)
+                for rel in rels
+            )
+            return ("template",) if clash else ()
+
+        self._run_stages([
+            ("template", template_stage, ()),
+            ("main", main_stage, after_template(self.out_main_tex, *self.included_outputs(includes))),
+            ("images", images_stage, ("main",) + after_template(self.figures_dir)),
+            ("figures", figures_stage, ("main", "images") + after_template(self.figures_dir)),
+            ("bib", bib_stage, ("main",) + after_template(self.bib_name)),
+        ])
+        if self.report.errors:
+            self.save_report()
+            return False
+
+        if self.compile_pdf and self.precompile_preamble:
+            template = manifest.fingerprint({f.rel: f.path for f in self.mdpi_index.files}, {}, self.mdpi_index)
+            self._template_digest = hashlib.sha256(
+                json.dumps(template["files"], sort_keys=True).encode("utf-8")
+            ).hexdigest()
+        if self.compile_pdf and self.cache_pdf:
+            self._pdf_inputs = manifest.fingerprint(self.compile_inputs(includes), {
+                "latex_cmd": self.latex_cmd,
+                "bibtex_cmd": self.bibtex_cmd,
+                "max_passes": self.max_passes,
+                "out_main_tex": self.out_main_tex,
+            })
+
+        if manifest is not None:
+            manifest.save()
+
+        if self.compile_pdf:
+            with self.profiler.stage("compile"):
+                pdf = self.compile()
+                self.profiler.annotate(files_written=int(pdf is not None))
+
+        # Save report
+        self.save_report()
+
+        return not self.report.errors
+
+    def compile_inputs(self, includes: Optional[IncludeResolver]) -> Dict[str, Path]:
+        """Files in out_dir a compile reads: the template copy, main TeX, bib, included files and figures"""
+        rels = {f.rel for f in self.mdpi_index.files}
+        rels.update([self.out_main_tex, self.bib_name] + self.included_outputs(includes))
+        for dirpath, _, filenames in os.walk(self.out_dir / self.figures_dir):
+            base = Path(dirpath).relative_to(self.out_dir).as_posix()
+            rels.update(f"{base}/{name}" for name in filenames)
+        return {rel: self.out_dir / rel for rel in rels if (self.out_dir / rel).is_file()}
+
+    def compile(self) -> Optional[Path]:
+        """Compile the converted project to PDF, or restore it from the PDF cache"""
+        cache = None
+        if self.cache_pdf and self._pdf_inputs is not None:
+            cache = PDFCache(self.pdf_cache, self.pdf_cache_max_mb, self.pdf_cache_max_days)
+            key = PDFCache.key(self._pdf_inputs)
+            jobname = Path(self.out_main_tex).stem
+            meta = cache.lookup(key, self.out_dir, jobname)
+            if meta is not None:
+                # The restored .aux/.bbl come with the compile state that matches them
+                (self.out_dir / LaTeXCompiler.STATE_FILE).write_text(json.dumps(meta["state"]), encoding="utf-8")
+                self.report.warnings.extend(meta["warnings"])
+                self.report.pdf_cache = (
+                    f"命中（{key[:12]}），未运行 LaTeX/BibTeX（原编译 {meta['seconds']:.2f}s）"
+                    + self.pdf_cache_summary(cache, key)
+                )
+                pdf = self.out_dir / (jobname + ".pdf")
+                self.report.pdf = str(pdf.relative_to(self.out_dir))
+                return pdf
+
+        fmt = None
+        if self.precompile_preamble and self._template_digest:
+            fmt, status = PreambleFormat(self.format_cache, self.format_cmd).prepare(
+                self.out_dir, self.out_main_tex, self._template_digest
+            )
+            self.report.preamble_format = status
+        compiler = LaTeXCompiler(
+            self.out_dir, self.out_main_tex, self.latex_cmd, self.bibtex_cmd, self.max_passes, fmt
+        )
+        pdf = compiler.compile()
+        if fmt and compiler.fmt is None:
+            self.report.preamble_format += "，加载失败已回退为常规编译"
+        self.report.compile_steps = compiler.steps
+        self.report.warnings.extend(compiler.warnings)
+        self.report.errors.extend(compiler.errors)
+        self.report.pdf = str(pdf.relative_to(self.out_dir)) if pdf else None
+
+        if cache is not None:
+            if pdf is None or compiler.errors:
+                status = "编译失败，结果未缓存"
+            elif cache.store(
+                key, self.out_dir, jobname, compiler.warnings,
+                sum(step["seconds"] for step in compiler.steps), compiler.load_state()
+            ):
+                status = "编译结果已存入缓存"
+            else:
+                status = "写入缓存失败"
+            self.report.pdf_cache = f"未命中（{key[:12]}），{status}" + self.pdf_cache_summary(cache, key)
+        return pdf
+
+    @staticmethod
+    def pdf_cache_summary(cache: PDFCache, key: str) -> str:
+        """Evict old entries and describe the cache for the report"""
+        entries, size = cache.evict(keep=key)
+        hits, misses = cache.stats()
+        rate = f"，命中率 {hits / (hits + misses):.0%}" if hits + misses else ""
+        return (
+            f"；缓存 {cache.cache_dir}：{entries} 项，{size / 1024 / 1024:.1f} MB，"
+            f"累计命中 {hits} 次 / 未命中 {misses} 次{rate}"
+        )
+
+    def save_report(self) -> None:
+        """Save conversion report (markdown, plus JSON for tooling) to output directory"""
+        report_json = json.dumps(asdict(self.report), ensure_ascii=False, indent=2)
+        if not self.out_fs.local:
+            self.out_fs.write_text_if_changed("conversion_report.md", self.report.to_md())
+            self.out_fs.write_text_if_changed("conversion_report.json", report_json)
+            return
+        (self.out_dir / "conversion_report.md").write_text(
+            self.report.to_md(),
+            encoding="utf-8"
+        )
+        (self.out_dir / "conversion_report.json").write_text(report_json, encoding="utf-8")
+
+    def print_summary(self) -> None:
+        """Print conversion summary"""
+        if self.report.errors:
+            print(f"[ERROR] Conversion failed. Check report: {self.out_dir / 'conversion_report.md'}")
+            for err in self.report.errors:
+                print(f"  - {err}")
+        else:
+            print(f"[OK] Converted project generated at: {self.out_dir}")
+            print(f"[OK] Main TeX: {self.out_dir / self.out_main_tex}")
+            if self.report.pdf and not self.report.compile_steps:
+                print(f"[OK] PDF: {self.out_dir / self.report.pdf} (restored from PDF cache)")
+            elif self.report.pdf:
+                seconds = sum(step["seconds"] for step in self.report.compile_steps)
+                print(f"[OK] PDF: {self.out_dir / self.report.pdf} "
+                      f"({len(self.report.compile_steps)} runs, {seconds:.2f}s)")
+            print(f"[OK] Report: {self.out_dir / 'conversion_report.md'}")
+
+
+def convert_archive(
+    source: Union[str, Path, IO[bytes], Mapping[str, bytes]],
+    mdpi_template_dir: Union[Path, VirtualFS],
+    out: Union[str, Path, IO[bytes]],
+    compresslevel: Optional[int] = None,
+    max_unpacked: Optional[int] = ARCHIVE_MAX_UNPACKED_MB * 1024 * 1024,
+    **options: Any
+) -> ConversionReport:
+    """
+    Convert a manuscript given as a zip archive (path or binary file object),
+    a mapping of relative path -> bytes, or a directory, and write the
+    converted project as a zip archive to out (path or writable binary file
+    object), report included. Nothing is extracted to disk: sources are read
+    from the archive and figures are copied from archive to archive in
+    STREAM_CHUNK pieces. options are AMAToMDPIConverter keyword arguments;
+    incremental builds, figure optimization and compilation need directories
+    and are skipped. The template may be given as a VirtualFS (WarmTemplate);
+    compresslevel is the deflate level of the output (None: zlib default);
+    a zip source unpacking to more than max_unpacked bytes raises
+    ArchiveTooLarge (None: no limit).
+    """
+    template_fs = mdpi_template_dir if isinstance(mdpi_template_dir, VirtualFS) else None
+    if isinstance(source, Mapping):
+        source_fs: VirtualFS = MemoryFS(source)
+    elif isinstance(source, (str, Path)) and Path(source).is_dir():
+        source_fs = DirFS(Path(source).resolve())
+    else:
+        source_fs = ZipFS(source, max_unpacked=max_unpacked)
+    try:
+        with ZipFS(out, "w", compresslevel=compresslevel) as out_fs:
+            converter = AMAToMDPIConverter(
+                source_fs.root, template_fs.root if template_fs else Path(mdpi_template_dir), out_fs.root,
+                source_fs=source_fs, out_fs=out_fs, template_fs=template_fs, **options
+            )
+            converter.convert()
+    finally:
+        source_fs.close()
+    return converter.report
+
+
+@dataclass
+class RenderTarget:
+    """One output of a multi-target run: a template, optionally with a journal option"""
+    name: str
+    mdpi_template_dir: Path
+    journal: Optional[str] = None
+
+
+class MultiTargetConverter:
+    """
+    Parse a manuscript once (AMAToMDPIConverter.parse) and render the result
+    into several templates / journals, one output directory per target.
+    Figures and refs.bib are materialized for the first target only; the
+    others hard-link them from there.
+    """
+
+    def __init__(
+        self,
+        source_dir: Path,
+        targets: List[RenderTarget],
+        out_dir: Path,
+        options: Optional[Dict[str, Any]] = None
+    ):
+        self.source_dir = source_dir.resolve()
+        self.targets = targets
+        self.out_dir = out_dir.resolve()
+        self.options = options or {}
+        self.reports: Dict[str, ConversionReport] = {}
+
+    def run(self) -> bool:
+        """Parse, then render every target; a failing target never stops the others"""
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        first = self.targets[0]
+        start = time.perf_counter()
+        parser = AMAToMDPIConverter(
+            self.source_dir, first.mdpi_template_dir, self.out_dir / first.name,
+            journal=first.journal, **self.options
+        )
+        ir = parser.parse()
+        if ir is None:
+            parser.out_dir.mkdir(parents=True, exist_ok=True)
+            parser.save_report()
+            self.reports[first.name] = parser.report
+            print(f"[ERROR] Parsing failed. Check conversion_report.md in: {parser.out_dir}")
+            for err in parser.report.errors:
+                print(f"  - {err}")
+            return False
+        print(f"[OK] Parsed {ir.source_main_tex} once ({time.perf_counter() - start:.2f}s)")
+
+        shared: Optional[Path] = None
+        for target in self.targets:
+            start = time.perf_counter()
+            converter = AMAToMDPIConverter(
+                self.source_dir, target.mdpi_template_dir, self.out_dir / target.name,
+                journal=target.journal, ir=ir, assets_from=shared, **self.options
+            )
+            # Same source tree: reuse the parse step's index instead of scanning again
+            converter._source_index = parser.source_index
+            try:
+                success = converter.convert()
+            except Exception as e:
+                # Recorded in this target's report; the remaining targets still run
+                success = False
+                converter.report.errors.append(f"转换过程异常：{type(e).__name__}: {e}")
+                try:
+                    converter.out_dir.mkdir(parents=True, exist_ok=True)
+                    converter.save_report()
+                except OSError:
+                    pass
+            self.reports[target.name] = converter.report
+            status = "OK" if success else "FAILED"
+            print(f"[{status}] {target.name} ({time.perf_counter() - start:.2f}s) -> {converter.out_dir}")
+            if success and shared is None:
+                shared = converter.out_dir
+        return all(not r.errors for r in self.reports.values())
+
+
+@dataclass
+class BatchJob:
+    """One manuscript to convert as part of a batch run"""
+    name: str
+    source_dir: Path
+    out_dir: Path
+
+
+@dataclass
+class BatchJobResult:
+    """Outcome of a single batch job"""
+    name: str
+    source_dir: str
+    out_dir: str
+    success: bool
+    elapsed: float
+    warnings: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+@dataclass
+class BatchReport:
+    """Aggregate report of a batch conversion run"""
+    workers: int
+    wall_time: float
+    results: List[BatchJobResult]
+
+    @property
+    def succeeded(self) -> List[BatchJobResult]:
+        return [r for r in self.results if r.success]
+
+    @property
+    def failed(self) -> List[BatchJobResult]:
+        return [r for r in self.results if not r.success]
+
+    def to_md(self) -> str:
+        """Generate markdown summary"""
+        out: List[str] = []
+        out.append("# AMA → MDPI 批量迁移汇总\n")
+
+        total_job_time = sum(r.elapsed for r in self.results)
+        out.append("## 1) 概况")
+        out.append(f"- 稿件数量：{len(self.results)}")
+        out.append(f"- 成功：{len(self.succeeded)}")
+        out.append(f"- 失败：{len(self.failed)}")
+        out.append(f"- 并行进程数：{self.workers}")
+        out.append(f"- 总耗时（墙钟）：{self.wall_time:.2f} s")
+        out.append(f"- 单稿耗时合计：{total_job_time:.2f} s")
+
+        out.append("\n## 2) 各稿件耗时")
+        out.append("| 稿件 | 状态 | 耗时 (s) | 警告数 | 输出目录 |")
+        out.append("|---|---|---|---|---|")
+        for r in self.results:
+            status = "✅" if r.success else "❌"
+            out.append(f"| {r.name} | {status} | {r.elapsed:.2f} | {r.warnings} | {r.out_dir} |")
+
+        out.append("\n## 3) 失败详情")
+        if self.failed:
+            for r in self.failed:
+                out.append(f"- ❌ {r.name}（{r.source_dir}）")
+                for e in r.errors:
+                    out.append(f"  - {e}")
+        else:
+            out.append("- （无）")
+
+        out.append("")
+        return "\n".join(out)
+
+
+def _run_batch_job(job: BatchJob, mdpi_template_dir: Path, options: Dict[str, Any]) -> BatchJobResult:
+    """Convert one manuscript in a worker process; never raises"""
+    start = time.perf_counter()
+    if options.get("figure_workers") is None:
+        # Manuscripts already run one per core
+        options = dict(options, figure_workers=1)
+    try:
+        converter = AMAToMDPIConverter(
+            source_dir=job.source_dir,
+            mdpi_template_dir=mdpi_template_dir,
+            out_dir=job.out_dir,
+            **options
+        )
+        success = converter.convert()
+        errors = list(converter.report.errors)
+        warnings = len(converter.report.warnings)
+    except Exception as e:
+        success = False
+        errors = [f"转换过程异常：{type(e).__name__}: {e}"]
+        warnings = 0
+
+    return BatchJobResult(
+        name=job.name,
+        source_dir=str(job.source_dir),
+        out_dir=str(job.out_dir),
+        success=success,
+        elapsed=time.perf_counter() - start,
+        warnings=warnings,
+        errors=errors,
+    )
+
+
+class BatchConverter:
+    """Run one AMAToMDPIConverter per manuscript across a process pool"""
+
+    def __init__(
+        self,
+        jobs: List[BatchJob],
+        mdpi_template_dir: Path,
+        out_dir: Path,
+        workers: Optional[int] = None,
+        options: Optional[Dict[str, Any]] = None
+    ):
+        self.jobs = jobs
+        self.mdpi_dir = mdpi_template_dir.resolve()
+        self.out_dir = out_dir.resolve()
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.options = options or {}
+        self.report: Optional[BatchReport] = None
+
+    @staticmethod
+    def _unique_jobs(sources: List[Path], out_dir: Path) -> List[BatchJob]:
+        """Build jobs with one output directory per manuscript, disambiguating equal names"""
+        jobs: List[BatchJob] = []
+        used: Set[str] = set()
+        for src in sources:
+            base = src.name or "manuscript"
+            name = base
+            n = 2
+            while name in used:
+                name = f"{base}-{n}"
+                n += 1
+            used.add(name)
+            jobs.append(BatchJob(name=name, source_dir=src, out_dir=out_dir / name))
+        return jobs
+
+    @staticmethod
+    def discover_jobs(batch_root: Path, out_dir: Path) -> List[BatchJob]:
+        """Treat every direct sub-directory of batch_root that holds a .tex file as one manuscript"""
+        sources = [
+            d for d in sorted(batch_root.iterdir())
+            if d.is_dir() and TeXParser.collect_tex_files(d)
+        ]
+        return BatchConverter._unique_jobs(sources, out_dir)
+
+    @staticmethod
+    def load_manifest(manifest: Path, out_dir: Path) -> List[BatchJob]:
+        """Read a manifest with one source directory per line (relative paths are relative to the manifest)"""
+        sources: List[Path] = []
+        for line in TeXParser.read_text(manifest).splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            src = Path(line)
+            if not src.is_absolute():
+                src = manifest.parent / src
+            sources.append(src.resolve())
+        return BatchConverter._unique_jobs(sources, out_dir)
+
+    def run(self) -> BatchReport:
+        """Convert all jobs; a failing manuscript never stops the others"""
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        results: Dict[str, BatchJobResult] = {}
+
+        workers = min(self.workers, max(1, len(self.jobs)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(_run_batch_job, job, self.mdpi_dir, self.options): job
+                for job in self.jobs
+            }
+            for fut in as_completed(futures):
+                job = futures[fut]
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    # Worker process died (e.g. killed / out of memory)
+                    result = BatchJobResult(
+                        name=job.name,
+                        source_dir=str(job.source_dir),
+                        out_dir=str(job.out_dir),
+                        success=False,
+                        elapsed=0.0,
+                        errors=[f"工作进程异常退出：{type(e).__name__}: {e}"],
+                    )
+                results[job.name] = result
+                status = "OK" if result.success else "FAILED"
+                print(f"[{status}] {job.name} ({result.elapsed:.2f}s)")
+
+        self.report = BatchReport(
+            workers=workers,
+            wall_time=time.perf_counter() - start,
+            results=[results[job.name] for job in self.jobs],
+        )
+        self.save_report()
+        return self.report
+
+    def save_report(self) -> None:
+        """Save batch summary to output directory"""
+        (self.out_dir / "batch_report.md").write_text(self.report.to_md(), encoding="utf-8")
+
+    def print_summary(self) -> None:
+        """Print aggregate batch summary"""
+        r = self.report
+        print(
+            f"[BATCH] {len(r.succeeded)}/{len(r.results)} succeeded, "
+            f"{len(r.failed)} failed, wall time {r.wall_time:.2f}s, {r.workers} workers"
+        )
+        for failed in r.failed:
+            print(f"  - {failed.name}: {'; '.join(failed.errors) or 'unknown error'}")
+        print(f"[BATCH] Report: {self.out_dir / 'batch_report.md'}")
+
+
+class SourceWatcher:
+    """
+    Polls directory trees for changes with os.scandir snapshots of
+    (size, mtime). Polling works the same on every platform and file system
+    (network drives, containers) and needs no extra dependency.
+    """
+
+    # Editor swap/backup files that should not trigger a rebuild
+    IGNORED_SUFFIXES = ("~", ".swp", ".swx", ".tmp")
+
+    def __init__(
+        self,
+        roots: List[Path],
+        interval: float = 0.5,
+        debounce: float = 0.3,
+        exclude: Optional[List[Path]] = None
+    ):
+        self.roots = [r.resolve() for r in roots]
+        self.interval = interval
+        self.debounce = debounce
+        self.exclude = {str(p.resolve()) for p in exclude or []}
+        self.state = self.snapshot()
+
+    def _ignored(self, name: str) -> bool:
+        return name.startswith(".#") or name.endswith(self.IGNORED_SUFFIXES)
+
+    def snapshot(self) -> Dict[str, Tuple[int, int]]:
+        """Absolute path -> (size, mtime_ns) of every file under the roots"""
+        state: Dict[str, Tuple[int, int]] = {}
+        stack = [str(r) for r in self.roots]
+        while stack:
+            folder = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.path not in self.exclude:
+                                    stack.append(entry.path)
+                            elif entry.is_file() and not self._ignored(entry.name):
+                                st = entry.stat()
+                                state[entry.path] = (st.st_size, st.st_mtime_ns)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return state
+
+    def _diff(self, new: Dict[str, Tuple[int, int]]) -> List[str]:
+        changed = [p for p, sig in new.items() if self.state.get(p) != sig]
+        changed.extend(p for p in self.state if p not in new)
+        return sorted(changed)
+
+    def wait(self) -> List[str]:
+        """
+        Block until something changes, then until the trees have been quiet
+        for `debounce` seconds (so a burst of saves is one rebuild). Returns
+        the changed paths.
+        """
+        while True:
+            time.sleep(self.interval)
+            new = self.snapshot()
+            if self._diff(new):
+                break
+        changed = set(self._diff(new))
+        while True:
+            time.sleep(self.debounce)
+            latest = self.snapshot()
+            if latest == new:
+                break
+            new = latest
+            changed.update(self._diff(new))
+        self.state = new
+        return sorted(changed)
+
+
+def watch_and_convert(
+    source_dir: Path,
+    mdpi_template_dir: Path,
+    out_dir: Path,
+    options: Dict[str, Any],
+    interval: float = 0.5,
+    debounce: float = 0.3
+) -> None:
+    """
+    Keep converting source_dir on every change until interrupted. Each cycle
+    goes through the build manifest, so only the stages whose inputs changed
+    are re-run (a body edit redoes main.tex, a .bib edit the merge, an image
+    edit the image copy). The template index is kept between cycles and
+    rebuilt only when a template file changes; the source tree is re-indexed
+    every cycle. A cycle that fails (e.g. a file deleted or half-written
+    during a save) is reported and the watcher keeps waiting.
+    """
+    options = dict(options, incremental=True)
+    template_prefix = str(mdpi_template_dir.resolve()) + os.sep
+    kept: Dict[str, TreeIndex] = {}
+
+    def cycle(changed: List[str]) -> None:
+        if changed:
+            shown = [os.path.relpath(p, source_dir.resolve()) for p in changed[:3]]
+            more = f" (+{len(changed) - 3} more)" if len(changed) > 3 else ""
+            print(f"[WATCH] Changed: {', '.join(shown)}{more}")
+        if any(p.startswith(template_prefix) for p in changed):
+            kept.clear()
+
+        start = time.perf_counter()
+        try:
+            converter = AMAToMDPIConverter(source_dir, mdpi_template_dir, out_dir, **options)
+            if "template" in kept:
+                converter._mdpi_index = kept["template"]
+            success = converter.convert()
+            kept["template"] = converter.mdpi_index
+        except Exception as e:
+            kept.clear()
+            print(f"[WATCH] ERROR {type(e).__name__}: {e} (waiting for the next change)")
+            return
+        elapsed = time.perf_counter() - start
+
+        ran = [stage for stage, executed in converter.stage_runs.items() if executed]
+        status = "OK" if success else "ERROR"
+        line = f"[WATCH] {status} in {elapsed:.3f}s, re-ran: {', '.join(ran) or 'nothing'}"
+        if converter.report.compile_steps:
+            seconds = sum(step["seconds"] for step in converter.report.compile_steps)
+            line += f", compile: {len(converter.report.compile_steps)} runs {seconds:.2f}s"
+        print(line)
+        for err in converter.report.errors:
+            print(f"  - {err}")
+
+    cycle([])
+    watcher = SourceWatcher([source_dir, mdpi_template_dir], interval, debounce, exclude=[out_dir])
+    print(f"[WATCH] Watching {source_dir} (Ctrl+C to stop)")
+    try:
+        while True:
+            cycle(watcher.wait())
+    except KeyboardInterrupt:
+        print("\n[WATCH] Stopped.")
+
+
+# Template of the --serve worker processes, loaded once per process
+_SERVICE_TEMPLATE: Optional[WarmTemplate] = None
+
+
+def _service_worker_init(mdpi_template_dir: Path) -> None:
+    """Process pool initializer: keep the template warm in memory"""
+    global _SERVICE_TEMPLATE
+    _SERVICE_TEMPLATE = WarmTemplate(mdpi_template_dir)
+    _SERVICE_TEMPLATE.index()
+
+
+def _service_ping() -> int:
+    """No-op job used to start the workers before the first request"""
+    return os.getpid()
+
+
+@dataclass
+class ServiceResult:
+    """Outcome of one service conversion, sent back from the worker process"""
+    status: int
+    archive: bytes
+    report: Dict[str, Any]
+    started: float
+    seconds: float
+
+
+def _run_service_job(data: bytes, options: Dict[str, Any]) -> ServiceResult:
+    """Convert one uploaded archive in a worker process; never raises"""
+    started = time.time()
+    out = io.BytesIO()
+    try:
+        report = asdict(convert_archive(
+            io.BytesIO(data), _SERVICE_TEMPLATE, out, compresslevel=SERVICE_ZIP_LEVEL, **options
+        ))
+        status = 422 if report["errors"] else 200
+    except zipfile.BadZipFile as e:
+        report, status = {"errors": [f"上传内容不是有效的 zip 压缩包：{e}"]}, 400
+    except ArchiveTooLarge as e:
+        report, status = {"errors": [f"压缩包解压后过大：{e}"]}, 413
+    except Exception as e:
+        report, status = {"errors": [f"转换过程异常：{type(e).__name__}: {e}"]}, 500
+    archive = out.getvalue() if status == 200 else b""
+    return ServiceResult(status, archive, report, started, time.time() - started)
+
+
+class ConversionService:
+    """
+    Local HTTP conversion service (asyncio; TCP on localhost or a Unix socket).
+
+        POST /convert   body: manuscript zip; query: per-request options
+                        -> converted project zip (report included), or
+                           {"report": ..., "archive": base64} with format=json
+        GET  /metrics   queue depth, counters and latency as JSON
+        GET  /health
+
+    Conversions run on a process pool whose workers hold the template in
+    memory (WarmTemplate), so a request only pays for its own manuscript.
+    At most workers + max_queue conversions are admitted at a time; further
+    requests are answered 503 with Retry-After instead of queueing without
+    bound.
+    """
+
+    # Query parameters of POST /convert that map to converter options
+    PATH_OPTIONS = ("out_main_tex", "figures_dir", "bib_name")
+    CHOICE_OPTIONS = {"image_mode": IMAGE_MODES, "include_mode": INCLUDE_MODES}
+    FLAG_OPTIONS = ("prune_bib",)
+
+    # Completed requests kept for the latency percentiles of /metrics
+    LATENCY_WINDOW = 1000
+
+    def __init__(
+        self,
+        mdpi_template_dir: Path,
+        workers: Optional[int] = None,
+        max_queue: int = SERVICE_MAX_QUEUE,
+        max_upload: int = SERVICE_MAX_UPLOAD_MB * 1024 * 1024,
+        options: Optional[Dict[str, Any]] = None
+    ):
+        self.mdpi_dir = mdpi_template_dir.resolve()
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_queue = max(0, max_queue)
+        self.max_upload = max_upload
+        self.options = options or {}
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.started = time.time()
+        # Admitted conversions that have not finished yet (running + queued)
+        self.pending = 0
+        self.peak_queue = 0
+        self.counts = {"accepted": 0, "completed": 0, "failed": 0, "rejected": 0, "errors": 0}
+        self.latencies: deque = deque(maxlen=self.LATENCY_WINDOW)
+        self.queue_waits: deque = deque(maxlen=self.LATENCY_WINDOW)
+
+    def start_pool(self) -> None:
+        """(Re)create the worker pool; every worker loads the template once"""
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_service_worker_init,
+            initargs=(self.mdpi_dir,)
+        )
+
+    @staticmethod
+    def _percentiles(values: Iterable[float]) -> Dict[str, float]:
+        ordered = sorted(values)
+        if not ordered:
+            return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {"p50": round(pick(0.5), 4), "p95": round(pick(0.95), 4), "max": round(ordered[-1], 4)}
+
+    def metrics(self) -> Dict[str, Any]:
+        """Current load of the service (served by GET /metrics)"""
+        running = min(self.pending, self.workers)
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": running,
+            "queue_depth": self.pending - running,
+            "peak_queue_depth": self.peak_queue,
+            **self.counts,
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "latency_seconds": self._percentiles(self.latencies),
+            "queue_wait_seconds": self._percentiles(self.queue_waits),
+        }
+
+    def parse_options(self, query: str) -> Tuple[Dict[str, Any], bool]:
+        """Converter options and JSON flag of a POST /convert query string"""
+        options = {
+            k: v for k, v in self.options.items()
+            if k in self.PATH_OPTIONS or k in self.CHOICE_OPTIONS or k in self.FLAG_OPTIONS
+        }
+        as_json = False
+        for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+            if name == "format":
+                if value not in ("zip", "json"):
+                    raise ValueError(f"format must be zip or json, not {value!r}")
+                as_json = value == "json"
+            elif name in self.PATH_OPTIONS:
+                if not value or _safe_rel(value) != value:
+                    raise ValueError(f"invalid {name}: {value!r}")
+                options[name] = value
+            elif name in self.CHOICE_OPTIONS:
+                if value not in self.CHOICE_OPTIONS[name]:
+                    raise ValueError(f"{name} must be one of {', '.join(self.CHOICE_OPTIONS[name])}")
+                options[name] = value
+            elif name in self.FLAG_OPTIONS:
+                options[name] = value.lower() in ("", "1", "true", "yes")
+            else:
+                raise ValueError(f"unknown option: {name}")
+        return options, as_json
+
+    @staticmethod
+    def _json(status: int, payload: Dict[str, Any], **headers: str) -> Tuple[int, Dict[str, str], bytes]:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        return status, dict(headers, **{"Content-Type": "application/json; charset=utf-8"}), body
+
+    async def convert(self, data: bytes, options: Dict[str, Any], as_json: bool) -> Tuple[int, Dict[str, str], bytes]:
+        """Run one admitted conversion (its slot is already counted in pending) on the pool"""
+        submitted = time.time()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _run_service_job, data, options
+            )
+        except BrokenProcessPool as e:
+            # A worker died (e.g. out of memory); later requests get a fresh pool
+            self.start_pool()
+            result = ServiceResult(500, b"", {"errors": [f"工作进程异常退出：{e}"]}, submitted, 0.0)
+
+        self.latencies.append(time.time() - submitted)
+        self.queue_waits.append(max(0.0, result.started - submitted))
+        self.counts["completed" if result.status == 200 else "failed"] += 1
+        if result.status != 200:
+            return self._json(result.status, {"report": result.report})
+
+        headers = {
+            "X-Conversion-Seconds": f"{result.seconds:.3f}",
+            "X-Queue-Seconds": f"{max(0.0, result.started - submitted):.3f}",
+            "X-Conversion-Warnings": str(len(result.report["warnings"])),
+        }
+        if as_json:
+            archive = base64.b64encode(result.archive).decode("ascii")
+            return self._json(200, {"report": result.report, "archive": archive}, **headers)
+        return 200, dict(headers, **{"Content-Type": "application/zip"}), result.archive
+
+    async def dispatch(self, reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str], bytes]:
+        """Read one HTTP/1.1 request and produce (status, headers, body)"""
+        parts = (await reader.readline()).decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError("malformed request line")
+        method, target, _ = parts
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        url = urllib.parse.urlsplit(target)
+        if url.path in ("/health", "/metrics"):
+            if method != "GET":
+                return self._json(405, {"error": "use GET"}, Allow="GET")
+            return self._json(200, self.metrics() if url.path == "/metrics" else {"status": "ok"})
+        if url.path != "/convert":
+            return self._json(404, {"error": f"no such endpoint: {url.path}"})
+        if method != "POST":
+            return self._json(405, {"error": "use POST"}, Allow="POST")
+        if "content-length" not in headers:
+            return self._json(411, {"error": "Content-Length required"})
+        length = int(headers["content-length"])
+        if length > self.max_upload:
+            return self._json(413, {"error": f"archive larger than {self.max_upload} bytes"})
+        options, as_json = self.parse_options(url.query)
+
+        # Admission comes before the body is read, so a busy service never
+        # buffers uploads it is going to refuse
+        if self.pending >= self.workers + self.max_queue:
+            self.counts["rejected"] += 1
+            await self._discard(reader, length)
+            return self._json(503, {"error": "service busy", **self.metrics()}, **{"Retry-After": "1"})
+        self.pending += 1
+        self.counts["accepted"] += 1
+        self.peak_queue = max(self.peak_queue, self.pending - min(self.pending, self.workers))
+        try:
+            data = await reader.readexactly(length)
+            return await self.convert(data, options, as_json)
+        finally:
+            self.pending -= 1
+
+    @staticmethod
+    async def _discard(reader: asyncio.StreamReader, length: int) -> None:
+        """Read and drop a refused request body in STREAM_CHUNK pieces, so the client still gets the answer"""
+        while length > 0:
+            chunk = await reader.read(min(length, STREAM_CHUNK))
+            if not chunk:
+                break
+            length -= len(chunk)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve one connection (one request; the connection is closed afterwards)"""
+        try:
+            try:
+                status, headers, body = await self.dispatch(reader)
+            except ValueError as e:
+                status, headers, body = self._json(400, {"error": str(e)})
+            except (asyncio.IncompleteReadError, ConnectionError):
+                raise
+            except Exception as e:
+                # Anything else (e.g. an OSError from a worker) still gets an answer
+                self.counts["errors"] += 1
+                print(f"[SERVE] ERROR {type(e).__name__}: {e}", flush=True)
+                status, headers, body = self._json(500, {"error": f"{type(e).__name__}: {e}"})
+            head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+            head += [f"{k}: {v}" for k, v in headers.items()]
+            head += [f"Content-Length: {len(body)}", "Connection: close", "", ""]
+            writer.write("\r\n".join(head).encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = SERVICE_PORT, unix_socket: Optional[Path] = None) -> None:
+        """Start the workers, then serve until cancelled"""
+        self.start_pool()
+        loop = asyncio.get_running_loop()
+        # Spawn every worker (and load the template) before accepting requests
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _service_ping) for _ in range(self.workers)))
+        try:
+            # SIGTERM stops the service like Ctrl+C (not available on Windows)
+            loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, AttributeError):
+            pass
+        try:
+            if unix_socket is not None:
+                if unix_socket.exists():
+                    unix_socket.unlink()
+                server = await asyncio.start_unix_server(self.handle, path=str(unix_socket))
+                where = f"unix:{unix_socket}"
+            else:
+                server = await asyncio.start_server(self.handle, host, port)
+                where = "http://{}:{}".format(*server.sockets[0].getsockname()[:2])
+            print(f"[SERVE] Listening on {where} ({self.workers} workers, queue {self.max_queue})", flush=True)
+            async with server:
+                await server.serve_forever()
+        finally:
+            # Let running conversions finish; queued ones are dropped with their connections
+            self.pool.shutdown(wait=True)
+            if unix_socket is not None and unix_socket.exists():
+                unix_socket.unlink()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(
+        description="Convert AMA format LaTeX paper to MDPI template format"
+    )
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--source_dir", help="AMA source directory")
+    src.add_argument("--batch_root", help="Batch mode: every sub-directory is one AMA manuscript")
+    src.add_argument("--batch_manifest", help="Batch mode: text file listing one AMA source directory per line")
+    src.add_argument("--source_zip", help="AMA manuscript as a zip archive (read without extracting)")
+    src.add_argument("--serve", action="store_true",
+                     help="Run a local conversion service: POST a manuscript zip to /convert, "
+                          "get the converted zip back (see also /metrics)")
+    ap.add_argument("--mdpi_template_dir", required=True, help="MDPI template directory")
+    ap.add_argument("--out_dir", default=None,
+                    help="Output directory (required unless --serve; batch mode: one sub-directory per manuscript); "
+                         "a name ending in .zip writes the converted project as a zip archive")
+    ap.add_argument("--out_main_tex", default="main.tex", help="Output main TeX filename")
+    ap.add_argument("--figures_dir", default="figures", help="Figures directory name")
+    ap.add_argument("--bib_name", default="refs.bib", help="Output bibliography filename")
+    ap.add_argument("--image_mode", choices=IMAGE_MODES, default="referenced",
+                    help="Migrate only \\includegraphics targets (default) or every image file")
+    ap.add_argument("--optimize_figures", action="store_true",
+                    help="Downscale PNG/JPEG figures to --figure_dpi at their printed width and recompress "
+                         "them losslessly otherwise (needs Pillow; results are cached)")
+    ap.add_argument("--figure_dpi", type=int, default=FIGURE_DPI, help="Target resolution of optimized figures")
+    ap.add_argument("--figure_max_px", type=int, default=0, help="Cap the longest side of optimized figures (0: no cap)")
+    ap.add_argument("--figure_cache", default=None,
+                    help="Figure cache directory (default: $XDG_CACHE_HOME/ama_to_mdpi/figures)")
+    ap.add_argument("--figure_workers", type=int, default=None,
+                    help="Worker processes for figure optimization (default: CPU count; 1 per manuscript in batch mode)")
+    ap.add_argument("--compile", action="store_true",
+                    help="Compile the result to PDF, running LaTeX/BibTeX only as often as needed")
+    ap.add_argument("--latex_cmd", default=LATEX_CMD, help="LaTeX engine command (the main .tex name is appended)")
+    ap.add_argument("--bibtex_cmd", default=BIBTEX_CMD, help="BibTeX command (the job name is appended)")
+    ap.add_argument("--max_passes", type=int, default=LATEX_MAX_PASSES, help="Maximum number of LaTeX passes")
+    ap.add_argument("--precompile_preamble", action="store_true",
+                    help="With --compile: dump the static MDPI preamble into a cached format (mylatexformat) "
+                         "and compile with -fmt; falls back to a normal compile if it cannot be used")
+    ap.add_argument("--format_cache", default=None,
+                    help="Format cache directory (default: $XDG_CACHE_HOME/ama_to_mdpi/formats)")
+    ap.add_argument("--format_cmd", default=FORMAT_CMD,
+                    help="Command that dumps the format (-jobname and the .tex file are added)")
+    ap.add_argument("--cache_pdf", action="store_true",
+                    help="With --compile: restore main.pdf/.bbl/.log from a cache keyed by the hashes of every "
+                         "file the compile reads, and add fresh compile results to it")
+    ap.add_argument("--pdf_cache", default=None,
+                    help="PDF cache directory (default: $XDG_CACHE_HOME/ama_to_mdpi/pdf)")
+    ap.add_argument("--pdf_cache_max_mb", type=float, default=PDF_CACHE_MAX_MB,
+                    help="Evict least recently used PDF cache entries beyond this size")
+    ap.add_argument("--pdf_cache_max_days", type=float, default=PDF_CACHE_MAX_DAYS,
+                    help="Evict PDF cache entries unused for this many days")
+    ap.add_argument("--include_mode", choices=INCLUDE_MODES, default="single",
+                    help="Multi-file manuscripts: flatten \\input/\\include/\\subfile into main.tex (default) "
+                         "or keep them and write each included file rewritten")
+    ap.add_argument("--stage_workers", type=int, default=STAGE_WORKERS,
+                    help="Threads running independent conversion stages side by side (1: sequential)")
+    ap.add_argument("--journal", nargs="+", default=None, metavar="NAME",
+                    help="MDPI journal option of \\documentclass (e.g. applsci); with several names the manuscript "
+                         "is parsed once and rendered to <out_dir>/<NAME>/ for each")
+    ap.add_argument("--extra_template", action="append", default=[], metavar="NAME=DIR",
+                    help="Also render into the template in DIR, written to <out_dir>/<NAME>/ (repeatable)")
+    ap.add_argument("--prune_bib", action="store_true",
+                    help="Write only the bib entries cited in the body (plus crossref/@string dependencies)")
+    ap.add_argument("--force", action="store_true", help="Ignore the build manifest and re-run every stage")
+    ap.add_argument(
+        "--template_strategy", default="changed", choices=MATERIALIZE_STRATEGIES,
+        help="How template files are placed in out_dir: copy only if changed (default), always copy, "
+             "hardlink, reflink or symlink (link modes fall back to copying)"
+    )
+    ap.add_argument("--watch", action="store_true",
+                    help="Keep running and reconvert (and compile, with --compile) whenever source_dir changes")
+    ap.add_argument("--watch_interval", type=float, default=0.5, help="Watch mode: polling interval in seconds")
+    ap.add_argument("--debounce", type=float, default=0.3,
+                    help="Watch mode: quiet time in seconds before a burst of changes is rebuilt")
+    ap.add_argument("--workers", type=int, default=None,
+                    help="Batch and serve mode: number of worker processes (default: CPU count)")
+    ap.add_argument("--host", default="127.0.0.1", help="Serve mode: address to listen on")
+    ap.add_argument("--port", type=int, default=SERVICE_PORT, help="Serve mode: TCP port (0: any free port)")
+    ap.add_argument("--unix_socket", default=None, help="Serve mode: listen on this Unix socket instead of TCP")
+    ap.add_argument("--max_queue", type=int, default=SERVICE_MAX_QUEUE,
+                    help="Serve mode: conversions that may wait for a worker before requests are refused with 503")
+    ap.add_argument("--max_upload_mb", type=int, default=SERVICE_MAX_UPLOAD_MB,
+                    help="Serve mode: largest accepted manuscript archive in MB")
+    ap.add_argument("--profile", nargs="?", const="", default=None, metavar="PATH",
+                    help="Write a cProfile dump of the whole run (default: <out_dir>/conversion.prof, "
+                         "or <out_dir>.prof for a .zip output; inspect with python -m pstats)")
+    args = ap.parse_args()
+    if not args.serve and not args.out_dir:
+        ap.error("the following arguments are required: --out_dir")
+    if args.watch and not args.source_dir:
+        ap.error("--watch needs --source_dir")
+    to_zip = bool(args.out_dir) and args.out_dir.lower().endswith(".zip")
+    if to_zip and (args.batch_root or args.batch_manifest or args.watch):
+        ap.error("zip output works for a single manuscript only")
+
+    journals = args.journal or []
+    targets: List[RenderTarget] = []
+    if len(journals) > 1 or args.extra_template:
+        if not args.source_dir or args.watch or to_zip:
+            ap.error("several --journal values and --extra_template need --source_dir and a directory --out_dir")
+        template = Path(args.mdpi_template_dir)
+        targets = [RenderTarget(j, template, j) for j in journals] or [RenderTarget(template.name, template)]
+        for spec in args.extra_template:
+            name, sep, path = spec.partition("=")
+            if not sep or not name or not path:
+                ap.error(f"--extra_template expects NAME=DIR, got: {spec}")
+            targets.append(RenderTarget(name, Path(path)))
+        names = [t.name for t in targets]
+        if len(set(names)) != len(names):
+            ap.error(f"target names must be unique: {', '.join(names)}")
+    for j in journals:
+        if not re.fullmatch(r"[A-Za-z0-9]+", j):
+            ap.error(f"invalid journal name: {j}")
+
+    options = dict(
+        out_main_tex=args.out_main_tex,
+        figures_dir=args.figures_dir,
+        bib_name=args.bib_name,
+        incremental=not args.force,
+        template_strategy=args.template_strategy,
+        prune_bib=args.prune_bib,
+        image_mode=args.image_mode,
+        optimize_figures=args.optimize_figures,
+        figure_dpi=args.figure_dpi,
+        figure_max_px=args.figure_max_px,
+        figure_cache=Path(args.figure_cache) if args.figure_cache else None,
+        figure_workers=args.figure_workers,
+        compile_pdf=args.compile,
+        latex_cmd=args.latex_cmd,
+        bibtex_cmd=args.bibtex_cmd,
+        max_passes=args.max_passes,
+        precompile_preamble=args.precompile_preamble,
+        format_cache=Path(args.format_cache) if args.format_cache else None,
+        format_cmd=args.format_cmd,
+        cache_pdf=args.cache_pdf,
+        pdf_cache=Path(args.pdf_cache) if args.pdf_cache else None,
+        pdf_cache_max_mb=args.pdf_cache_max_mb,
+        pdf_cache_max_days=args.pdf_cache_max_days,
+        include_mode=args.include_mode,
+        stage_workers=args.stage_workers
+    )
+    if len(journals) == 1 and not targets:
+        options["journal"] = journals[0]
+
+    if args.serve:
+        template = Path(args.mdpi_template_dir)
+        if not template.is_dir():
+            ap.error(f"mdpi_template_dir does not exist: {template}")
+        service = ConversionService(
+            template, args.workers, args.max_queue, args.max_upload_mb * 1024 * 1024, options
+        )
+        try:
+            asyncio.run(service.serve(args.host, args.port, Path(args.unix_socket) if args.unix_socket else None))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print("\n[SERVE] Stopped.")
+        return
+
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.batch_root or args.batch_manifest:
+            out_dir = Path(args.out_dir)
+            if args.batch_root:
+                jobs = BatchConverter.discover_jobs(Path(args.batch_root), out_dir)
+            else:
+                jobs = BatchConverter.load_manifest(Path(args.batch_manifest), out_dir)
+            if not jobs:
+                print("[ERROR] No manuscripts found for batch conversion.")
+                raise SystemExit(1)
+
+            batch = BatchConverter(
+                jobs,
+                mdpi_template_dir=Path(args.mdpi_template_dir),
+                out_dir=out_dir,
+                workers=args.workers,
+                options=options
+            )
+            report = batch.run()
+            batch.print_summary()
+            if report.failed:
+                raise SystemExit(1)
+            return
+
+        if to_zip:
+            report = convert_archive(
+                Path(args.source_zip or args.source_dir), Path(args.mdpi_template_dir), Path(args.out_dir),
+                **dict(options, incremental=False)
+            )
+            if report.errors:
+                print(f"[ERROR] Conversion failed. Check conversion_report.md in: {args.out_dir}")
+                for err in report.errors:
+                    print(f"  - {err}")
+                raise SystemExit(1)
+            print(f"[OK] Converted project written to: {args.out_dir}")
+            return
+
+        if targets:
+            multi = MultiTargetConverter(Path(args.source_dir), targets, Path(args.out_dir), options)
+            if not multi.run():
+                raise SystemExit(1)
+            return
+
+        if args.watch:
+            watch_and_convert(
+                Path(args.source_dir), Path(args.mdpi_template_dir), Path(args.out_dir),
+                options, args.watch_interval, args.debounce
+            )
+            return
+
+        source_fs = ZipFS(Path(args.source_zip)) if args.source_zip else None
+        converter = AMAToMDPIConverter(
+            source_dir=Path(args.source_zip or args.source_dir),
+            mdpi_template_dir=Path(args.mdpi_template_dir),
+            out_dir=Path(args.out_dir),
+            source_fs=source_fs,
+            **options
+        )
 
-    success = converter.convert()
-    converter.print_summary()
+        try:
+            success = converter.convert()
+        finally:
+            if source_fs is not None:
+                source_fs.close()
+        converter.print_summary()
 
-    if not success:
-        raise SystemExit(1)
+        if not success:
+            raise SystemExit(1)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            out = Path(args.out_dir)
+            # A zip output gets its profile next to the archive, not inside it
+            default = out.with_name(out.name + ".prof") if to_zip else out / "conversion.prof"
+            prof_path = Path(args.profile) if args.profile else default
+            prof_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(prof_path))
+            print(f"[OK] Profile: {prof_path}")
 
 
 if __name__ == "__main__":
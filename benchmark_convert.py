@@ -0,0 +1,1055 @@
+#!/usr/bin/env python3
+"""Benchmarks for ama_to_mdpi_convert on synthetic project trees"""
+from __future__ import annotations
+
+import argparse
+import filecmp
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ama_to_mdpi_convert import (
+    BIB_EXTS,
+    IMAGE_EXTS,
+    MATERIALIZE_STRATEGIES,
+    AMAToMDPIConverter,
+    ContentProcessor,
+    FigureOptimizer,
+    FileHandler,
+    TeXParser,
+    TreeIndex,
+)
+
+REPO_TEMPLATE = Path(__file__).resolve().parent / "mdpi_template"
+REPO_SOURCE = Path(__file__).resolve().parent / "ama_source"
+REPO_SCRIPT = Path(__file__).resolve().parent / "ama_to_mdpi_convert.py"
+
+# Pause of the service load-test client before retrying a 503 answer
+BUSY_RETRY_SECONDS = 0.05
+
+# Linearity check: allowed growth of seconds per MB from the smallest to the
+# largest input, and allowed peak traced memory as a multiple of the input or
+# the produced main TeX, whichever is larger (an abstract that runs to the end
+# of the body is written twice)
+LINEAR_TOLERANCE = 2.0
+MEMORY_FACTOR = 3.0
+
+
+class SyscallCounter:
+    """Count os.stat / os.scandir calls made while active"""
+
+    def __init__(self):
+        self.stat = 0
+        self.scandir = 0
+        self._stat = os.stat
+        self._scandir = os.scandir
+
+    def __enter__(self) -> "SyscallCounter":
+        def stat(*args, **kwargs):
+            self.stat += 1
+            return self._stat(*args, **kwargs)
+
+        def scandir(*args, **kwargs):
+            self.scandir += 1
+            return self._scandir(*args, **kwargs)
+
+        os.stat = stat
+        os.scandir = scandir
+        return self
+
+    def __exit__(self, *exc) -> None:
+        os.stat = self._stat
+        os.scandir = self._scandir
+
+
+def make_tree(root: Path, dirs: int, files_per_dir: int) -> None:
+    """Synthetic source tree: a main .tex plus data/figure folders of mixed files"""
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "manuscript.tex").write_text(
+        "\\documentclass{article}\n\\begin{document}\nx\n\\end{document}\n", encoding="utf-8"
+    )
+    (root / "ref.bib").write_text("@article{k,\n  title = {t}\n}\n", encoding="utf-8")
+    exts = [".csv", ".dat", ".png", ".tex", ".txt", ".pdf", ".json", ".bib"]
+    for d in range(dirs):
+        sub = root / f"data{d:03d}" / "raw"
+        sub.mkdir(parents=True, exist_ok=True)
+        for i in range(files_per_dir):
+            (sub / f"f{i:04d}{exts[i % len(exts)]}").write_bytes(b"x")
+
+
+def legacy_walks(source: Path, template: Path) -> None:
+    """The five tree walks one convert() call used to make"""
+    TeXParser.collect_tex_files(source)
+    TeXParser.collect_tex_files(template)
+    FileHandler.collect_files_by_ext(source, IMAGE_EXTS)
+    FileHandler.collect_files_by_ext(source, BIB_EXTS)
+    [p for p in template.rglob("*") if not p.is_dir()]
+
+
+def indexed_walks(source: Path, template: Path) -> int:
+    """Same queries answered from one TreeIndex per tree; returns DirEntry.stat calls"""
+    src_index = TreeIndex.build(source)
+    tpl_index = TreeIndex.build(template)
+    TeXParser.collect_tex_files(source, src_index)
+    TeXParser.collect_tex_files(template, tpl_index)
+    FileHandler.collect_files_by_ext(source, IMAGE_EXTS, src_index)
+    FileHandler.collect_files_by_ext(source, BIB_EXTS, src_index)
+    list(tpl_index.files)
+    return src_index.stat_calls + tpl_index.stat_calls
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Best wall time over repeat runs plus syscall counts of one run"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    with SyscallCounter() as counter:
+        fn()
+    return {"seconds": best, "stat": counter.stat, "scandir": counter.scandir}
+
+
+def bench_tree_index(dirs: int, files_per_dir: int, repeat: int) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        source = tmp / "source"
+        template = tmp / "template"
+        make_tree(source, dirs, files_per_dir)
+        make_tree(template, max(1, dirs // 10), files_per_dir)
+
+        legacy = measure(lambda: legacy_walks(source, template), repeat)
+        indexed = measure(lambda: indexed_walks(source, template), repeat)
+        # TreeIndex stats through DirEntry.stat(), which os.stat patching cannot see
+        indexed["stat"] += indexed_walks(source, template)
+
+        total = dirs * files_per_dir
+        print(f"tree_index: {total} source files in {dirs * 2} directories")
+        print(f"{'variant':<10} {'seconds':>10} {'stat':>10} {'scandir':>10}")
+        for name, r in (("legacy", legacy), ("indexed", indexed)):
+            print(f"{name:<10} {r['seconds']:>10.4f} {r['stat']:>10} {r['scandir']:>10}")
+        print(f"stat calls: {legacy['stat']} -> {indexed['stat']}, "
+              f"directory listings: {legacy['scandir']} -> {indexed['scandir']}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def legacy_find_main_tex(tex_files: List[Path]) -> Optional[Path]:
+    """Previous find_main_tex: full read_text of every file, stat again when ranking"""
+    candidates = [
+        f for f in tex_files
+        if "\\documentclass" in (t := TeXParser.read_text(f)) and "\\begin{document}" in t
+    ]
+    if not candidates:
+        return None
+    candidates.sort(key=lambda x: (len(x.parts), -x.stat().st_size))
+    return candidates[0]
+
+
+def make_chapter_tree(root: Path, files: int, lines_per_file: int) -> None:
+    """Many large non-main .tex files plus one main file"""
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "paper.tex").write_text(
+        "\\documentclass{article}\n\\begin{document}\n\\input{chapters/c000}\n\\end{document}\n",
+        encoding="utf-8"
+    )
+    chapters = root / "chapters"
+    chapters.mkdir(exist_ok=True)
+    row = " & ".join(["1.234"] * 12) + " \\\\\n"
+    table = "\\begin{tabular}{" + "c" * 12 + "}\n" + row * lines_per_file + "\\end{tabular}\n"
+    for i in range(files):
+        (chapters / f"c{i:03d}.tex").write_text(table, encoding="utf-8")
+
+
+def bench_main_tex(files: int, lines_per_file: int, repeat: int) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        make_chapter_tree(tmp, files, lines_per_file)
+        index = TreeIndex.build(tmp)
+        tex_files = TeXParser.collect_tex_files(tmp, index)
+
+        legacy = measure(lambda: legacy_find_main_tex(tex_files), repeat)
+        streaming = measure(lambda: TeXParser.find_main_tex(tex_files, index), repeat)
+        assert legacy_find_main_tex(tex_files) == TeXParser.find_main_tex(tex_files, index)
+
+        size_mb = sum(f.size for f in index.files) / 1e6
+        print(f"main_tex: {len(tex_files)} .tex files, {size_mb:.1f} MB")
+        print(f"{'variant':<10} {'seconds':>10} {'stat':>10}")
+        for name, r in (("legacy", legacy), ("streaming", streaming)):
+            print(f"{name:<10} {r['seconds']:>10.4f} {r['stat']:>10}")
+        print(f"speedup: {legacy['seconds'] / max(streaming['seconds'], 1e-9):.1f}x")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def disk_usage(root: Path) -> int:
+    """Bytes allocated under root, counting each inode once and not following symlinks"""
+    seen = set()
+    total = 0
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            st = os.lstat(os.path.join(dirpath, name))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += getattr(st, "st_blocks", 0) * 512 or st.st_size
+    return total
+
+
+def bench_materialize(outputs: int) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        template = REPO_TEMPLATE
+        if not template.is_dir():
+            template = tmp / "template"
+            make_tree(template, 2, 20)
+        index = TreeIndex.build(template)
+        size_mb = sum(f.size for f in index.files) / 1e6
+
+        print(f"materialize: {len(index.files)} template files ({size_mb:.1f} MB) into {outputs} output dirs")
+        print(f"{'strategy':<10} {'first (s)':>10} {'rerun (s)':>10} {'disk (MB)':>10}  methods")
+        for strategy in MATERIALIZE_STRATEGIES:
+            root = tmp / strategy
+            counts: Dict[str, int] = {}
+            start = time.perf_counter()
+            for i in range(outputs):
+                for k, v in FileHandler.copy_template_structure(template, root / f"job{i:04d}", index, strategy).items():
+                    counts[k] = counts.get(k, 0) + v
+            first = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(outputs):
+                FileHandler.copy_template_structure(template, root / f"job{i:04d}", index, strategy)
+            rerun = time.perf_counter() - start
+
+            methods = ", ".join(f"{k}={v}" for k, v in sorted(counts.items()))
+            print(f"{strategy:<10} {first:>10.4f} {rerun:>10.4f} {disk_usage(root) / 1e6:>10.1f}  {methods}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def legacy_rewrite(body: str, figures_dir: str = "figures") -> str:
+    """Previous body processing: one regex pass per rewrite"""
+    body = re.sub(r"\\citep\s*\{", r"\\cite{", body)
+    body = re.sub(r"\\citet\s*\{", r"\\cite{", body)
+    if "\\printbibliography" in body:
+        body = re.sub(r"\\printbibliography\s*(?:\[[^\]]*\])?\s*", "", body)
+    if "\\addbibresource" in body:
+        body = re.sub(r"\\addbibresource\s*\{[^}]+\}\s*", "", body)
+    body = re.sub(r"\\maketitle\s*", "", body)
+
+    def repl(m: re.Match) -> str:
+        path = m.group(2).strip()
+        if path.startswith(figures_dir + "/"):
+            return m.group(0)
+        return f"{m.group(1)}{figures_dir}/{Path(path).name}{m.group(3)}"
+
+    return re.sub(r"(\\includegraphics(?:\[[^\]]*\])?\{)([^}]+)(\})", repl, body)
+
+
+def bench_rewrite(copies: int, repeat: int) -> None:
+    sample = TeXParser.extract_document_body(TeXParser.read_text(REPO_SOURCE / "manuscript.tex"))
+    row = " & ".join(["1.234"] * 12) + " \\\\\n"
+    table = "\\begin{tabular}{" + "c" * 12 + "}\n" + row * 500 + "\\end{tabular}\n"
+    bodies = {
+        f"manuscript x{copies}": sample * copies,
+        f"tables x{copies}": (table + "See \\citep{k} and Fig.~\\ref{f}.\n") * copies,
+    }
+
+    print(f"{'body':<22} {'MB':>6} {'legacy (s)':>11} {'lexer (s)':>10}")
+    for name, body in bodies.items():
+        legacy = measure(lambda: legacy_rewrite(body), repeat)
+        lexer = measure(lambda: ContentProcessor.rewrite_body(body), repeat)
+        print(f"{name:<22} {len(body) / 1e6:>6.1f} {legacy['seconds']:>11.4f} {lexer['seconds']:>10.4f}")
+
+
+def legacy_extract_abstract(body: str) -> Tuple[Optional[str], str]:
+    """Previous abstract extraction: a lazy DOTALL search, then a second near-identical re.sub"""
+    match = re.search(
+        r"\\section\*?\{Abstract\}\\label\{[^}]*\}\s*(.*?)(?=\\section|\Z)", body, re.DOTALL | re.IGNORECASE
+    )
+    if not match:
+        return None, body
+    rest = re.sub(
+        r"\\section\*?\{Abstract\}\\label\{[^}]*\}.*?(?=\\section)", "", body,
+        count=1, flags=re.DOTALL | re.IGNORECASE
+    )
+    return match.group(1).strip(), rest.strip()
+
+
+def legacy_inject(template: str, title: str, abstract: str, body: str) -> str:
+    """Previous template injection: regex substitutions, concatenation, then rfind on the result"""
+    begin = re.search(r"^\\begin\{document\}", template, re.MULTILINE).end()
+    end = re.search(r"^\\end\{document\}", template, re.MULTILINE).start()
+    pre, post = template[:begin], template[end:]
+    pre = re.sub(r"\\Title\{[^}]*\}", f"\\\\Title{{{title}}}", pre)
+    pre = re.sub(r"\\abstract\{[^}]*?\}", f"\\\\abstract{{{abstract}}}", pre, flags=re.DOTALL)
+    final = pre + "\n\n" + body + "\n\n" + post
+    if "\\bibliography{" not in body and "\\begin{thebibliography}" not in body:
+        pos = final.rfind("\\end{document}")
+        final = final[:pos] + "\\bibliography{refs}\n\n" + final[pos:]
+    return final
+
+
+def make_large_document(size: int, sections: bool) -> str:
+    """A manuscript of about size bytes: an abstract section, then either many sections or none"""
+    paragraph = "Spike trains are fused across sensors \\cite{k1,k2} with 62\\% less bandwidth.\n" * 8 + "\n"
+    parts = [
+        "\\documentclass{article}\n\\title{Large \\emph{synthetic} manuscript}\n\\begin{document}\n",
+        "\\section*{Abstract}\\label{sec:abstract}\nA short abstract.\n\n",
+    ]
+    n = 0
+    while n < size:
+        if sections:
+            parts.append(f"\\section{{Part {n}}}\n")
+        parts.append(paragraph)
+        n += len(paragraph)
+    parts.append("\\end{document}\n")
+    return "".join(parts)
+
+
+def fuzz_document(rng: random.Random) -> str:
+    tokens = [
+        "\\section{Intro}", "\\section*{Abstract}\\label{a}", "\\section{abstract}\\label{sec:x}\n  ",
+        "\\SECTION{x}", "\\section*{ABSTRACT}\\label{}", "\\section", "text ", "\n", "  ", "{", "}", "%",
+        "\\label{", "\\bibliography{refs}", "\\begin{thebibliography}",
+    ]
+    return "".join(rng.choice(tokens) for _ in range(rng.randint(0, 40)))
+
+
+def bench_linearity(base_mb: float, steps: int, repeat: int, fuzz_cases: int) -> bool:
+    """
+    Title/abstract/body extraction and template injection on growing
+    manuscripts: time per MB must stay flat and peak memory within a small
+    multiple of the input. The rewritten functions are also fuzzed against
+    the previous implementation for identical results.
+    """
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        converter = AMAToMDPIConverter(REPO_SOURCE, REPO_TEMPLATE, tmp)
+        _, mdpi_main = converter.find_main_files()
+        template = TeXParser.read_text(mdpi_main)
+
+        rng = random.Random(0)
+        mismatches = 0
+        for _ in range(fuzz_cases):
+            body = fuzz_document(rng)
+            if TeXParser.extract_abstract(body) != legacy_extract_abstract(body):
+                mismatches += 1
+            # Plain title/abstract: the previous code ran them through re.sub escapes
+            converter.title, converter.abstract = "Fuzz title", "Fuzz abstract"
+            if converter.inject_body_into_template(mdpi_main, body) != legacy_inject(
+                template, converter.title, converter.abstract, body
+            ):
+                mismatches += 1
+        print(f"linearity: fuzzed {fuzz_cases} documents against the previous implementation, "
+              f"{mismatches} mismatches")
+
+        def legacy(doc: str) -> str:
+            body = TeXParser.extract_document_body(doc)
+            abstract, body = legacy_extract_abstract(body)
+            # Escaped: the previous re.sub replacement failed on e.g. \cite in the abstract
+            return legacy_inject(template, "Title", (abstract or "").replace("\\", "\\\\"), body)
+
+        def single_pass(doc: str) -> str:
+            body = TeXParser.extract_document_body(doc)
+            converter.title = TeXParser.extract_title(doc)
+            converter.abstract, body = TeXParser.extract_abstract(body)
+            return converter.inject_body_into_template(mdpi_main, body)
+
+        ok = mismatches == 0
+        print(f"{'document':<22} {'MB':>6} {'legacy (s)':>11} {'single (s)':>11} {'s/MB':>8} "
+              f"{'peak/input':>11} {'peak/output':>12}")
+        for sections in (False, True):
+            per_mb: List[float] = []
+            for step in range(steps):
+                doc = make_large_document(int(base_mb * 1e6 * 2 ** step), sections)
+                mb = len(doc) / 1e6
+                old = measure(lambda: legacy(doc), repeat)
+                new = measure(lambda: single_pass(doc), repeat)
+                peak = peak_memory(lambda: single_pass(doc))
+                produced = len(single_pass(doc))
+                per_mb.append(new["seconds"] / mb)
+                name = "sections" if sections else "no later \\section"
+                print(f"{name:<22} {mb:>6.1f} {old['seconds']:>11.4f} {new['seconds']:>11.4f} "
+                      f"{per_mb[-1]:>8.4f} {peak / len(doc):>10.1f}x {peak / produced:>11.1f}x")
+                if peak > MEMORY_FACTOR * max(len(doc), produced):
+                    print(f"  [FAIL] peak memory above {MEMORY_FACTOR:.0f}x the input/output size")
+                    ok = False
+            if per_mb[-1] > per_mb[0] * LINEAR_TOLERANCE:
+                print(f"  [FAIL] time per MB grew {per_mb[-1] / per_mb[0]:.1f}x (limit {LINEAR_TOLERANCE:.1f}x)")
+                ok = False
+        return ok
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def legacy_write_segments(p: Path, segments: List[str]) -> bool:
+    """Previous main.tex write: the whole text, its encoding and the old file in memory at once"""
+    data = "".join(segments).encode("utf-8")
+    if p.is_file() and p.stat().st_size == len(data) and p.read_bytes() == data:
+        return False
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(data)
+    return True
+
+
+def memory_child(variant: str, source: Path, out: Path) -> None:
+    """
+    One conversion in this process, then its peak RSS in bytes as JSON on
+    stdout (run by bench_memory in a fresh interpreter). The legacy variant
+    patches the previous whole-file read, body copies and write back in.
+    """
+    import resource
+
+    if variant == "legacy":
+        TeXParser.read_text = staticmethod(lambda p: p.read_text(encoding="utf-8", errors="ignore"))
+        TeXParser.count_lines = staticmethod(lambda text: len(text.splitlines()))
+        TeXParser.extract_abstract = staticmethod(
+            lambda text, start=0, end=None: legacy_extract_abstract(text[start:end].strip())
+        )
+        FileHandler.write_segments_if_changed = staticmethod(legacy_write_segments)
+        ContentProcessor.REWRITE_FLUSH_PIECES = sys.maxsize
+    AMAToMDPIConverter(source, REPO_TEMPLATE, out, incremental=False, stage_workers=1).convert()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    print(json.dumps({"peak_rss": peak if sys.platform == "darwin" else peak * 1024}))
+
+
+def bench_memory(size_mb: float) -> None:
+    """Peak RSS of converting a large manuscript, previous implementation vs memory-mapped/streamed"""
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        print("memory: skipped (the resource module is not available on this platform)")
+        return
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        source = tmp / "source"
+        source.mkdir()
+        doc = make_large_document(int(size_mb * 1e6), True).replace("\\cite{", "\\citep{")
+        (source / "manuscript.tex").write_text(doc, encoding="utf-8")
+        (source / "refs.bib").write_text("@article{k1, title={A}}\n@article{k2, title={B}}\n", encoding="utf-8")
+        print(f"memory: {len(doc) / 1e6:.1f} MB manuscript")
+        del doc
+
+        print(f"{'variant':<10} {'run':<10} {'seconds':>10} {'peak RSS MB':>12}")
+        for variant in ("legacy", "streamed"):
+            out = tmp / f"out_{variant}"
+            # Second run: main.tex already has the content (compared, not rewritten)
+            for run in ("cold", "unchanged"):
+                code = (
+                    "from pathlib import Path; import benchmark_convert as b; "
+                    f"b.memory_child({variant!r}, Path({str(source)!r}), Path({str(out)!r}))"
+                )
+                start = time.perf_counter()
+                proc = subprocess.run(
+                    [sys.executable, "-c", code], cwd=str(REPO_SCRIPT.parent),
+                    stdout=subprocess.PIPE, check=True, universal_newlines=True
+                )
+                seconds = time.perf_counter() - start
+                peak = json.loads(proc.stdout.strip().splitlines()[-1])["peak_rss"]
+                print(f"{variant:<10} {run:<10} {seconds:>10.2f} {peak / 1e6:>12.1f}")
+        same = filecmp.cmp(tmp / "out_legacy" / "main.tex", tmp / "out_streamed" / "main.tex", shallow=False)
+        print(f"main.tex identical: {'yes' if same else 'NO'}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def make_image_tree(root: Path, images: int, referenced: int, image_kb: int) -> str:
+    """Image tree with a few referenced figures among many raw plots; returns the body"""
+    for i in range(images):
+        folder = root / f"run{i % 20:02d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        # Every run folder has its own plot_<n>.png, so basenames collide across folders
+        data = os.urandom(image_kb * 1024) if i % 7 else b"shared" * (image_kb * 170)
+        (folder / f"plot_{i // 20}.png").write_bytes(data)
+    picked = sorted({(k * 37) % images for k in range(referenced)})
+    lines = [f"\\includegraphics[width=0.5\\textwidth]{{run{i % 20:02d}/plot_{i // 20}}}" for i in picked]
+    return "\n".join(lines) + "\n"
+
+
+def bench_images(images: int, referenced: int, image_kb: int, repeat: int) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        source = tmp / "source"
+        body = make_image_tree(source, images, referenced, image_kb)
+        index = TreeIndex.build(source)
+
+        def legacy() -> None:
+            out = tmp / "legacy"
+            shutil.rmtree(out, ignore_errors=True)
+            out.mkdir()
+            for img in index.by_ext(IMAGE_EXTS):
+                shutil.copy2(img, out / img.name)
+
+        def planned(workers: int) -> None:
+            out = tmp / f"planned{workers}"
+            shutil.rmtree(out, ignore_errors=True)
+            plan = FileHandler.plan_images(ContentProcessor.collect_graphics(body), index, "figures")
+            FileHandler.copy_images(source, out, "figures", index, plan.sources, workers)
+
+        plan = FileHandler.plan_images(ContentProcessor.collect_graphics(body), index, "figures")
+        print(f"images: {images} files of {image_kb} KB, {referenced} referenced")
+        print(f"plan: {len(plan.sources)} files, {len(plan.renamed)} renamed, {len(plan.duplicates)} deduplicated")
+        print(f"{'variant':<14} {'seconds':>10} {'files':>8}")
+        legacy_r = measure(legacy, repeat)
+        print(f"{'legacy (all)':<14} {legacy_r['seconds']:>10.4f} {len(os.listdir(tmp / 'legacy')):>8}")
+        for workers in (1, 8):
+            r = measure(lambda: planned(workers), repeat)
+            copied = len(os.listdir(tmp / f"planned{workers}" / "figures"))
+            print(f"{f'planned x{workers}':<14} {r['seconds']:>10.4f} {copied:>8}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def make_screenshots(root: Path, count: int, width: int) -> None:
+    """Screenshot-like PNGs: flat panels, grid lines and a noisy plot area"""
+    from PIL import Image, ImageDraw
+
+    root.mkdir(parents=True, exist_ok=True)
+    height = width * 2 // 3
+    for i in range(count):
+        img = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(img)
+        for x in range(0, width, 40):
+            draw.line([(x, 0), (x, height)], fill=(220, 220, 220))
+        for k in range(30):
+            y = (k * 97 + i * 13) % height
+            draw.rectangle([(k * 50 % width, y), (k * 50 % width + 300, y + 20)], fill=(40 + k * 5, 90, 160))
+        noise = Image.effect_noise((width // 3, height // 3), 40).convert("RGB")
+        img.paste(noise, (width // 3, height // 3))
+        img.save(root / f"fig{i:03d}.png", dpi=(300, 300))
+
+
+def bench_figures(count: int, width: int) -> None:
+    if not FigureOptimizer.available():
+        print("figures: skipped (Pillow is not installed)")
+        return
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        source = tmp / "source"
+        make_screenshots(source, count, width)
+        figures = [(p.name, p, [["width", 0.5 * 13.86 / 2.54, 0]]) for p in sorted(source.iterdir())]
+        size_in = sum(p.stat().st_size for _, p, _ in figures)
+
+        print(f"figures: {count} PNGs of {width}px ({size_in / 1e6:.1f} MB) at 0.5\\textwidth")
+        print(f"{'variant':<14} {'seconds':>10} {'out MB':>8} {'hits':>6}")
+        for label, workers, cache in (
+            ("cold x1", 1, "c1"),
+            (f"cold x{os.cpu_count()}", None, "cn"),
+            ("warm", None, "cn"),
+        ):
+            optimizer = FigureOptimizer(tmp / cache, workers=workers)
+            start = time.perf_counter()
+            results = optimizer.optimize(figures)
+            seconds = time.perf_counter() - start
+            size_out = sum(r["bytes_out"] for r in results)
+            hits = sum(1 for r in results if r["cached"])
+            print(f"{label:<14} {seconds:>10.4f} {size_out / 1e6:>8.1f} {hits:>6}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def legacy_merge_bib(bibs: List[Path], out_bib: Path) -> None:
+    """The regex-split merge used before BibReader: whole files in memory, no pruning"""
+    seen = set()
+    merged = []
+    key_pattern = re.compile(r"@\w+\s*\{\s*([^,\s]+)\s*,", re.IGNORECASE)
+    for bib in bibs:
+        txt = TeXParser.read_text(bib)
+        for part in re.split(r"\n(?=@\w+\s*\{)", txt, flags=re.IGNORECASE):
+            s = part.strip()
+            m = key_pattern.search(s) if s.startswith("@") else None
+            if m and m.group(1) not in seen:
+                seen.add(m.group(1))
+                merged.append(s + "\n")
+    out_bib.write_text("\n\n".join(merged), encoding="utf-8")
+
+
+def make_bib(path: Path, entries: int) -> None:
+    with path.open("w", encoding="utf-8") as fh:
+        fh.write('@string{jn = "Journal of Synthetic Results"}\n\n')
+        for i in range(entries):
+            fh.write(
+                f"@article{{key{i},\n  author = {{Author, A. and Other, B.}},\n"
+                f"  title = {{A {{Nested}} Title number {i}}},\n  journal = jn,\n"
+                f"  year = {{{2000 + i % 25}}},\n  abstract = {{{'lorem ipsum ' * 40}}}\n}}\n\n"
+            )
+
+
+def peak_memory(fn: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_bib(entries: int, cited: int, repeat: int) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        bib = tmp / "library.bib"
+        make_bib(bib, entries)
+        keys = [f"key{i}" for i in range(0, entries, max(1, entries // cited))][:cited]
+        out = tmp / "refs.bib"
+
+        variants = {
+            "legacy": lambda: legacy_merge_bib([bib], out),
+            "streamed": lambda: FileHandler.merge_bib_files([bib], out),
+            f"pruned ({len(keys)})": lambda: FileHandler.merge_bib_files([bib], out, keys),
+        }
+        print(f"bib: {entries} entries, {bib.stat().st_size / 1e6:.1f} MB")
+        print(f"{'variant':<16} {'seconds':>10} {'peak MB':>10} {'out MB':>10}")
+        for name, fn in variants.items():
+            r = measure(fn, repeat)
+            peak = peak_memory(fn)
+            print(f"{name:<16} {r['seconds']:>10.4f} {peak / 1e6:>10.1f} {out.stat().st_size / 1e6:>10.2f}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def make_project(
+    root: Path,
+    body_lines: int,
+    brace_depth: int,
+    bib_entries: int,
+    figures: int,
+    tex_files: int
+) -> Path:
+    """
+    Synthetic AMA project: a biblatex manuscript with an abstract section,
+    body_lines of prose citing the library and including every figure, a
+    paragraph nested brace_depth groups deep, tex_files non-main chapters and
+    figures distinct image files in two folders. Returns the main .tex path.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    fig_dirs = [root / "figs", root / "plots" / "raw"]
+    for d in fig_dirs:
+        d.mkdir(parents=True, exist_ok=True)
+    for i in range(figures):
+        ext = (".png", ".pdf", ".jpg")[i % 3]
+        (fig_dirs[i % 2] / f"fig{i:05d}{ext}").write_bytes(i.to_bytes(4, "big") * 64)
+
+    make_bib(root / "library.bib", bib_entries)
+
+    chapters = root / "chapters"
+    chapters.mkdir(exist_ok=True)
+    filler = "Filler text with $x^2$ math and a \\textbf{bold} word.\n" * 50
+    for i in range(tex_files):
+        (chapters / f"ch{i:04d}.tex").write_text(f"\\section{{Chapter {i}}}\n{filler}", encoding="utf-8")
+
+    lines = [
+        "\\documentclass{article}",
+        "\\usepackage{graphicx}",
+        "\\usepackage[backend=biber,style=numeric-comp,sorting=none]{biblatex}",
+        "\\addbibresource{library.bib}",
+        "\\graphicspath{{figs/}{plots/raw/}}",
+        "\\title{A Synthetic Manuscript for Benchmarking}",
+        "\\begin{document}",
+        "\\maketitle",
+        "\\section*{Abstract}\\label{abstract}",
+        "We benchmark the converter on a synthetic manuscript. " * 20,
+        "\\section{Introduction}",
+    ]
+    step = max(1, bib_entries // max(1, body_lines // 4))
+    for i in range(body_lines):
+        if figures and i % max(1, body_lines // figures) == 0 and i // max(1, body_lines // figures) < figures:
+            n = i // max(1, body_lines // figures)
+            lines.append(f"\\includegraphics[width=0.8\\textwidth]{{fig{n:05d}}}")
+        elif i % 4 == 0:
+            key = (i // 4 * step) % max(1, bib_entries)
+            lines.append(f"As shown before \\autocite{{key{key}}}, the effect holds (Fig.~\\ref{{f{i}}}). % note {i}")
+        else:
+            lines.append(f"Line {i} of the body has \\emph{{emphasis}}, $a_{{{i}}} + b$ and plain words.")
+    lines.append("{" * brace_depth + "deeply nested" + "}" * brace_depth)
+    lines += ["\\printbibliography", "\\end{document}", ""]
+    main = root / "manuscript.tex"
+    main.write_text("\n".join(lines), encoding="utf-8")
+    return main
+
+
+def suite_cases(project: Path, work: Path) -> Dict[str, Callable[[], object]]:
+    """Per-function cases over one synthetic project, keyed by qualified name"""
+    index = TreeIndex.build(project)
+    tex_files = TeXParser.collect_tex_files(project, index)
+    main = project / "manuscript.tex"
+    text = TeXParser.read_text(main)
+    body = TeXParser.extract_document_body(text)
+    _, body_only = TeXParser.extract_abstract(body)
+    search_dirs = [""] + TeXParser.extract_graphicspath(text)
+    refs = [target for target, _ in ContentProcessor.collect_graphics_options(body_only)]
+    plan = FileHandler.plan_images(refs, index, "figures", search_dirs)
+    bibs = FileHandler.collect_files_by_ext(project, BIB_EXTS, index)
+    cited = ContentProcessor.collect_cite_keys(
+        ContentProcessor.rewrite_body(body_only, graphics_map=plan.paths).body
+    )
+    rewritten = ContentProcessor.rewrite_body(body_only, graphics_map=plan.paths).body
+    out = work / "out"
+    counter = iter(range(1 << 30))
+
+    def fresh(name: str) -> Path:
+        # A new destination per repetition, so copies are never no-ops
+        d = out / f"{name}{next(counter)}"
+        d.mkdir(parents=True)
+        return d
+
+    return {
+        "TreeIndex.build": lambda: TreeIndex.build(project),
+        "TeXParser.collect_tex_files": lambda: TeXParser.collect_tex_files(project, TreeIndex.build(project)),
+        "TeXParser.find_main_tex": lambda: TeXParser.find_main_tex(tex_files, TreeIndex.build(project)),
+        "TeXParser.read_text": lambda: TeXParser.read_text(main),
+        "TeXParser.extract_document_body": lambda: TeXParser.extract_document_body(text),
+        "TeXParser.extract_title": lambda: TeXParser.extract_title(text),
+        "TeXParser.extract_graphicspath": lambda: TeXParser.extract_graphicspath(text),
+        "TeXParser.extract_abstract": lambda: TeXParser.extract_abstract(body),
+        "ContentProcessor.rewrite_body": lambda: ContentProcessor.rewrite_body(body_only, graphics_map=plan.paths),
+        "ContentProcessor.collect_cite_keys": lambda: ContentProcessor.collect_cite_keys(rewritten),
+        "ContentProcessor.collect_graphics_options": lambda: ContentProcessor.collect_graphics_options(body_only),
+        "FileHandler.collect_files_by_ext": lambda: FileHandler.collect_files_by_ext(
+            project, IMAGE_EXTS, TreeIndex.build(project)
+        ),
+        "FileHandler.plan_images": lambda: FileHandler.plan_images(refs, index, "figures", search_dirs),
+        "FileHandler.copy_images": lambda: FileHandler.copy_images(
+            project, fresh("images"), "figures", index, plan.sources
+        ),
+        "FileHandler.copy_template_structure": lambda: FileHandler.copy_template_structure(
+            REPO_TEMPLATE, fresh("template"), TreeIndex.build(REPO_TEMPLATE)
+        ),
+        "FileHandler.merge_bib_files": lambda: FileHandler.merge_bib_files(bibs, fresh("bib") / "refs.bib"),
+        "FileHandler.merge_bib_files[pruned]": lambda: FileHandler.merge_bib_files(
+            bibs, fresh("bib") / "refs.bib", cited
+        ),
+        "FileHandler.file_digest": lambda: FileHandler.file_digest(bibs[0]),
+    }
+
+
+def end_to_end_cases(project: Path, work: Path) -> Dict[str, Callable[[], object]]:
+    """convert() on the synthetic project: from scratch, and again with nothing changed"""
+    counter = iter(range(1 << 30))
+    warm = work / "convert_warm"
+    AMAToMDPIConverter(project, REPO_TEMPLATE, warm).convert()
+
+    def cold() -> None:
+        out = work / f"convert_cold{next(counter)}"
+        if not AMAToMDPIConverter(project, REPO_TEMPLATE, out, incremental=False).convert():
+            raise RuntimeError(f"convert() failed, see {out / 'conversion_report.md'}")
+
+    return {
+        "convert[cold]": cold,
+        "convert[incremental]": lambda: AMAToMDPIConverter(project, REPO_TEMPLATE, warm).convert(),
+    }
+
+
+def time_case(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Best and median wall time over repeat runs"""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"seconds": min(runs), "median": statistics.median(runs), "runs": len(runs)}
+
+
+def compare_results(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+    min_seconds: float
+) -> List[str]:
+    """Names of cases slower than baseline by more than threshold (and min_seconds)"""
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = r["seconds"] - base["seconds"]
+        if slower > min_seconds and r["seconds"] > base["seconds"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def bench_suite(
+    params: Dict[str, int],
+    repeat: int,
+    json_out: Optional[Path],
+    baseline: Optional[Path],
+    threshold: float,
+    min_seconds: float
+) -> bool:
+    """
+    Time every case on one synthetic project, optionally save the results as
+    JSON and compare them with a baseline file. Returns False on regressions.
+    """
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        start = time.perf_counter()
+        project = tmp / "project"
+        make_project(project, **params)
+        print(f"suite: project generated in {time.perf_counter() - start:.1f}s "
+              + ", ".join(f"{k}={v}" for k, v in params.items()))
+
+        results: Dict[str, Dict[str, float]] = {}
+        cases = dict(suite_cases(project, tmp), **end_to_end_cases(project, tmp))
+        for name, fn in cases.items():
+            results[name] = time_case(fn, repeat)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    base: Dict[str, Dict[str, float]] = {}
+    if baseline is not None:
+        data = json.loads(baseline.read_text(encoding="utf-8"))
+        if data.get("params") != params:
+            print(f"[WARN] Baseline was recorded with different parameters: {data.get('params')}")
+        base = data.get("results", {})
+    regressions = compare_results(results, base, threshold, min_seconds)
+
+    print(f"{'case':<42} {'best (s)':>10} {'median (s)':>11} {'baseline':>10} {'change':>8}")
+    for name, r in results.items():
+        line = f"{name:<42} {r['seconds']:>10.4f} {r['median']:>11.4f}"
+        if name in base:
+            change = (r["seconds"] - base[name]["seconds"]) / max(base[name]["seconds"], 1e-9)
+            flag = "  REGRESSION" if name in regressions else ""
+            line += f" {base[name]['seconds']:>10.4f} {change:>+8.0%}{flag}"
+        print(line)
+
+    if json_out is not None:
+        json_out.write_text(json.dumps({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "params": params,
+            "results": results,
+        }, indent=2), encoding="utf-8")
+        print(f"results written to {json_out}")
+    if regressions:
+        print(f"[FAIL] {len(regressions)} case(s) slower than baseline by more than {threshold:.0%}: "
+              + ", ".join(regressions))
+        return False
+    if base:
+        print(f"[OK] No regressions beyond {threshold:.0%} against {baseline}")
+    return True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix socket (service URLs of the form unix:/path)"""
+
+    def __init__(self, path: str, timeout: float = 600):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def service_request(url: str, method: str, target: str, body: Optional[bytes] = None) -> Tuple[int, bytes]:
+    """One request to the conversion service; url is http://host:port or unix:/path"""
+    if url.startswith("unix:"):
+        conn: http.client.HTTPConnection = UnixHTTPConnection(url[len("unix:"):])
+    else:
+        parts = urllib.parse.urlsplit(url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=600)
+    try:
+        conn.request(method, target, body=body)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+
+def zip_tree(root: Path) -> bytes:
+    """A directory tree as an in-memory zip archive"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(root.rglob("*")):
+            if path.is_file():
+                zf.write(path, path.relative_to(root).as_posix())
+    return buf.getvalue()
+
+
+def start_service(workers: int, max_queue: int) -> Tuple[subprocess.Popen, str]:
+    """Start ama_to_mdpi_convert.py --serve on a free port; returns (process, url)"""
+    proc = subprocess.Popen(
+        [sys.executable, str(REPO_SCRIPT), "--serve", "--mdpi_template_dir", str(REPO_TEMPLATE),
+         "--port", "0", "--workers", str(workers), "--max_queue", str(max_queue)],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = proc.stdout.readline()
+    match = re.search(r"(http://\S+)", line)
+    if not match:
+        proc.terminate()
+        raise RuntimeError(f"service did not start: {line!r}")
+    return proc, match.group(1)
+
+
+def bench_service(url: Optional[str], requests: int, concurrency: int, workers: int, max_queue: int) -> None:
+    """
+    Load-test the conversion service with the sample manuscript: concurrent
+    POST /convert requests, latency percentiles, 503 rejections and the
+    service's own /metrics, next to a cold one-process-per-conversion run.
+    """
+    archive = zip_tree(REPO_SOURCE)
+    proc = None
+    if url is None:
+        proc, url = start_service(workers, max_queue)
+    try:
+        status, _ = service_request(url, "POST", "/convert", archive)
+        if status != 200:
+            raise RuntimeError(f"warm-up conversion failed with HTTP {status}")
+
+        def one(_: int) -> Tuple[int, int, float]:
+            # Busy answers (503) are retried after a short pause, as a real client would
+            start = time.perf_counter()
+            busy = 0
+            status, _ = service_request(url, "POST", "/convert", archive)
+            while status == 503:
+                busy += 1
+                time.sleep(BUSY_RETRY_SECONDS)
+                status, _ = service_request(url, "POST", "/convert", archive)
+            return status, busy, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(requests)))
+        wall = time.perf_counter() - start
+        metrics = json.loads(service_request(url, "GET", "/metrics")[1])
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    ok = sorted(seconds for status, _, seconds in results if status == 200)
+    busy = sum(busy for _, busy, _ in results)
+    print(f"service: {url}, {requests} requests, concurrency {concurrency}, archive {len(archive) / 1024:.0f} KB")
+    print(f"  {'throughput':<24} {len(ok) / wall:>10.1f} conversions/s ({wall:.2f}s wall)")
+    if ok:
+        pick = lambda q: ok[min(len(ok) - 1, int(q * len(ok)))]
+        print(f"  {'latency p50 / p95':<24} {pick(0.5):>10.3f} / {pick(0.95):.3f} s")
+    print(f"  {'rejected (503, retried)':<24} {busy:>10}")
+    print(f"  {'failures':<24} {len(results) - len(ok):>10}")
+    print(f"  {'peak queue depth':<24} {metrics['peak_queue_depth']:>10}")
+    print(f"  {'queue wait p95':<24} {metrics['queue_wait_seconds']['p95']:>10.3f} s")
+
+    tmp = Path(tempfile.mkdtemp(prefix="ama2mdpi_bench_"))
+    try:
+        src = tmp / "src.zip"
+        src.write_bytes(archive)
+        cold = time_case(lambda: subprocess.run(
+            [sys.executable, str(REPO_SCRIPT), "--source_zip", str(src),
+             "--mdpi_template_dir", str(REPO_TEMPLATE), "--out_dir", str(tmp / "out.zip")],
+            check=True, stdout=subprocess.DEVNULL
+        ), 3)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"  {'cold CLI run (best of 3)':<24} {cold['seconds']:>10.3f} s per conversion")
+
+
+BENCHMARKS = (
+    "tree_index", "main_tex", "materialize", "rewrite", "linearity", "memory", "bib", "images", "figures", "suite",
+    "service",
+)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark the AMA to MDPI converter")
+    ap.add_argument("benchmarks", nargs="*", choices=BENCHMARKS, help="Benchmarks to run (default: all)")
+    ap.add_argument("--dirs", type=int, default=200, help="Number of data directories in the synthetic tree")
+    ap.add_argument("--files_per_dir", type=int, default=100, help="Files per data directory")
+    ap.add_argument("--tex_files", type=int, default=300, help="Number of non-main .tex files")
+    ap.add_argument("--tex_lines", type=int, default=2000, help="Lines per non-main .tex file")
+    ap.add_argument("--outputs", type=int, default=100, help="Number of output directories to materialize into")
+    ap.add_argument("--copies", type=int, default=200, help="Body size multiplier for the rewrite benchmark")
+    ap.add_argument("--linear_mb", type=float, default=2.0, help="Linearity: size of the smallest manuscript in MB")
+    ap.add_argument("--linear_steps", type=int, default=4, help="Linearity: number of sizes (each doubles the last)")
+    ap.add_argument("--fuzz_cases", type=int, default=2000, help="Linearity: random documents checked against legacy")
+    ap.add_argument("--memory_mb", type=float, default=100.0, help="Memory: size of the synthetic manuscript in MB")
+    ap.add_argument("--bib_entries", type=int, default=50000, help="Entries in the synthetic .bib library")
+    ap.add_argument("--cited", type=int, default=100, help="Keys cited by the pruned bib variant")
+    ap.add_argument("--images", type=int, default=4000, help="Image files in the synthetic image tree")
+    ap.add_argument("--referenced", type=int, default=200, help="Images referenced by \\includegraphics")
+    ap.add_argument("--image_kb", type=int, default=64, help="Size of each synthetic image in KB")
+    ap.add_argument("--figures", type=int, default=24, help="Synthetic PNG figures to optimize")
+    ap.add_argument("--figure_px", type=int, default=3000, help="Width of the synthetic PNG figures")
+    ap.add_argument("--repeat", type=int, default=3, help="Timing repetitions (best is reported)")
+    ap.add_argument("--body_lines", type=int, default=10000, help="Suite: lines in the synthetic manuscript body")
+    ap.add_argument("--brace_depth", type=int, default=200, help="Suite: depth of the nested brace group in the body")
+    ap.add_argument("--project_figures", type=int, default=2000, help="Suite: image files in the synthetic project")
+    ap.add_argument("--project_tex_files", type=int, default=200, help="Suite: non-main .tex files in the project")
+    ap.add_argument("--json", default=None, help="Suite: write the results to this JSON file")
+    ap.add_argument("--baseline", default=None, help="Suite: compare against results saved with --json")
+    ap.add_argument("--threshold", type=float, default=0.25,
+                    help="Suite: fail when a case is this fraction slower than the baseline")
+    ap.add_argument("--min_seconds", type=float, default=0.005,
+                    help="Suite: ignore slowdowns smaller than this many seconds (timer noise)")
+    ap.add_argument("--service_url", default=None,
+                    help="Service: load-test a running service (http://host:port or unix:/path) "
+                         "instead of starting one")
+    ap.add_argument("--requests", type=int, default=200, help="Service: number of conversions to send")
+    ap.add_argument("--concurrency", type=int, default=8, help="Service: concurrent client connections")
+    ap.add_argument("--service_workers", type=int, default=4, help="Service: worker processes of the started service")
+    ap.add_argument("--max_queue", type=int, default=16, help="Service: queue limit of the started service")
+    args = ap.parse_args()
+
+    selected = args.benchmarks or BENCHMARKS
+    if "tree_index" in selected:
+        bench_tree_index(args.dirs, args.files_per_dir, args.repeat)
+    if "main_tex" in selected:
+        bench_main_tex(args.tex_files, args.tex_lines, args.repeat)
+    if "materialize" in selected:
+        bench_materialize(args.outputs)
+    if "rewrite" in selected:
+        bench_rewrite(args.copies, args.repeat)
+    if "linearity" in selected:
+        if not bench_linearity(args.linear_mb, args.linear_steps, args.repeat, args.fuzz_cases):
+            raise SystemExit(1)
+    if "memory" in selected:
+        bench_memory(args.memory_mb)
+    if "bib" in selected:
+        bench_bib(args.bib_entries, args.cited, args.repeat)
+    if "images" in selected:
+        bench_images(args.images, args.referenced, args.image_kb, args.repeat)
+    if "figures" in selected:
+        bench_figures(args.figures, args.figure_px)
+    if "suite" in selected:
+        params = {
+            "body_lines": args.body_lines,
+            "brace_depth": args.brace_depth,
+            "bib_entries": args.bib_entries,
+            "figures": args.project_figures,
+            "tex_files": args.project_tex_files,
+        }
+        ok = bench_suite(
+            params, args.repeat,
+            Path(args.json) if args.json else None,
+            Path(args.baseline) if args.baseline else None,
+            args.threshold, args.min_seconds
+        )
+        if not ok:
+            raise SystemExit(1)
+    if "service" in selected:
+        bench_service(args.service_url, args.requests, args.concurrency, args.service_workers, args.max_queue)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,13 @@ echo AMA to MDPI Conversion and Compilation
 echo ========================================
 echo.
 
-REM Step 1: Run the conversion script
-echo [1/5] Running conversion script...
-python ama_to_mdpi_convert.py --source_dir ./ama_source --mdpi_template_dir ./mdpi_template --out_dir ./output
+REM Step 1: Convert and compile. LaTeX/BibTeX are run only as often as needed
+REM (BibTeX when citations or refs.bib changed, LaTeX until .aux/.out settle).
+REM An unchanged manuscript is restored from the PDF cache without running LaTeX.
+echo [1/2] Running conversion and compilation...
+python ama_to_mdpi_convert.py --source_dir ./ama_source --mdpi_template_dir ./mdpi_template --out_dir ./output --compile --cache_pdf
 if errorlevel 1 (
-    echo ERROR: Conversion failed!
+    echo ERROR: Conversion or compilation failed! See output\conversion_report.md
     pause
     exit /b 1
 )
@@ -20,6 +22,7 @@ echo Conversion completed successfully.
 echo.
 
 REM Step 2: Change to output directory
+echo [2/2] Checking result...
 cd output
 if errorlevel 1 (
     echo ERROR: Cannot enter output directory!
@@ -28,32 +31,6 @@ if errorlevel 1 (
     exit /b 1
 )
 
-REM Step 3: First LaTeX pass
-echo [2/5] Running pdflatex (first pass)...
-pdflatex -interaction=nonstopmode main.tex > nul 2>&1
-if errorlevel 1 (
-    echo Warning: First pass had some issues, continuing...
-)
-echo.
-
-REM Step 4: Run bibtex
-echo [3/5] Running bibtex...
-bibtex main
-if errorlevel 1 (
-    echo Warning: Bibtex had some issues, continuing...
-)
-echo.
-
-REM Step 5: Second LaTeX pass
-echo [4/5] Running pdflatex (second pass)...
-pdflatex -interaction=nonstopmode main.tex > nul 2>&1
-echo.
-
-REM Step 6: Final LaTeX pass
-echo [5/5] Running pdflatex (final pass)...
-pdflatex -interaction=nonstopmode main.tex
-echo.
-
 REM Check if PDF was generated
 if exist main.pdf (
     echo ========================================
@@ -9,42 +9,25 @@ echo "AMA to MDPI Conversion and Compilation"
 echo "========================================"
 echo ""
 
-# Step 1: Run the conversion script
-echo "[1/5] Running conversion script..."
-python ama_to_mdpi_convert.py --source_dir ./ama_source --mdpi_template_dir ./mdpi_template --out_dir ./output
+# Step 1: Convert and compile. LaTeX/BibTeX are run only as often as needed
+# (BibTeX when citations or refs.bib changed, LaTeX until .aux/.out settle).
+# An unchanged manuscript is restored from the PDF cache without running LaTeX.
+echo "[1/2] Running conversion and compilation..."
+python ama_to_mdpi_convert.py --source_dir ./ama_source --mdpi_template_dir ./mdpi_template --out_dir ./output --compile --cache_pdf
 if [ $? -ne 0 ]; then
-    echo "ERROR: Conversion failed!"
+    echo "ERROR: Conversion or compilation failed! See output/conversion_report.md"
     exit 1
 fi
 echo "Conversion completed successfully."
 echo ""
 
 # Step 2: Change to output directory
+echo "[2/2] Checking result..."
 cd output || {
     echo "ERROR: Cannot enter output directory!"
     exit 1
 }
 
-# Step 3: First LaTeX pass
-echo "[2/5] Running pdflatex (first pass)..."
-pdflatex -interaction=nonstopmode main.tex > /dev/null 2>&1
-echo ""
-
-# Step 4: Run bibtex
-echo "[3/5] Running bibtex..."
-bibtex main
-echo ""
-
-# Step 5: Second LaTeX pass
-echo "[4/5] Running pdflatex (second pass)..."
-pdflatex -interaction=nonstopmode main.tex > /dev/null 2>&1
-echo ""
-
-# Step 6: Final LaTeX pass
-echo "[5/5] Running pdflatex (final pass)..."
-pdflatex -interaction=nonstopmode main.tex
-echo ""
-
 # Check if PDF was generated
 if [ -f main.pdf ]; then
     echo "========================================"
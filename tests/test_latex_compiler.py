@@ -0,0 +1,110 @@
+"""LaTeXCompiler pass logic, driven by fake latex/bibtex engines"""
+import shlex
+import sys
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from ama_to_mdpi_convert import LaTeXCompiler
+
+# Fake pdflatex. The document says what the .aux gets:
+#   \bibliography{...}  citation data, plus \bibcite lines once a .bbl exists
+#   %settle=N           a counter that grows by one per run until it reaches N
+#   %settle=never       a counter that never stops growing
+FAKE_LATEX = r'''
+import re, sys
+from pathlib import Path
+
+tex = Path(sys.argv[-1])
+job = tex.stem
+src = tex.read_text()
+aux = Path(job + ".aux")
+old = aux.read_text() if aux.exists() else ""
+lines = ["\\relax"]
+if "\\bibliography{" in src:
+    lines += ["\\citation{key1}", "\\bibdata{refs}", "\\bibstyle{mdpi}"]
+    if Path(job + ".bbl").exists():
+        lines.append("\\bibcite{key1}{1}")
+settle = re.search(r"%settle=(\w+)", src)
+if settle:
+    count = re.search(r"\\count\{(\d+)\}", old)
+    n = int(count.group(1)) + 1 if count else 1
+    if settle.group(1) != "never":
+        n = min(n, int(settle.group(1)))
+    lines.append("\\count{%d}" % n)
+aux.write_text("\n".join(lines) + "\n")
+Path(job + ".log").write_text("This is fake pdflatex, " + tex.name + "\n")
+Path(job + ".pdf").write_bytes(b"%PDF-1.5 fake\n")
+'''
+
+FAKE_BIBTEX = r'''
+import sys
+from pathlib import Path
+
+Path(sys.argv[-1] + ".bbl").write_text("\\begin{thebibliography}{1}\n\\end{thebibliography}\n")
+'''
+
+
+@pytest.fixture
+def engines(tmp_path: Path) -> Path:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "fake_latex.py").write_text(FAKE_LATEX)
+    (bin_dir / "fake_bibtex.py").write_text(FAKE_BIBTEX)
+    return bin_dir
+
+
+def make_compiler(out_dir: Path, engines: Path, body: str, max_passes: int = 5) -> LaTeXCompiler:
+    out_dir.mkdir(exist_ok=True)
+    (out_dir / "main.tex").write_text(f"\\documentclass{{article}}\n{body}\n")
+    (out_dir / "refs.bib").write_text("@article{key1, title={T}}\n")
+    python = shlex.quote(sys.executable)
+    return LaTeXCompiler(
+        out_dir,
+        latex_cmd=f"{python} {shlex.quote(str(engines / 'fake_latex.py'))}",
+        bibtex_cmd=f"{python} {shlex.quote(str(engines / 'fake_bibtex.py'))}",
+        max_passes=max_passes,
+    )
+
+
+def tools(compiler: LaTeXCompiler) -> List[str]:
+    return [step["tool"] for step in compiler.steps]
+
+
+def test_bibtex_runs_once_and_passes_stop_when_aux_is_stable(tmp_path: Path, engines: Path) -> None:
+    compiler = make_compiler(tmp_path / "out", engines, "\\bibliography{refs}")
+    assert compiler.compile() == tmp_path / "out" / "main.pdf"
+    # 1: .aux written, BibTeX; 2: \bibcite added to the .aux; 3: nothing changed
+    assert tools(compiler) == ["LaTeX", "BibTeX", "LaTeX", "LaTeX"]
+    assert all(step["returncode"] == 0 for step in compiler.steps)
+    assert compiler.warnings == [] and compiler.errors == []
+
+
+def test_unchanged_document_recompiles_in_one_pass(tmp_path: Path, engines: Path) -> None:
+    make_compiler(tmp_path / "out", engines, "\\bibliography{refs}").compile()
+    again = make_compiler(tmp_path / "out", engines, "\\bibliography{refs}")
+    again.compile()
+    assert tools(again) == ["LaTeX"]
+
+
+def test_bibtex_skipped_without_bibdata(tmp_path: Path, engines: Path) -> None:
+    compiler = make_compiler(tmp_path / "out", engines, "No citations here.")
+    assert compiler.compile() is not None
+    assert tools(compiler) == ["LaTeX", "LaTeX"]
+    assert not (tmp_path / "out" / "main.bbl").exists()
+
+
+def test_reruns_stop_once_aux_converges(tmp_path: Path, engines: Path) -> None:
+    compiler = make_compiler(tmp_path / "out", engines, "%settle=3")
+    compiler.compile()
+    # .aux counter: 1, 2, 3, 3
+    assert tools(compiler) == ["LaTeX"] * 4
+    assert compiler.warnings == []
+
+
+def test_reruns_capped_at_max_passes(tmp_path: Path, engines: Path) -> None:
+    compiler = make_compiler(tmp_path / "out", engines, "%settle=never", max_passes=3)
+    assert compiler.compile() is not None
+    assert tools(compiler) == ["LaTeX"] * 3
+    assert len(compiler.warnings) == 1 and "3" in compiler.warnings[0]
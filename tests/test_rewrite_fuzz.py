@@ -0,0 +1,61 @@
+"""Single-pass body rewrite and abstract/template handling against the previous regex implementations"""
+import random
+
+import pytest
+
+from ama_to_mdpi_convert import AMAToMDPIConverter, ContentProcessor, TeXParser
+from benchmark_convert import (
+    REPO_SOURCE,
+    REPO_TEMPLATE,
+    fuzz_document,
+    legacy_extract_abstract,
+    legacy_inject,
+    legacy_rewrite,
+)
+
+# Well-formed pieces only. No piece starts with a letter: the previous
+# rewrite also cut \maketitle out of longer control words (see below).
+REWRITE_TOKENS = [
+    " text", "\n", "  ", "{", "}", "$x$", "\\\\", "\\cite{k}", "\\ref{f}", "\\emph{y}", "\\section{S}",
+    "\\citep{k1}", "\\citet {k2,k3}", "\\citep\n{k}",
+    "\\maketitle", "\\maketitle\n\n",
+    "\\printbibliography", "\\printbibliography[heading=none]",
+    "\\addbibresource{refs.bib}", "\\addbibresource{a.bib}\n",
+    "\\includegraphics{img/a.png}", "\\includegraphics[width=0.5\\linewidth]{../b c.pdf}",
+    "\\includegraphics{figures/x.png}",
+]
+
+FUZZ_CASES = 2000
+# Each case renders the whole MDPI template
+INJECT_CASES = 300
+
+
+def test_rewrite_body_matches_previous_rewrite() -> None:
+    rng = random.Random(0)
+    for _ in range(FUZZ_CASES):
+        body = "".join(rng.choice(REWRITE_TOKENS) for _ in range(rng.randint(0, 40)))
+        assert ContentProcessor.rewrite_body(body).body == legacy_rewrite(body), body
+
+
+def test_rewrite_body_leaves_longer_control_words_alone() -> None:
+    body = "\\maketitlepage \\printbibliographyheading x"
+    assert ContentProcessor.rewrite_body(body).body == body
+
+
+@pytest.fixture(scope="module")
+def converter(tmp_path_factory: pytest.TempPathFactory) -> AMAToMDPIConverter:
+    return AMAToMDPIConverter(REPO_SOURCE, REPO_TEMPLATE, tmp_path_factory.mktemp("out"))
+
+
+def test_extract_abstract_and_inject_match_previous(converter: AMAToMDPIConverter) -> None:
+    _, mdpi_main = converter.find_main_files()
+    template = TeXParser.read_text(mdpi_main)
+    converter.title, converter.abstract = "Fuzz title", "Fuzz abstract"
+
+    rng = random.Random(0)
+    for _ in range(INJECT_CASES):
+        body = fuzz_document(rng)
+        assert TeXParser.extract_abstract(body) == legacy_extract_abstract(body), body
+        assert converter.inject_body_into_template(mdpi_main, body) == legacy_inject(
+            template, converter.title, converter.abstract, body
+        ), body